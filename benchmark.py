@@ -0,0 +1,355 @@
+"""NetKeep基准测试：在本地启动模拟的主机面板，用合成账号运行完整的登录与续期流程并统计耗时
+
+示例:
+    python benchmark.py --accounts 20 --sites 2 --latency 50 -- --concurrency 4 --site-rate 0
+
+"--"之后的参数原样传给netkeep（与命令行运行netkeep.py时相同）。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import resource
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 状态文件写到临时目录，避免污染真实的会话与cf_clearance缓存（必须在导入netkeep之前设置）
+os.environ['NETKEEP_STATE_DIR'] = tempfile.mkdtemp(prefix='netkeep-bench-')
+os.environ.pop('TELEGRAM_BOT_TOKEN', None)
+os.environ.pop('TELEGRAM_CHAT_ID', None)
+
+import netkeep  # noqa: E402
+
+PASSWORD = 'bench-password'
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><title>登录</title></head>
+<body>
+<form method="post" action="/login">
+  <input type="hidden" name="_token" value="{csrf}">
+  <input type="text" name="username">
+  <input type="password" name="password">
+  <button type="submit">登录</button>
+</form>
+{error}
+</body></html>"""
+
+HOME_PAGE = """<!DOCTYPE html>
+<html><head><title>用户中心</title></head>
+<body><h1>用户中心</h1><a href="/server/lxc">我的服务器</a></body></html>"""
+
+# 服务器列表页：点击续费后弹出layui风格的弹窗，弹窗按钮通过AJAX调用续期接口
+LXC_PAGE = """<!DOCTYPE html>
+<html><head><title>LXC 服务器</title></head>
+<body>
+<h1>控制面板</h1>
+<table><tr><td>VPS #{server_id}</td><td><button class="btn btn-renew" id="renewBtn">续费</button></td></tr></table>
+<script>
+document.getElementById('renewBtn').addEventListener('click', function () {{
+  var layer = document.createElement('div');
+  layer.className = 'layui-layer';
+  layer.innerHTML = '<div class="layui-layer-content">续费一个月</div>' +
+    '<button id="submitRenew" class="btn-primary">点击续费</button>';
+  document.body.appendChild(layer);
+  document.getElementById('submitRenew').addEventListener('click', function () {{
+    fetch('/server/detail/{server_id}/renew', {{
+      method: 'POST',
+      headers: {{'Content-Type': 'application/x-www-form-urlencoded', 'X-Requested-With': 'XMLHttpRequest'}},
+      body: 'month=1&coupon_id=0&submit=1'
+    }}).then(function (r) {{ return r.json(); }}).then(function (data) {{
+      // 与layui一样关闭确认弹窗，再用消息层显示接口返回的消息
+      layer.remove();
+      var msg = document.createElement('div');
+      msg.className = 'layui-layer layui-layer-msg';
+      msg.innerHTML = '<div class="layui-layer-content"></div>';
+      msg.firstChild.textContent = data.msg;
+      document.body.appendChild(msg);
+    }});
+  }});
+}});
+</script>
+</body></html>"""
+
+# 模拟CloudFlare的"Just a moment"页面：等待片刻后写入cf_clearance并刷新
+CHALLENGE_PAGE = """<!DOCTYPE html>
+<html><head><title>Just a moment...</title></head>
+<body>
+<div id="challenge-running">Checking your browser before accessing the site.</div>
+<script>
+setTimeout(function () {{
+  document.cookie = 'cf_clearance={token}; path=/; max-age=3600';
+  location.reload();
+}}, {delay});
+</script>
+</body></html>"""
+
+
+class PanelState:
+    """模拟面板的共享状态"""
+
+    def __init__(self, latency_ms, jitter_ms, challenge, challenge_delay_ms, renew_result):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.challenge = challenge
+        self.challenge_delay_ms = challenge_delay_ms
+        self.renew_result = renew_result
+        self.sessions = {}
+        self.clearances = set()
+        self.lock = threading.Lock()
+        self.requests = 0
+
+
+def make_handler(state):
+    class PanelHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, body, content_type='text/html; charset=utf-8', headers=None):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def redirect(self, location, headers=None):
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+
+        def cookies(self):
+            cookies = {}
+            for part in self.headers.get('Cookie', '').split(';'):
+                name, sep, value = part.strip().partition('=')
+                if sep:
+                    cookies[name] = value
+            return cookies
+
+        def simulate_latency(self):
+            with state.lock:
+                state.requests += 1
+            delay = state.latency_ms + random.uniform(0, state.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000)
+
+        def challenged(self):
+            """开启挑战时，没有有效cf_clearance的页面请求返回挑战页"""
+            if not state.challenge or self.cookies().get('cf_clearance') in state.clearances:
+                return False
+            token = secrets.token_hex(16)
+            with state.lock:
+                state.clearances.add(token)
+            self.send_body(403, CHALLENGE_PAGE.format(token=token, delay=state.challenge_delay_ms),
+                           headers={'Server': 'cloudflare', 'cf-mitigated': 'challenge'})
+            return True
+
+        def current_user(self):
+            return state.sessions.get(self.cookies().get('sw110xy'))
+
+        def do_GET(self):
+            self.simulate_latency()
+            path = urlparse(self.path).path
+            if self.challenged():
+                return
+            if path == '/login':
+                self.send_body(200, LOGIN_PAGE.format(csrf=secrets.token_hex(8), error=''))
+            elif path == '/user':
+                if self.current_user() is None:
+                    return self.redirect('/login')
+                self.send_body(200, HOME_PAGE)
+            elif path == '/server/lxc':
+                user = self.current_user()
+                if user is None:
+                    return self.redirect('/login')
+                self.send_body(200, LXC_PAGE.format(server_id=user['server_id']))
+            else:
+                self.send_body(404, 'not found', 'text/plain')
+
+        def do_POST(self):
+            self.simulate_latency()
+            path = urlparse(self.path).path
+            length = int(self.headers.get('Content-Length') or 0)
+            form = parse_qs(self.rfile.read(length).decode('utf-8'))
+            if self.challenged():
+                return
+            if path == '/login':
+                username = form.get('username', [''])[0]
+                if form.get('password', [''])[0] != PASSWORD:
+                    return self.send_body(200, LOGIN_PAGE.format(csrf=secrets.token_hex(8), error='<p>密码错误</p>'))
+                token = secrets.token_hex(16)
+                match = re.search(r'(\d+)$', username)
+                with state.lock:
+                    state.sessions[token] = {'username': username, 'server_id': match.group(1) if match else '1'}
+                self.redirect('/user', headers={'Set-Cookie': f'sw110xy={token}; Path=/; HttpOnly'})
+            elif re.fullmatch(r'/server/detail/\d+/renew', path):
+                if self.current_user() is None:
+                    return self.send_body(200, json.dumps({'code': -1, 'msg': '请先登录'}), 'application/json')
+                if state.renew_result == 'early':
+                    result = {'code': 0, 'msg': '请在到期前3天后再续费'}
+                else:
+                    result = {'code': 1, 'msg': '续期成功'}
+                self.send_body(200, json.dumps(result, ensure_ascii=False), 'application/json')
+            else:
+                self.send_body(404, 'not found', 'text/plain')
+
+    return PanelHandler
+
+
+def start_panels(count, state):
+    """启动count个模拟面板（不同端口即不同站点），返回 (服务器列表, 站点URL列表)"""
+    servers = []
+    for _ in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers, [f"http://127.0.0.1:{server.server_address[1]}" for server in servers]
+
+
+def make_accounts(count, sites, login_mode=None):
+    """生成合成账号，轮流分配到各个站点"""
+    accounts = []
+    for i in range(count):
+        account = {
+            'username': f"bench{i + 1}",
+            'password': PASSWORD,
+            'site': sites[i % len(sites)],
+            'loginApi': '/login',
+            'renewApi': f"/server/detail/{i + 1}/renew",
+            'renewBody': 'month=1&coupon_id=0&submit=1'
+        }
+        if login_mode:
+            account['loginMode'] = login_mode
+        accounts.append(account)
+    return accounts
+
+
+def percentile(values, p):
+    """返回已排序列表的第p百分位（最近秩法）"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def timed_process_account(durations):
+    """包装netkeep.process_account，记录每个账号从开始调度到完成的时间"""
+    original = netkeep.process_account
+
+    async def wrapper(p, account, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original(p, account, *args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - started)
+
+    return wrapper
+
+
+def parse_args(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    netkeep_argv = []
+    if '--' in argv:
+        index = argv.index('--')
+        argv, netkeep_argv = argv[:index], argv[index + 1:]
+
+    parser = argparse.ArgumentParser(description="NetKeep基准测试（本地模拟面板）")
+    parser.add_argument('--accounts', type=int, default=10, help="合成账号数量（默认10）")
+    parser.add_argument('--sites', type=int, default=1, help="模拟站点数量，每个站点一个端口（默认1）")
+    parser.add_argument('--latency', type=float, default=50, help="每个请求的固定延迟，毫秒（默认50）")
+    parser.add_argument('--jitter', type=float, default=0, help="每个请求额外的随机延迟上限，毫秒（默认0）")
+    parser.add_argument('--challenge', action='store_true', help="没有cf_clearance的请求返回模拟的CloudFlare挑战页")
+    parser.add_argument('--challenge-delay', type=float, default=1000, help="挑战页写入cf_clearance前的等待，毫秒")
+    parser.add_argument('--renew-result', choices=['ok', 'early'], default='ok',
+                        help="续期接口返回成功（ok）或未到续期时间（early）")
+    parser.add_argument('--login-mode', choices=['auto', 'http', 'browser'],
+                        help="写入每个合成账号的loginMode（默认沿用netkeep的--login-mode）")
+    parser.add_argument('--json', action='store_true', help="以JSON输出结果")
+    return parser.parse_args(argv), netkeep.parse_args(netkeep_argv)
+
+
+def main(argv=None):
+    args, netkeep_args = parse_args(argv)
+    netkeep.setup_logging(netkeep_args.log_level, netkeep_args.log_file)
+    if netkeep_args.no_block_resources:
+        os.environ['NETKEEP_BLOCK_RESOURCES'] = '0'
+    netkeep.load_site_profiles(netkeep_args.profiles)
+
+    state = PanelState(args.latency, args.jitter, args.challenge, args.challenge_delay, args.renew_result)
+    servers, sites = start_panels(max(1, args.sites), state)
+    accounts = make_accounts(args.accounts, sites, args.login_mode)
+
+    durations = []
+    netkeep.process_account = timed_process_account(durations)
+    started = time.perf_counter()
+    try:
+        login_statuses, renew_statuses = asyncio.run(netkeep.run_accounts(
+            accounts, netkeep_args.concurrency, netkeep_args.browser_mode,
+            use_session_cache=not netkeep_args.no_session_cache, login_mode=netkeep_args.login_mode,
+            site_concurrency=netkeep_args.site_concurrency, site_rate=netkeep_args.site_rate
+        ))
+    finally:
+        wall_time = time.perf_counter() - started
+        for server in servers:
+            server.shutdown()
+
+    netkeep.export_metrics(netkeep_args)
+    durations.sort()
+    # 续期接口有响应（包括"未到续期时间"）即视为完成了续期流程
+    renewed = sum(1 for status in renew_statuses if '续期成功' in status or '续期结果' in status)
+    report = {
+        'accounts': len(accounts),
+        'sites': len(sites),
+        'latency_ms': args.latency,
+        'challenge': args.challenge,
+        'wall_time': round(wall_time, 3),
+        'per_account_mean': round(sum(durations) / len(durations), 3) if durations else 0.0,
+        'per_account_p50': round(percentile(durations, 50), 3),
+        'per_account_p95': round(percentile(durations, 95), 3),
+        'throughput': round(len(accounts) / wall_time, 3) if wall_time else 0.0,
+        'logged_in': sum(1 for status in login_statuses if '登录成功' in status),
+        'renew_completed': renewed,
+        'requests': state.requests,
+        # Linux上ru_maxrss的单位是KB；子进程为浏览器进程中占用最大的一个
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'peak_child_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'phases': netkeep.run_metrics.to_json()['phases']
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print("\n基准测试结果:")
+        print(f"  账号数: {report['accounts']}，站点数: {report['sites']}，请求延迟: {report['latency_ms']}ms，"
+              f"CloudFlare挑战: {'开启' if report['challenge'] else '关闭'}")
+        print(f"  总耗时: {report['wall_time']}s，吞吐: {report['throughput']} 账号/秒")
+        print(f"  单账号耗时: 平均 {report['per_account_mean']}s，p50 {report['per_account_p50']}s，"
+              f"p95 {report['per_account_p95']}s")
+        print(f"  登录成功: {report['logged_in']}，完成续期: {report['renew_completed']}，面板收到请求: {report['requests']}")
+        print(f"  峰值内存: 本进程 {report['peak_rss_mb']}MB，子进程 {report['peak_child_rss_mb']}MB")
+        print("  各阶段耗时（p50 / p95 / 次数）:")
+        for phase, sites in report['phases'].items():
+            count = sum(stats['count'] for stats in sites.values())
+            p50 = max(stats['p50'] for stats in sites.values())
+            p95 = max(stats['p95'] for stats in sites.values())
+            print(f"    {phase}: {p50}s / {p95}s / {count}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -1,108 +1,99 @@
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import fnmatch
+import hashlib
+import heapq
+import itertools
 import json
 import os
+import re
+import signal
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-import traceback
+import logging.handlers
+import math
+from collections import deque
 from datetime import datetime
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin, urlparse
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 from dotenv import load_dotenv
 
-# 配置日志
-logging.basicConfig(
-    level=logging.WARNING,  # 将日志级别从INFO改为WARNING，这样INFO级别的消息将不会显示
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-logger = logging.getLogger("NetKeep")
-
-# 调试函数 - 简化版，由于日志级别设置为WARNING，INFO级别的日志不会显示
-def debug_info(message, data=None, account=None, step_name=None):
-    """空函数，由于日志级别设置为WARNING，所有INFO级别的日志都不会显示"""
-    pass
-
-# 处理配置文件
-def process_config_file():
-    """从分段的配置文件生成单行JSON格式的配置文件"""
-    config_path = 'config.json'
-    env_path = '.env'
-    env_example_path = '.env.example'
-
-    # 检查是否存在config.json文件
-    if os.path.exists(config_path):
-        try:
-            # 读取config.json文件内容
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config_content = f.read()
-
-            # 提取Telegram配置
-            import re
-            telegram_bot_token = None
-            telegram_chat_id = None
-
-            # 匹配Telegram配置
-            bot_token_match = re.search(r'TELEGRAM_BOT_TOKEN=(.*?)$', config_content, re.MULTILINE)
-            chat_id_match = re.search(r'TELEGRAM_CHAT_ID=(.*?)$', config_content, re.MULTILINE)
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，状态文件不加跨进程锁
+    fcntl = None
 
-            if bot_token_match:
-                telegram_bot_token = bot_token_match.group(1).strip()
-            if chat_id_match:
-                telegram_chat_id = chat_id_match.group(1).strip()
-
-            # 提取NETKEEP_ACCOUNTS数组
-            accounts_match = re.search(r'NETKEEP_ACCOUNTS=(\[.*?\])$', config_content, re.DOTALL | re.MULTILINE)
-            accounts_data = []
+# 日志：main()中调用setup_logging配置输出，导入模块本身不修改日志配置
+logger = logging.getLogger("NetKeep")
 
-            if accounts_match:
-                try:
-                    accounts_json = accounts_match.group(1)
-                    accounts_data = json.loads(accounts_json)
-                except json.JSONDecodeError as e:
-                    print(f"无法解析账号数据，错误: {str(e)}")
-                    # 尝试提取所有JSON对象
-                    try:
-                        pattern = r'({[^{}]*"site"[^{}]*"loginApi"[^{}]*})'
-                        matches = re.findall(pattern, accounts_json, re.DOTALL)
-
-                        if matches:
-                            # 将提取的对象组合成一个数组
-                            fixed_json = '[' + ','.join(matches) + ']'
-                            accounts_data = json.loads(fixed_json)
-                            print(f"成功从config.json中提取了 {len(accounts_data)} 个账号")
-                        else:
-                            print("无法从config.json中提取账号信息")
-                    except Exception as e:
-                        print(f"提取JSON对象失败: {str(e)}")
-            else:
-                # 如果没有找到NETKEEP_ACCOUNTS变量，尝试直接提取JSON对象
-                try:
-                    pattern = r'({[^{}]*"site"[^{}]*"loginApi"[^{}]*})'
-                    matches = re.findall(pattern, config_content, re.DOTALL)
-
-                    if matches:
-                        # 将提取的对象组合成一个数组
-                        fixed_json = '[' + ','.join(matches) + ']'
-                        accounts_data = json.loads(fixed_json)
-                        print(f"成功从config.json中直接提取了 {len(accounts_data)} 个账号")
-                    else:
-                        print("无法从config.json中提取账号信息")
-                except Exception as e:
-                    print(f"直接提取JSON对象失败: {str(e)}")
-
-            # 确保.env文件存在，如果不存在则从.env.example创建
-            if not os.path.exists(env_path) and os.path.exists(env_example_path):
-                with open(env_example_path, 'r', encoding='utf-8') as f:
-                    env_example_content = f.read()
-                with open(env_path, 'w', encoding='utf-8') as f:
-                    f.write(env_example_content)
-                print("已从.env.example创建.env文件")
-            elif not os.path.exists(env_path) and not os.path.exists(env_example_path):
-                # 如果.env和.env.example都不存在，创建一个基本的.env文件
-                basic_env_content = """# NetKeep配置文件
+# 当前账号的日志上下文（用户名、站点），每个账号的任务各自设置
+_log_context = contextvars.ContextVar('netkeep_log_context', default=None)
+
+class AccountContextFilter(logging.Filter):
+    """为日志记录附加当前账号的上下文字段 account / site"""
+
+    def filter(self, record):
+        context = _log_context.get() or {}
+        record.account = context.get('account', '')
+        record.site = context.get('site', '')
+        record.account_prefix = f"[{record.account}] " if record.account else ''
+        return True
+
+class JsonLineFormatter(logging.Formatter):
+    """每条日志输出为一行JSON，包含账号上下文字段"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'account': getattr(record, 'account', ''),
+            'site': getattr(record, 'site', '')
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging(level='INFO', json_path=None, buffer_size=500):
+    """配置日志：控制台输出文本；指定json_path时额外缓冲写入JSON行文件（每buffer_size条或遇到ERROR时写盘）"""
+    logger.setLevel(level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(account_prefix)s%(message)s', '%H:%M:%S'))
+    console.addFilter(AccountContextFilter())
+    logger.addHandler(console)
+
+    if json_path:
+        file_handler = logging.FileHandler(json_path, encoding='utf-8')
+        file_handler.setFormatter(JsonLineFormatter())
+        buffered = logging.handlers.MemoryHandler(buffer_size, flushLevel=logging.ERROR, target=file_handler)
+        buffered.addFilter(AccountContextFilter())
+        logger.addHandler(buffered)
+
+# 配置文件路径
+CONFIG_PATH = 'config.json'
+ENV_PATH = '.env'
+ENV_EXAMPLE_PATH = '.env.example'
+
+# 没有.env和.env.example时生成的基本.env
+BASIC_ENV_CONTENT = """# NetKeep配置文件
 # 自动生成的.env文件
 
 # 账号信息（JSON格式）
@@ -112,526 +103,2019 @@ NETKEEP_ACCOUNTS=[]
 # TELEGRAM_BOT_TOKEN=your_bot_token
 # TELEGRAM_CHAT_ID=your_chat_id
 """
-                with open(env_path, 'w', encoding='utf-8') as f:
-                    f.write(basic_env_content)
-                print("已创建基本的.env文件")
-
-            # 读取.env文件内容
-            if os.path.exists(env_path):
-                with open(env_path, 'r', encoding='utf-8') as f:
-                    env_content = f.read()
 
-                # 更新NETKEEP_ACCOUNTS
-                pattern_accounts = r'NETKEEP_ACCOUNTS=\[.*?\]'
-                compact_json = json.dumps(accounts_data, ensure_ascii=False, separators=(',', ':'))
+# 账号字段的类型要求：必填字段与可选字段
+ACCOUNT_REQUIRED_FIELDS = {'site': str, 'loginApi': str, 'username': str, 'password': str}
+ACCOUNT_OPTIONAL_FIELDS = {
+    'renewApi': str,
+    'renewBody': str,
+    'needCookie': bool,
+    'loginMode': str,
+    'siteConcurrency': int,
+    'siteRate': (int, float),
+    'allowResources': (list, str),
+    'profile': str
+}
+LOGIN_MODES = ('auto', 'http', 'browser')
+
+class ConfigError(Exception):
+    """配置无法解析"""
+
+def validate_account(account, index=0):
+    """按字段要求检查单个账号配置，返回错误描述列表（为空表示有效）"""
+    if not isinstance(account, dict):
+        return [f"账号 {index + 1} 不是JSON对象"]
+    name = account.get('username') or f"#{index + 1}"
+    errors = []
+    for field, expected in ACCOUNT_REQUIRED_FIELDS.items():
+        if not account.get(field):
+            errors.append(f"账号 {name} 缺少必填字段 {field}")
+        elif not isinstance(account[field], expected):
+            errors.append(f"账号 {name} 的字段 {field} 类型不正确")
+    for field, expected in ACCOUNT_OPTIONAL_FIELDS.items():
+        # bool是int的子类，siteConcurrency等数字字段不接受true/false
+        value = account.get(field)
+        if value is not None and (not isinstance(value, expected) or
+                                  (isinstance(value, bool) and expected is not bool)):
+            errors.append(f"账号 {name} 的字段 {field} 类型不正确")
+    if isinstance(account.get('site'), str) and not account['site'].startswith(('http://', 'https://')):
+        errors.append(f"账号 {name} 的site必须以http://或https://开头")
+    if account.get('loginMode') is not None and account['loginMode'] not in LOGIN_MODES:
+        errors.append(f"账号 {name} 的loginMode必须是 {'/'.join(LOGIN_MODES)} 之一")
+    return errors
+
+def validate_accounts(accounts):
+    """检查账号列表，返回有效的账号，无效账号记录警告后跳过"""
+    valid = []
+    for index, account in enumerate(accounts):
+        errors = validate_account(account, index)
+        if errors:
+            logger.warning("配置错误: %s，跳过该账号", "；".join(errors))
+            continue
+        valid.append(account)
+    return valid
+
+def extract_json_objects(text):
+    """从文本中逐个解码出包含site字段的JSON对象（可以处理嵌套结构和字符串中的括号）"""
+    decoder = json.JSONDecoder()
+    objects = []
+    index = text.find('{')
+    while index != -1:
+        try:
+            obj, end = decoder.raw_decode(text, index)
+        except json.JSONDecodeError:
+            index = text.find('{', index + 1)
+            continue
+        if isinstance(obj, dict) and 'site' in obj:
+            objects.append(obj)
+            index = text.find('{', end)
+        else:
+            index = text.find('{', index + 1)
+    return objects
 
-                if re.search(pattern_accounts, env_content, re.DOTALL):
-                    new_env_content = re.sub(pattern_accounts, f'NETKEEP_ACCOUNTS={compact_json}', env_content, flags=re.DOTALL)
-                else:
-                    # 如果没有找到NETKEEP_ACCOUNTS行，添加一个
-                    new_env_content = env_content + f"\nNETKEEP_ACCOUNTS={compact_json}\n"
-
-                # 更新Telegram配置
-                if telegram_bot_token:
-                    pattern_bot_token = r'#?\s*TELEGRAM_BOT_TOKEN=.*?$'
-                    if re.search(pattern_bot_token, new_env_content, re.MULTILINE):
-                        new_env_content = re.sub(pattern_bot_token, f'TELEGRAM_BOT_TOKEN={telegram_bot_token}', new_env_content, flags=re.MULTILINE)
-                    else:
-                        new_env_content += f"\nTELEGRAM_BOT_TOKEN={telegram_bot_token}\n"
-
-                if telegram_chat_id:
-                    pattern_chat_id = r'#?\s*TELEGRAM_CHAT_ID=.*?$'
-                    if re.search(pattern_chat_id, new_env_content, re.MULTILINE):
-                        new_env_content = re.sub(pattern_chat_id, f'TELEGRAM_CHAT_ID={telegram_chat_id}', new_env_content, flags=re.MULTILINE)
-                    else:
-                        new_env_content += f"\nTELEGRAM_CHAT_ID={telegram_chat_id}\n"
-
-                # 写入新的.env文件
-                with open(env_path, 'w', encoding='utf-8') as f:
-                    f.write(new_env_content)
-
-                print("已从config.json生成配置")
-
-                # 将账号信息设置到环境变量中，以便main函数可以直接使用
-                os.environ['NETKEEP_ACCOUNTS'] = compact_json
-                if telegram_bot_token:
-                    os.environ['TELEGRAM_BOT_TOKEN'] = telegram_bot_token
-                if telegram_chat_id:
-                    os.environ['TELEGRAM_CHAT_ID'] = telegram_chat_id
+def decode_json_value(text, start):
+    """从text的start位置解码一个JSON值，返回 (值, 结束位置)，无法解码时返回 (None, start)"""
+    try:
+        return json.JSONDecoder().raw_decode(text, start)
+    except json.JSONDecodeError:
+        return None, start
+
+def parse_accounts_text(text):
+    """解析账号JSON：完整的数组或对象优先，失败时逐个提取账号对象"""
+    text = text.strip()
+    value, end = decode_json_value(text, 0)
+    if value is not None and not text[end:].strip():
+        # 单个账号对象也视为只包含一个账号的数组
+        return [value] if isinstance(value, dict) else value
+    accounts = extract_json_objects(text)
+    if accounts:
+        logger.info("JSON格式不完整，从中提取了 %s 个账号", len(accounts))
+    return accounts
+
+def parse_config_text(text):
+    """解析config.json，返回 {'accounts': [...], 'telegram_bot_token': ..., 'telegram_chat_id': ...}
+
+    支持两种写法：与.env相同的"KEY=VALUE"分段格式（NETKEEP_ACCOUNTS=[...]可以跨多行），
+    或者纯JSON（账号数组，或包含accounts/NETKEEP_ACCOUNTS字段的对象）。
+    """
+    config = {'accounts': [], 'telegram_bot_token': None, 'telegram_chat_id': None}
+
+    stripped = text.strip()
+    if stripped.startswith(('[', '{')):
+        value, end = decode_json_value(stripped, 0)
+        if isinstance(value, list) and not stripped[end:].strip():
+            config['accounts'] = value
+            return config
+        if isinstance(value, dict) and not stripped[end:].strip() and 'site' not in value:
+            config['accounts'] = value.get('accounts', value.get('NETKEEP_ACCOUNTS', []))
+            config['telegram_bot_token'] = value.get('TELEGRAM_BOT_TOKEN')
+            config['telegram_chat_id'] = value.get('TELEGRAM_CHAT_ID')
+            return config
+
+    accounts = None
+    for match in re.finditer(r'^\s*(TELEGRAM_BOT_TOKEN|TELEGRAM_CHAT_ID|NETKEEP_ACCOUNTS)\s*=', text, re.MULTILINE):
+        key = match.group(1)
+        if key == 'NETKEEP_ACCOUNTS':
+            start = match.end()
+            while start < len(text) and text[start] in ' \t':
+                start += 1
+            value, _ = decode_json_value(text, start)
+            if value is not None:
+                accounts = [value] if isinstance(value, dict) else value
             else:
-                print("未找到.env文件，无法更新配置")
-        except Exception as e:
-            print(f"处理配置文件时出错: {str(e)}")
-
-# 处理配置文件并加载.env文件
-process_config_file()
-load_dotenv(override=True)  # 使用override=True强制重新加载.env文件
+                # 数组本身格式有误时，只在该变量之后提取账号对象
+                logger.warning("无法解析config.json中的NETKEEP_ACCOUNTS，尝试逐个提取账号")
+                accounts = extract_json_objects(text[start:])
+        else:
+            line_end = text.find('\n', match.end())
+            value = text[match.end():line_end if line_end != -1 else len(text)].strip()
+            config['telegram_bot_token' if key == 'TELEGRAM_BOT_TOKEN' else 'telegram_chat_id'] = value or None
+
+    if accounts is None:
+        # 没有NETKEEP_ACCOUNTS变量时直接提取文件中的账号对象
+        accounts = extract_json_objects(text)
+    config['accounts'] = accounts
+    return config
+
+def replace_env_value(content, key, value):
+    """替换.env内容中KEY=...的值（NETKEEP_ACCOUNTS可能是跨多行的JSON），没有该变量时追加到末尾"""
+    match = re.search(rf'^#?[ \t]*{key}=', content, re.MULTILINE)
+    if not match:
+        return content.rstrip('\n') + f"\n{key}={value}\n"
+    json_value, end = decode_json_value(content, match.end()) if key == 'NETKEEP_ACCOUNTS' else (None, 0)
+    if json_value is None:
+        line_end = content.find('\n', match.end())
+        end = line_end if line_end != -1 else len(content)
+    return content[:match.start()] + f"{key}={value}" + content[end:]
+
+class ConfigLoader:
+    """读取config.json并同步到.env与环境变量
+
+    解析结果按文件的修改时间和大小缓存，内容未变化时不会重新解析；.env只在生成的内容与现有内容不同时写入。
+    """
+
+    def __init__(self, config_path=CONFIG_PATH, env_path=ENV_PATH, env_example_path=ENV_EXAMPLE_PATH):
+        self.config_path = config_path
+        self.env_path = env_path
+        self.env_example_path = env_example_path
+        self._stat_key = None
+        self._digest = None
+        self._config = None
+
+    def read(self):
+        """返回解析后的config.json（不存在时返回None），文件未变化时直接使用缓存"""
+        try:
+            stat = os.stat(self.config_path)
+        except FileNotFoundError:
+            self._stat_key = self._digest = self._config = None
+            return None
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        if stat_key == self._stat_key:
+            return self._config
+
+        with open(self.config_path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        self._stat_key = stat_key
+        if digest != self._digest:
+            self._config = parse_config_text(raw.decode('utf-8'))
+            self._digest = digest
+        return self._config
+
+    def sync_env(self, config):
+        """把config.json的内容写入.env，内容没有变化时不写文件，返回是否写入"""
+        if os.path.exists(self.env_path):
+            with open(self.env_path, 'r', encoding='utf-8') as f:
+                env_content = f.read()
+        elif os.path.exists(self.env_example_path):
+            with open(self.env_example_path, 'r', encoding='utf-8') as f:
+                env_content = f.read()
+        else:
+            env_content = BASIC_ENV_CONTENT
+
+        new_content = replace_env_value(env_content, 'NETKEEP_ACCOUNTS', compact_accounts_json(config['accounts']))
+        if config['telegram_bot_token']:
+            new_content = replace_env_value(new_content, 'TELEGRAM_BOT_TOKEN', config['telegram_bot_token'])
+        if config['telegram_chat_id']:
+            new_content = replace_env_value(new_content, 'TELEGRAM_CHAT_ID', config['telegram_chat_id'])
+
+        if os.path.exists(self.env_path) and new_content == env_content:
+            return False
+        tmp_path = f"{self.env_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(new_content)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.env_path)
+        return True
+
+    def load(self):
+        """加载配置：config.json有变化时同步到.env，然后把.env载入环境变量，返回config.json是否有变化"""
+        previous_digest = self._digest
+        config = self.read()
+        changed = config is not None and self._digest != previous_digest
+        if config is not None:
+            try:
+                if self.sync_env(config):
+                    logger.info("已从config.json生成配置")
+            except OSError as e:
+                logger.warning("写入%s失败: %s", self.env_path, e)
+            os.environ['NETKEEP_ACCOUNTS'] = compact_accounts_json(config['accounts'])
+            if config['telegram_bot_token']:
+                os.environ['TELEGRAM_BOT_TOKEN'] = config['telegram_bot_token']
+            if config['telegram_chat_id']:
+                os.environ['TELEGRAM_CHAT_ID'] = config['telegram_chat_id']
+        # 使用override=True强制重新加载.env文件
+        load_dotenv(self.env_path, override=True)
+        return changed
+
+def compact_accounts_json(accounts):
+    """账号列表的单行JSON（写入.env和环境变量）"""
+    return json.dumps(accounts, ensure_ascii=False, separators=(',', ':'))
+
+# 整个进程共用的配置加载器，守护模式下重复调用load_config只在文件变化时重新解析
+_config_loader = None
+
+def load_config():
+    """加载config.json与.env，返回config.json是否有变化"""
+    global _config_loader
+    if _config_loader is None:
+        _config_loader = ConfigLoader()
+    return _config_loader.load()
+
+
+
+# HTTP请求的连接超时与读取超时（秒）
+HTTP_TIMEOUT = (5, 20)
+
+# 每个主机保持的空闲连接数
+HTTP_POOL_SIZE = 16
+
+# 所有HTTP会话共享的连接池，同一主机的请求复用keep-alive连接
+_http_adapter = None
+_http_adapter_lock = threading.Lock()
+
+def get_http_adapter():
+    """返回共享的HTTPAdapter
+
+    连接失败时所有请求都会重试（请求尚未发出）；读取超时和502/504/429只对幂等请求重试，
+    避免重复提交续期之类的POST请求。
+    """
+    global _http_adapter
+    with _http_adapter_lock:
+        if _http_adapter is None:
+            retry = Retry(
+                total=3, connect=3, read=2, status=2,
+                backoff_factor=0.5,
+                status_forcelist=(429, 502, 504),
+                allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+            _http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                        max_retries=retry)
+        return _http_adapter
+
+def new_http_session(headers=None):
+    """创建使用共享连接池的requests.Session，每个账号一个，Cookie保存在会话自己的Cookie Jar中
+
+    不要调用session.close()，否则会关闭所有会话共享的连接池。
+    """
+    session = requests.Session()
+    adapter = get_http_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'User-Agent': USER_AGENT})
+    if headers:
+        session.headers.update(headers)
+    return session
+
+def load_cookie_header(session, cookie, url):
+    """把"name=value; name2=value2"形式的Cookie字符串写入会话的Cookie Jar"""
+    domain = urlparse(url).hostname
+    for part in (cookie or '').split(';'):
+        name, sep, value = part.strip().partition('=')
+        if sep and name:
+            session.cookies.set(name, value, domain=domain, path='/')
+
+# Telegram单条消息的最大长度
+TELEGRAM_MAX_LENGTH = 4096
+
+def telegram_deadline():
+    """发送通知的最长时间（秒），超过后放弃，不拖慢运行"""
+    return float(os.environ.get('NETKEEP_NOTIFY_TIMEOUT', '20'))
+
+def split_telegram_message(message, limit=TELEGRAM_MAX_LENGTH):
+    """按行把消息切分为不超过limit的若干段，避免把一行的Markdown标记拆到两段中"""
+    chunks = []
+    current = ''
+    for line in message.split('\n'):
+        # 单行过长时只能硬切
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+def post_telegram_chunk(session, url, payload, deadline):
+    """发送一段消息：遇到429时按retry_after等待，Markdown解析失败时改为纯文本，直到deadline为止"""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return {"ok": False, "error": "发送超时"}
+        result = session.post(url, json=payload, timeout=(min(HTTP_TIMEOUT[0], remaining), remaining)).json()
+        if result.get('ok'):
+            return result
+
+        error_code = result.get('error_code')
+        description = result.get('description', '')
+        if error_code == 429:
+            retry_after = result.get('parameters', {}).get('retry_after', 1)
+            if time.monotonic() + retry_after >= deadline:
+                return result
+            logger.info("Telegram限流，%s秒后重试", retry_after)
+            time.sleep(retry_after)
+        elif error_code == 400 and 'parse' in description and 'parse_mode' in payload:
+            # 用户名等内容中的_或*会导致Markdown解析失败，改为纯文本发送
+            payload = {k: v for k, v in payload.items() if k != 'parse_mode'}
+        else:
+            return result
 
+def send_telegram_message(message, timeout=None):
+    """发送Telegram通知，如果配置缺失则只打印消息
 
-def send_telegram_message(message):
-    """发送Telegram通知，如果配置缺失则只打印消息"""
+    超过4096字符的消息按行拆分为多条发送，整体耗时不超过timeout秒。
+    """
     # 检查Telegram配置是否存在
     bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
     chat_id = os.environ.get('TELEGRAM_CHAT_ID')
 
     # 如果Telegram配置缺失，只打印消息
     if not (bot_token and chat_id):
-        print("Telegram配置缺失: 跳过Telegram通知")
+        logger.warning("Telegram配置缺失: 跳过Telegram通知")
         # 打印消息内容
-        print(f"消息内容:\n{message}")
+        logger.info("消息内容:\n%s", message)
         return {"ok": True, "result": {"message_id": 0}}
 
     # 正常模式且Telegram配置存在，发送通知
+    deadline = time.monotonic() + (timeout if timeout is not None else telegram_deadline())
     try:
         url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        payload = {"chat_id": chat_id, "text": message, "parse_mode": "Markdown"}
-        response = requests.post(url, json=payload)
-        return response.json()
+        session = new_http_session()
+        result = {"ok": True, "result": {"message_id": 0}}
+        for chunk in split_telegram_message(message):
+            result = post_telegram_chunk(session, url, {"chat_id": chat_id, "text": chunk, "parse_mode": "Markdown"},
+                                         deadline)
+            if not result.get('ok'):
+                logger.warning("发送Telegram通知失败: %s", result.get('description') or result.get('error'))
+                logger.info("消息内容:\n%s", message)
+                return result
+        return result
     except Exception as e:
-        print(f"发送Telegram通知失败: {str(e)}")
-        print(f"消息内容:\n{message}")
+        logger.warning("发送Telegram通知失败: %s", e)
+        logger.info("消息内容:\n%s", message)
         return {"ok": False, "error": str(e)}
 
-def login_and_get_cookie(account, browser, max_retries=2):  # 减少重试次数
-    # 检查是否需要获取Cookie
-    # 如果没有renewApi字段，默认不需要获取Cookie
-    need_cookie = account.get('needCookie', 'renewApi' in account)
+class TelegramNotifier:
+    """在后台线程中发送Telegram通知，主流程只需放入消息，不等待网络请求"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout if timeout is not None else telegram_deadline()
+        self.threads = []
+
+    def _send(self, message):
+        started = time.monotonic()
+        result = send_telegram_message(message, self.timeout)
+        run_metrics.observe('notify', 'telegram', time.monotonic() - started, bool(result.get('ok')))
+
+    def send(self, message):
+        """在后台线程中发送消息，立即返回"""
+        # 常驻模式下会多次发送，只保留仍在发送的线程
+        self.threads = [(thread, deadline) for thread, deadline in self.threads if thread.is_alive()]
+        thread = threading.Thread(target=self._send, args=(message,), daemon=True)
+        thread.start()
+        self.threads.append((thread, time.monotonic() + self.timeout))
+
+    def close(self):
+        """等待后台发送结束，最多等到各条消息的截止时间；超时的线程是守护线程，不会阻止进程退出"""
+        for thread, deadline in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                logger.warning("Telegram通知超时，不再等待")
+        self.threads = []
+
+# 重试前的等待时间（秒）
+RETRY_DELAY = 3
+
+class WaitRecorder:
+    """记录一个账号在各类等待上实际花费的时间"""
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, name, elapsed, satisfied):
+        self.records.append({'name': name, 'elapsed': elapsed, 'satisfied': satisfied})
+
+    def total(self):
+        return sum(r['elapsed'] for r in self.records)
+
+    def summary(self):
+        """按等待名称汇总，例如 "challenge 1次/2.31秒, dom_quiet 3次/0.92秒" """
+        totals = {}
+        for r in self.records:
+            count, elapsed = totals.get(r['name'], (0, 0.0))
+            totals[r['name']] = (count + 1, elapsed + r['elapsed'])
+        return ", ".join(f"{name} {count}次/{elapsed:.2f}秒" for name, (count, elapsed) in totals.items())
+
+# 当前账号的等待记录，每个账号的任务各自设置
+_current_waits = contextvars.ContextVar('netkeep_waits', default=None)
+
+def _record_wait(name, started, satisfied):
+    recorder = _current_waits.get()
+    if recorder is not None:
+        recorder.add(name, time.monotonic() - started, satisfied)
+
+# 账号处理流程中计时的阶段（阶段之间可能嵌套，例如cf_wait包含在login_nav或lxc_nav之内）
+PHASES = (
+    'browser_launch', 'context_create', 'login_nav', 'cf_wait', 'form_fill', 'submit_detect',
+    'cookie_extract', 'lxc_nav', 'api_renew', 'browser_renew', 'notify', 'session_check'
+)
 
-    # 使用更真实的浏览器配置
-    context = browser.new_context(
-        user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        viewport={'width': 1280, 'height': 800},
-        extra_http_headers={
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-            'Upgrade-Insecure-Requests': '1',
-            'sec-ch-ua': '"Not_A Brand";v="8", "Chromium";v="120"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"'
-        }
-    )
+# 阶段耗时直方图的桶上限（秒）
+SPAN_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# 每个阶段和站点保留的最近耗时样本数（用于JSON摘要的百分位，常驻模式下内存不会无限增长）
+SPAN_SAMPLES = 1000
+
+def prometheus_escape(value):
+    """转义Prometheus标签值中的反斜杠、引号和换行"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RunMetrics:
+    """汇总一次运行中所有账号的阶段耗时，导出为JSON摘要或Prometheus文本格式"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}
+        self.failures = {}
+        # 每个账号只保留最后一次尝试，重试次数按站点单独计数
+        self.accounts = {}
+        self.retries = {}
+
+    def _histogram(self, phase, site):
+        return self.histograms.setdefault((phase, site), [[0] * len(SPAN_BUCKETS), 0.0, 0,
+                                                          deque(maxlen=SPAN_SAMPLES)])
+
+    def observe(self, phase, site, elapsed, ok=True):
+        if phase not in PHASES:
+            raise ValueError(f"未知的阶段: {phase}")
+        with self.lock:
+            buckets = self._histogram(phase, site)
+            for i, bound in enumerate(SPAN_BUCKETS):
+                if elapsed <= bound:
+                    buckets[0][i] += 1
+            buckets[1] += elapsed
+            buckets[2] += 1
+            buckets[3].append(elapsed)
+            if not ok:
+                self.failures[(phase, site)] = self.failures.get((phase, site), 0) + 1
+
+    def add_account(self, recorder, elapsed, logged_in, renew_status, attempt=0):
+        """记录账号的处理结果，同一账号重复记录时覆盖之前的结果；attempt大于0表示这是一次重试"""
+        with self.lock:
+            if attempt:
+                self.retries[recorder.site] = self.retries.get(recorder.site, 0) + 1
+            self.accounts[(recorder.site, recorder.username)] = {
+                'username': recorder.username,
+                'site': recorder.site,
+                'elapsed': round(elapsed, 3),
+                'logged_in': logged_in,
+                'renew_status': renew_status,
+                'attempts': attempt + 1,
+                'phases': {name: round(value, 3) for name, value in recorder.totals().items()}
+            }
+
+    def dump(self):
+        """导出原始数据，工作进程用它把指标交给父进程合并"""
+        with self.lock:
+            return {
+                'histograms': [[phase, site, counts, total, count, list(values)]
+                               for (phase, site), (counts, total, count, values) in self.histograms.items()],
+                'failures': [[phase, site, count] for (phase, site), count in self.failures.items()],
+                'retries': [[site, count] for site, count in self.retries.items()],
+                'accounts': list(self.accounts.values())
+            }
+
+    def merge(self, data):
+        """合并dump()导出的数据"""
+        with self.lock:
+            for phase, site, counts, total, count, values in data.get('histograms', []):
+                buckets = self._histogram(phase, site)
+                buckets[0] = [a + b for a, b in zip(buckets[0], counts)]
+                buckets[1] += total
+                buckets[2] += count
+                buckets[3].extend(values)
+            for phase, site, count in data.get('failures', []):
+                self.failures[(phase, site)] = self.failures.get((phase, site), 0) + count
+            for site, count in data.get('retries', []):
+                self.retries[site] = self.retries.get(site, 0) + count
+            for account in data.get('accounts', []):
+                self.accounts[(account['site'], account['username'])] = account
+
+    def to_json(self):
+        """JSON摘要：每个阶段的次数、总耗时、p50/p95/最大值（按最近SPAN_SAMPLES个样本计算），以及每个账号的阶段耗时"""
+        with self.lock:
+            phases = {}
+            for (phase, site), (_, total, count, values) in sorted(self.histograms.items()):
+                values = sorted(values)
+                phases.setdefault(phase, {})[site] = {
+                    'count': count,
+                    'sum': round(total, 3),
+                    'p50': round(values[max(0, math.ceil(0.5 * len(values)) - 1)], 3),
+                    'p95': round(values[max(0, math.ceil(0.95 * len(values)) - 1)], 3),
+                    'max': round(values[-1], 3),
+                    'failures': self.failures.get((phase, site), 0)
+                }
+            return {
+                'started_at': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'wall_time': round(time.time() - self.started, 3),
+                'phases': phases,
+                'retries': dict(self.retries),
+                'accounts': list(self.accounts.values())
+            }
+
+    def to_prometheus(self):
+        """Prometheus文本格式，每个阶段和站点一个直方图"""
+        def labels(**kv):
+            return '{' + ','.join(f'{k}="{prometheus_escape(v)}"' for k, v in kv.items()) + '}'
+
+        lines = [
+            '# HELP netkeep_phase_duration_seconds Duration of each NetKeep phase per site.',
+            '# TYPE netkeep_phase_duration_seconds histogram'
+        ]
+        with self.lock:
+            for (phase, site), (bucket_counts, total, count, _) in sorted(self.histograms.items()):
+                for bound, bucket_count in zip(SPAN_BUCKETS, bucket_counts):
+                    lines.append(f"netkeep_phase_duration_seconds_bucket{labels(phase=phase, site=site, le=bound)} "
+                                 f"{bucket_count}")
+                lines.append(f"netkeep_phase_duration_seconds_bucket{labels(phase=phase, site=site, le='+Inf')} {count}")
+                lines.append(f"netkeep_phase_duration_seconds_sum{labels(phase=phase, site=site)} {total:.6f}")
+                lines.append(f"netkeep_phase_duration_seconds_count{labels(phase=phase, site=site)} {count}")
+
+            lines += [
+                '# HELP netkeep_phase_failures_total Phases that ended with an error.',
+                '# TYPE netkeep_phase_failures_total counter'
+            ]
+            for (phase, site), failures in sorted(self.failures.items()):
+                lines.append(f"netkeep_phase_failures_total{labels(phase=phase, site=site)} {failures}")
 
-    # 启用JavaScript
-    context.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => false})")
+            lines += [
+                '# HELP netkeep_account_logged_in Whether the account logged in during the last run.',
+                '# TYPE netkeep_account_logged_in gauge'
+            ]
+            for (site, username), account in sorted(self.accounts.items()):
+                lines.append(f"netkeep_account_logged_in{labels(site=site, username=username)} "
+                             f"{int(account['logged_in'])}")
 
-    page = context.new_page()
+            lines += [
+                '# HELP netkeep_account_retries_total Account attempts that were retries after a failure.',
+                '# TYPE netkeep_account_retries_total counter'
+            ]
+            for site, retries in sorted(self.retries.items()):
+                lines.append(f"netkeep_account_retries_total{labels(site=site)} {retries}")
 
-    # 随机移动鼠标，模拟人类行为
-    def simulate_human_behavior(page):
-        # 随机移动鼠标
-        import random
-        for _ in range(3):
-            page.mouse.move(
-                random.randint(100, 1000),
-                random.randint(100, 600)
-            )
-            time.sleep(random.uniform(0.5, 1.5))
+            lines += [
+                '# HELP netkeep_last_run_timestamp_seconds Start time of the last run.',
+                '# TYPE netkeep_last_run_timestamp_seconds gauge',
+                f"netkeep_last_run_timestamp_seconds {self.started:.0f}"
+            ]
+        return '\n'.join(lines) + '\n'
+
+# 当前运行的阶段耗时汇总
+run_metrics = RunMetrics()
+
+class SpanRecorder:
+    """记录一个账号各阶段的耗时，同时汇总到run_metrics"""
+
+    def __init__(self, site='', username=''):
+        self.site = site
+        self.username = username
+        self.spans = []
+
+    def add(self, name, elapsed, ok):
+        self.spans.append({'name': name, 'elapsed': elapsed, 'ok': ok})
+        run_metrics.observe(name, self.site, elapsed, ok)
+
+    def totals(self):
+        totals = {}
+        for s in self.spans:
+            totals[s['name']] = totals.get(s['name'], 0.0) + s['elapsed']
+        return totals
+
+    def summary(self):
+        """按阶段汇总，例如 "login_nav 1.20秒, submit_detect 0.85秒" """
+        return ", ".join(f"{name} {elapsed:.2f}秒" for name, elapsed in self.totals().items())
+
+# 当前账号的阶段记录，每个账号的任务各自设置（asyncio.to_thread会把它带入工作线程）
+_current_spans = contextvars.ContextVar('netkeep_spans', default=None)
+
+@contextlib.contextmanager
+def span(name):
+    """记录一个阶段的耗时，阶段内抛出异常时记为失败：with span('login_nav'): ...
+
+    name必须是PHASES中的阶段，这样导出的指标只包含固定的一组阶段名称。
+    """
+    if name not in PHASES:
+        raise ValueError(f"未知的阶段: {name}")
+    started = time.monotonic()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        recorder = _current_spans.get()
+        if recorder is not None:
+            recorder.add(name, time.monotonic() - started, ok)
+
+def write_metrics_textfile(path):
+    """原子写入Prometheus文本文件（供node_exporter的textfile collector读取）"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(run_metrics.to_prometheus())
+    os.replace(tmp_path, path)
+
+def write_metrics_json(path):
+    """原子写入JSON格式的阶段耗时摘要"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(run_metrics.to_json(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def start_metrics_server(port):
+    """在后台线程中提供 /metrics（Prometheus格式）和 /metrics.json"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
 
-    for attempt in range(max_retries):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = run_metrics.to_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(run_metrics.to_json(), ensure_ascii=False), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            data = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("指标服务已启动: http://0.0.0.0:%s/metrics", port)
+    return server
+
+async def wait_pause(name, seconds):
+    """无条件等待（仅用于重试退避等确实需要间隔的场景）"""
+    started = time.monotonic()
+    await asyncio.sleep(seconds)
+    _record_wait(name, started, True)
+
+async def wait_load(page, name, state='domcontentloaded', timeout=10):
+    """等待页面达到指定加载状态，最长timeout秒，返回是否达到"""
+    started = time.monotonic()
+    try:
+        await page.wait_for_load_state(state, timeout=timeout * 1000)
+        satisfied = True
+    except Exception:
+        satisfied = False
+    _record_wait(name, started, satisfied)
+    return satisfied
+
+async def wait_selector(page, selector, name, timeout=10, state='visible'):
+    """等待选择器对应的元素出现，最长timeout秒，返回是否出现"""
+    started = time.monotonic()
+    try:
+        await page.wait_for_selector(selector, state=state, timeout=timeout * 1000)
+        satisfied = True
+    except Exception:
+        satisfied = False
+    _record_wait(name, started, satisfied)
+    return satisfied
+
+async def wait_response(page, predicate, name, timeout=10):
+    """等待满足条件的网络响应，最长timeout秒，返回响应或None"""
+    started = time.monotonic()
+    try:
+        response = await page.wait_for_event('response', predicate, timeout=timeout * 1000)
+    except Exception:
+        response = None
+    _record_wait(name, started, response is not None)
+    return response
+
+# 在页面内等待DOM稳定：可选地要求先发生变化，之后quietMs毫秒内没有新的变化即返回
+DOM_QUIET_JS = """([quietMs, timeoutMs, requireChange]) => new Promise(resolve => {
+    let changed = false;
+    let quietTimer = null;
+    const finish = (result) => {
+        observer.disconnect();
+        clearTimeout(quietTimer);
+        clearTimeout(capTimer);
+        resolve(result);
+    };
+    const arm = () => {
+        clearTimeout(quietTimer);
+        quietTimer = setTimeout(() => finish(true), quietMs);
+    };
+    const observer = new MutationObserver(() => { changed = true; arm(); });
+    observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+    const capTimer = setTimeout(() => finish(changed), timeoutMs);
+    if (!requireChange) arm();
+})"""
+
+async def wait_dom_quiet(page, name, quiet_ms=300, timeout=3, require_change=True):
+    """点击等操作后等待页面响应：DOM发生变化并稳定quiet_ms毫秒，或发生导航，最长timeout秒"""
+    started = time.monotonic()
+    try:
+        satisfied = bool(await page.evaluate(DOM_QUIET_JS, [quiet_ms, timeout * 1000, require_change]))
+    except Exception:
+        # 执行上下文被导航销毁，说明页面已经响应，等待新页面DOM就绪
         try:
-            login_url = f"{account['site']}{account['loginApi']}"
-            print(f"尝试 {attempt + 1}/{max_retries}: 导航到 {login_url} 登录 {account['username']}")
+            await page.wait_for_load_state('domcontentloaded', timeout=timeout * 1000)
+        except Exception:
+            pass
+        satisfied = True
+    _record_wait(name, started, satisfied)
+    return satisfied
 
-            # 使用load而不是networkidle，更快地返回控制权
-            try:
-                page.goto(login_url, wait_until='load', timeout=30000)
-            except Exception as e:
-                print(f"页面导航时出错: {str(e)}，尝试继续执行...")
+def state_dir():
+    """持久化状态目录（会话缓存等），可通过NETKEEP_STATE_DIR修改"""
+    return os.environ.get('NETKEEP_STATE_DIR', '.netkeep')
 
-            # 检查是否遇到CloudFlare挑战页面
-            try:
-                page_content = page.content().lower()
-                if "just a moment" in page_content or "checking your browser" in page_content:
-                    print("检测到CloudFlare挑战页面，等待挑战完成...")
-                    # 等待更长时间让CloudFlare挑战完成
-                    for _ in range(6):  # 最多等待30秒
-                        time.sleep(5)
-                        page_content = page.content().lower()
-                        if "just a moment" not in page_content and "checking your browser" not in page_content:
-                            print("CloudFlare挑战已完成，继续执行...")
-                            break
+def load_state_file(name, default):
+    """读取状态目录中的JSON文件，不存在或损坏时返回默认值"""
+    path = os.path.join(state_dir(), name)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        logger.warning("读取状态文件 %s 失败: %s，忽略该文件", path, e)
+        return default
+
+def save_state_file(name, data):
+    """原子地写入状态目录中的JSON文件，文件中可能包含Cookie，因此仅对当前用户可读"""
+    os.makedirs(state_dir(), exist_ok=True)
+    path = os.path.join(state_dir(), name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+
+@contextlib.contextmanager
+def state_file_lock(name):
+    """跨进程锁定状态文件，使多个进程（--workers/--shard）的读-改-写依次进行"""
+    os.makedirs(state_dir(), exist_ok=True)
+    with open(os.path.join(state_dir(), f"{name}.lock"), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def merge_state_file(name, entries, changed=(), removed=()):
+    """在文件锁内重新读取状态文件，只写入本进程修改（changed）或删除（removed）的键，返回合并后的内容
+
+    多个进程同时运行时各自只覆盖自己改动的条目，不会因为后写入的进程而丢失其他进程的更新。
+    """
+    with state_file_lock(name):
+        data = load_state_file(name, {})
+        for key in changed:
+            if key in entries:
+                data[key] = entries[key]
+        for key in removed:
+            data.pop(key, None)
+        save_state_file(name, data)
+    return data
+
+class SessionStore:
+    """按 (site, username) 保存Playwright storage_state 的磁盘会话缓存，支持TTL过期与LRU淘汰"""
+
+    def __init__(self, filename='sessions.json', ttl=None, max_entries=None):
+        self.filename = filename
+        # 默认保存7天，最多保存200个账号的会话
+        self.ttl = ttl if ttl is not None else float(os.environ.get('NETKEEP_SESSION_TTL', 7 * 24 * 3600))
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get('NETKEEP_SESSION_MAX', 200))
+        self._entries = load_state_file(filename, {})
+        # get()刷新了最近使用时间但尚未写入磁盘的键，下次保存时一并写入
+        self._touched = set()
+
+    @staticmethod
+    def _key(site, username):
+        return f"{site.rstrip('/')}|{username}"
+
+    def get(self, site, username):
+        """返回未过期的storage_state，并刷新其最近使用时间（随下次保存写入磁盘）"""
+        key = self._key(site, username)
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        now = time.time()
+        if now - entry.get('saved_at', 0) > self.ttl:
+            logger.info("账号 %s 的缓存会话已过期", username)
+            self.delete(site, username)
+            return None
+        entry['last_used'] = now
+        self._touched.add(key)
+        return entry.get('storage_state')
+
+    def put(self, site, username, storage_state):
+        """保存账号的storage_state，超出容量时淘汰最久未使用的条目"""
+        now = time.time()
+        key = self._key(site, username)
+        self._entries[key] = {
+            'storage_state': storage_state,
+            'saved_at': now,
+            'last_used': now
+        }
+        evicted = []
+        if len(self._entries) > self.max_entries:
+            lru_keys = sorted(self._entries, key=lambda k: self._entries[k].get('last_used', 0))
+            evicted = lru_keys[:len(self._entries) - self.max_entries]
+            for lru_key in evicted:
+                del self._entries[lru_key]
+        self.save([key], evicted)
+
+    def delete(self, site, username):
+        """删除账号的缓存会话"""
+        key = self._key(site, username)
+        if self._entries.pop(key, None) is not None:
+            self.save(removed=[key])
+
+    def save(self, changed=(), removed=()):
+        touched, self._touched = self._touched, set()
+        try:
+            self._entries = merge_state_file(self.filename, self._entries, set(changed) | touched, removed)
+        except Exception as e:
+            self._touched |= touched
+            logger.warning("保存会话缓存失败: %s", e)
+
+# 提前续期时面板返回的提示，如"请在到期前3天后再续费"
+EARLY_RENEW_PATTERN = re.compile(r'请在到期前\s*(\d+)\s*天')
+# 续期一个月按30天估算到期时间；没有见过提前续期提示时假定到期前3天可续期
+DAYS_PER_MONTH = 30
+DEFAULT_RENEW_WINDOW_DAYS = 3
+
+def format_timestamp(ts):
+    """把时间戳格式化为本地时间字符串"""
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')
+
+def account_key(account):
+    """账号的唯一标识（站点 + 用户名）"""
+    return f"{account['site'].rstrip('/')}|{account['username']}"
+
+# 距上次登录超过login_max_age的这一比例时就视为需要登录，定时任务与login_max_age间隔相同时提前启动也不会跳过
+LOGIN_DUE_RATIO = 0.8
+
+class RenewLedger:
+    """按 (site, username) 记录每个账号的上次登录、上次续期、可续期时间和上次结果，用于跳过尚未到期的账号
+
+    续期成功后按续期月数估算到期时间，到期前N天（面板提示的天数）才再次续期；收到"请在到期前N天后再续费"
+    时记住N，并在已知的到期时间前N天或recheck秒后再检查。距上次登录超过login_max_age的账号总会执行一次登录；
+    为了容忍定时任务提前几分钟启动，距上次登录超过login_max_age * LOGIN_DUE_RATIO时就视为需要登录。
+    """
+
+    def __init__(self, filename='ledger.json', recheck=None, login_max_age=None):
+        self.filename = filename
+        # 未能估算到期时间时，默认1天后再检查；默认至少每3天登录一次
+        self.recheck = recheck if recheck is not None else float(os.environ.get('NETKEEP_RENEW_RECHECK', 24 * 3600))
+        self.login_max_age = login_max_age if login_max_age is not None else \
+            float(os.environ.get('NETKEEP_LOGIN_MAX_AGE', 3 * 24 * 3600))
+        self._entries = load_state_file(filename, {})
+
+    @staticmethod
+    def _key(account):
+        return account_key(account)
+
+    def get(self, account):
+        """返回账号的记录（没有时为空dict）"""
+        return self._entries.get(self._key(account), {})
+
+    def is_due(self, account, now=None):
+        """判断账号本次是否需要处理，返回 (是否需要, 原因)"""
+        now = now if now is not None else time.time()
+        entry = self.get(account)
+        if not entry:
+            return True, "没有处理记录"
+        if entry.get('failures'):
+            return True, f"上次处理失败（连续 {entry['failures']} 次）"
+        last_login = entry.get('last_login')
+        if not last_login or now - last_login > self.login_max_age * LOGIN_DUE_RATIO:
+            return True, "距上次登录时间过长"
+        if not account.get('renewApi'):
+            return False, f"上次登录于 {format_timestamp(last_login)}"
+        not_before = entry.get('not_before')
+        if not not_before or now >= not_before:
+            return True, "已到续期时间"
+        return False, f"未到续期时间，{format_timestamp(not_before)} 后再续期"
+
+    def urgency(self, account, now=None):
+        """返回账号的紧迫程度（秒，越小越紧迫），用于决定处理顺序
+
+        取已知到期时间（或续期窗口结束时间）与"上次登录 + login_max_age"中较早者距现在的时间，
+        每次连续失败再提前1天；没有记录的账号视为已经到期。
+        """
+        now = now if now is not None else time.time()
+        entry = self.get(account)
+        deadlines = []
+        if entry.get('expires_at'):
+            deadlines.append(entry['expires_at'])
+        elif entry.get('not_before'):
+            deadlines.append(entry['not_before'] + entry.get('window_days', DEFAULT_RENEW_WINDOW_DAYS) * 86400)
+        if entry.get('last_login'):
+            deadlines.append(entry['last_login'] + self.login_max_age)
+        slack = min(deadlines) - now if deadlines else 0
+        return slack - entry.get('failures', 0) * 86400
+
+    def next_due(self, account, now=None):
+        """返回账号下次需要处理的时间（时间戳），已经需要处理时返回now"""
+        now = now if now is not None else time.time()
+        if self.is_due(account, now)[0]:
+            return now
+        entry = self.get(account)
+        due_times = [entry['last_login'] + self.login_max_age * LOGIN_DUE_RATIO]
+        if account.get('renewApi') and entry.get('not_before'):
+            due_times.append(entry['not_before'])
+        return min(due_times)
+
+    def record(self, account, logged_in, result=None, error=None, now=None):
+        """记录账号本次的处理结果；result为续期结果，error为出错信息"""
+        now = now if now is not None else time.time()
+        key = self._key(account)
+        entry = self._entries.setdefault(key, {})
+        if logged_in:
+            entry['last_login'] = now
+
+        failed = error is not None or not logged_in or (isinstance(result, dict) and result.get('success') is False)
+        if failed:
+            entry['failures'] = entry.get('failures', 0) + 1
+            entry['last_result'] = str(error or result)[:200]
+        elif account.get('renewApi'):
+            entry['failures'] = 0
+            message = str(result.get('msg') or result.get('text') or '') if isinstance(result, dict) else str(result)
+            entry['last_result'] = message[:200]
+            early = EARLY_RENEW_PATTERN.search(message)
+            if early:
+                # 尚未进入续期窗口：记住窗口天数，已知到期时间时在窗口开始时再续期，否则稍后再检查
+                entry['window_days'] = int(early.group(1))
+                expires_at = entry.get('expires_at')
+                window_start = expires_at - entry['window_days'] * 86400 if expires_at else None
+                entry['not_before'] = window_start if window_start and window_start > now else now + self.recheck
+            else:
+                profile = get_site_profile(account)
+                months = parse_renew_body(account.get('renewBody') or profile['renewBody']).get('month', 1)
+                months = months if isinstance(months, int) and months > 0 else 1
+                entry['last_renew'] = now
+                # 保守估计：按本次续期时刚好到期计算，宁可提前检查也不错过续期窗口
+                entry['expires_at'] = now + months * DAYS_PER_MONTH * 86400
+                window_days = entry.get('window_days', DEFAULT_RENEW_WINDOW_DAYS)
+                entry['not_before'] = entry['expires_at'] - window_days * 86400
+        else:
+            entry['failures'] = 0
+            entry['last_result'] = "登录成功"
+        entry['updated_at'] = now
+        self.save(key)
 
-                    # 如果仍然在CloudFlare页面，尝试刷新
-                    if "just a moment" in page_content or "checking your browser" in page_content:
-                        print("CloudFlare挑战仍未完成，尝试刷新页面...")
-                        try:
-                            page.reload(wait_until='load', timeout=30000)
-                        except Exception as e:
-                            print(f"页面刷新时出错: {str(e)}，尝试继续执行...")
-                        time.sleep(5)
-            except Exception as e:
-                print(f"检查CloudFlare挑战时出错: {str(e)}，尝试继续执行...")
+    def save(self, key):
+        try:
+            self._entries = merge_state_file(self.filename, self._entries, [key])
+        except Exception as e:
+            logger.warning("保存续期记录失败: %s", e)
+
+def select_due_accounts(accounts, ledger, force=False):
+    """按续期记录筛选本次需要处理的账号，返回 (需要处理的账号, 跳过的账号状态行)"""
+    due, skipped = [], []
+    for account in accounts:
+        is_due, reason = (True, "强制执行") if force else ledger.is_due(account)
+        if is_due:
+            due.append(account)
+        else:
+            logger.info("跳过账号 %s: %s", account['username'], reason)
+            skipped.append(f"账号 {account['username']} ({get_site_name(account)}) 已跳过: {reason}")
+    return due, skipped
+
+def is_challenge_response(status, headers, url=''):
+    """根据状态码、响应头和URL判断是否为CloudFlare挑战，无需扫描页面HTML"""
+    if headers.get('cf-mitigated', '').lower() == 'challenge':
+        return True
+    if '/cdn-cgi/challenge-platform' in url:
+        return True
+    return status in (403, 503) and 'cloudflare' in headers.get('server', '').lower()
+
+def is_challenge_page_response(response):
+    """判断Playwright的响应是否为CloudFlare挑战"""
+    return response is not None and is_challenge_response(response.status, response.headers, response.url)
+
+class ClearanceCache:
+    """按域名缓存CloudFlare的cf_clearance Cookie，与User-Agent绑定，同一站点的所有账号在其有效期内共享
+
+    同一域名同时只允许一个账号处理挑战，其他账号等待其完成后直接复用Cookie。
+    """
+
+    # 会话级Cookie（没有过期时间）最多复用30分钟
+    SESSION_COOKIE_TTL = 30 * 60
+
+    def __init__(self, filename='clearance.json'):
+        self.filename = filename
+        self._entries = load_state_file(filename, {})
+        self._locks = {}
+
+    def lock(self, domain):
+        """返回域名对应的挑战处理锁"""
+        if domain not in self._locks:
+            self._locks[domain] = asyncio.Lock()
+        return self._locks[domain]
+
+    def get(self, domain):
+        """返回域名下仍然有效且与当前User-Agent匹配的cf_clearance Cookie"""
+        entry = self._entries.get(domain)
+        if not entry or entry.get('user_agent') != USER_AGENT:
+            return None
+        cookie = entry['cookie']
+        now = time.time()
+        expires = cookie.get('expires', -1)
+        if (expires and expires > 0 and expires <= now) or \
+                ((not expires or expires <= 0) and now - entry.get('saved_at', 0) > self.SESSION_COOKIE_TTL):
+            self._entries.pop(domain, None)
+            return None
+        return cookie
+
+    def saved_at(self, domain):
+        entry = self._entries.get(domain)
+        return entry.get('saved_at', 0) if entry else 0
+
+    def put(self, domain, cookie):
+        self._entries[domain] = {'cookie': cookie, 'user_agent': USER_AGENT, 'saved_at': time.time()}
+        try:
+            self._entries = merge_state_file(self.filename, self._entries, [domain])
+        except Exception as e:
+            logger.warning("保存cf_clearance缓存失败: %s", e)
 
-            # 填写表单
-            print("填写登录表单...")
+    async def apply(self, context, domain):
+        """将缓存的cf_clearance添加到浏览器上下文，返回是否添加"""
+        cookie = self.get(domain)
+        if cookie is None:
+            return False
+        try:
+            await context.add_cookies([cookie])
+            return True
+        except Exception as e:
+            logger.warning("添加cf_clearance Cookie失败: %s", e)
+            return False
 
-            # 使用netkeep1.py的简单直接的表单填写方式
-            try:
-                # 直接填写用户名和密码
-                page.fill('input[name="username"]', account['username'])
-                page.fill('input[name="password"]', account['password'])
+    async def capture(self, context, domain):
+        """从浏览器上下文中保存该域名的cf_clearance"""
+        try:
+            cookies = await context.cookies(f"https://{domain}")
+        except Exception:
+            return
+        cookie = next((c for c in cookies if c['name'] == 'cf_clearance'), None)
+        if cookie is not None:
+            self.put(domain, cookie)
+
+_clearance_cache = None
+
+def get_clearance_cache():
+    """返回本进程共享的cf_clearance缓存（首次使用时从磁盘加载）"""
+    global _clearance_cache
+    if _clearance_cache is None:
+        _clearance_cache = ClearanceCache()
+    return _clearance_cache
+
+class StrategyCache:
+    """按站点记住登录和续期时实际成功的方法与选择器，下次优先尝试，失败时再回到完整的尝试顺序
+
+    每个站点保存两类记录：login（method: http/browser，以及表单选择器和提交方式）与
+    renew（method: api/page，以及续期按钮和弹窗按钮的候选规则）。记录超过有效期后不再使用，以便重新探测。
+    method和其余字段各自记录更新时间（method_at / updated_at），选择器的更新不会延长method的有效期。
+    """
+
+    def __init__(self, filename='strategies.json', ttl=None):
+        self.filename = filename
+        self.ttl = ttl if ttl is not None else float(os.environ.get('NETKEEP_STRATEGY_TTL', 30 * 24 * 3600))
+        self.entries = load_state_file(filename, {})
+        # HTTP登录与API续期在工作线程中执行，写入需要加锁
+        self._lock = threading.Lock()
+
+    def get(self, domain, kind):
+        """返回站点某类记录中未过期的字段（dict），没有时返回空dict"""
+        entry = self.entries.get(domain, {}).get(kind)
+        if not entry:
+            return {}
+        now = time.time()
+        result = {}
+        if now - entry.get('updated_at', 0) <= self.ttl:
+            result.update((key, value) for key, value in entry.items() if key not in ('method', 'method_at'))
+        # 旧记录没有method_at时使用updated_at
+        method_at = entry.get('method_at', entry.get('updated_at', 0))
+        if 'method' in entry and now - method_at <= self.ttl:
+            result['method'] = entry['method']
+            result['method_at'] = method_at
+        return result
+
+    def update(self, domain, kind, refresh=False, **values):
+        """合并并保存站点的记录，值没有变化时只在记录快过期时刷新时间（refresh为True时总是刷新）；
+        method与其余字段分别计时"""
+        with self._lock:
+            entry = self.entries.setdefault(domain, {}).setdefault(kind, {})
+            now = time.time()
+            changed = False
+            for stamp, group in (('method_at', {k: v for k, v in values.items() if k == 'method'}),
+                                 ('updated_at', {k: v for k, v in values.items() if k != 'method'})):
+                if not group:
+                    continue
+                unchanged = all(entry.get(key) == value for key, value in group.items())
+                if unchanged and not refresh and now - entry.get(stamp, 0) < self.ttl / 2:
+                    continue
+                entry.update(group)
+                entry[stamp] = now
+                changed = True
+            if changed:
+                self.save(domain)
+
+    def forget(self, domain, kind, *keys):
+        """删除记住的某些字段（记住的方法失败时调用）"""
+        with self._lock:
+            entry = self.entries.get(domain, {}).get(kind)
+            if not entry or not any(key in entry for key in keys):
+                return
+            for key in keys:
+                entry.pop(key, None)
+            self.save(domain)
+
+    def save(self, domain):
+        try:
+            self.entries = merge_state_file(self.filename, self.entries, [domain])
+        except OSError as e:
+            logger.warning("保存站点策略缓存失败: %s", e)
+
+_strategy_cache = None
+
+def get_strategy_cache():
+    """返回本进程共享的站点策略缓存（首次使用时从磁盘加载）"""
+    global _strategy_cache
+    if _strategy_cache is None:
+        _strategy_cache = StrategyCache()
+    return _strategy_cache
+
+def prefer_first(options, preferred):
+    """把记住的选项放到最前面，其余保持原顺序"""
+    if not preferred:
+        return list(options)
+    return [preferred] + [option for option in options if option != preferred]
+
+# 站点配置文件路径（可通过NETKEEP_PROFILES修改）
+PROFILES_PATH = 'profiles.json'
+
+# 站点配置的字段及类型；未填写的字段使用DEFAULT_SITE_PROFILE或通用的探测逻辑
+PROFILE_FIELDS = {
+    'name': str,
+    'domains': list,
+    'usernameSelector': str,
+    'passwordSelector': str,
+    'submitSelector': str,
+    'successTexts': list,
+    'failureTexts': list,
+    'sessionCookie': str,
+    'warmupPath': str,
+    'renewMethod': str,
+    'renewBody': str,
+    'renewButton': str,
+    'popupButton': str,
+    'confirmButton': str,
+    'response': dict
+}
+RENEW_METHODS = ('api', 'page')
+
+# 内置的默认站点配置（原先写死在登录和续期流程中的面板约定）
+DEFAULT_SITE_PROFILE = {
+    'name': 'default',
+    'sessionCookie': 'sw110xy',
+    'warmupPath': '/server/lxc',
+    'renewBody': 'month=1&coupon_id=0&submit=1',
+    'response': {'codeField': 'code', 'messageField': 'msg', 'successCodes': [0, 1]}
+}
+
+def validate_profile(profile, index=0):
+    """检查单个站点配置，返回错误描述列表（为空表示有效）"""
+    if not isinstance(profile, dict):
+        return [f"站点配置 {index + 1} 不是JSON对象"]
+    name = profile.get('name') or f"#{index + 1}"
+    errors = []
+    if not profile.get('name'):
+        errors.append(f"站点配置 {name} 缺少name")
+    for field, expected in PROFILE_FIELDS.items():
+        value = profile.get(field)
+        if value is not None and not isinstance(value, expected):
+            errors.append(f"站点配置 {name} 的字段 {field} 类型不正确")
+    unknown = set(profile) - set(PROFILE_FIELDS)
+    if unknown:
+        errors.append(f"站点配置 {name} 包含未知字段 {', '.join(sorted(unknown))}")
+    if profile.get('renewMethod') is not None and profile['renewMethod'] not in RENEW_METHODS:
+        errors.append(f"站点配置 {name} 的renewMethod必须是 {'/'.join(RENEW_METHODS)} 之一")
+    return errors
+
+class SiteProfiles:
+    """站点配置：启动时加载一次，按账号的profile字段或域名匹配，未匹配时使用默认配置
+
+    匹配到的站点配置中填写了的选择器、续期方式等会被直接使用，不再进行启发式查找。
+    """
+
+    def __init__(self, profiles=()):
+        self.profiles = {}
+        self.by_domain = []
+        for index, profile in enumerate(profiles):
+            errors = validate_profile(profile, index)
+            if errors:
+                for error in errors:
+                    logger.warning("站点配置错误: %s，已跳过", error)
+                continue
+            self.profiles[profile['name']] = profile
+            for pattern in profile.get('domains', []):
+                self.by_domain.append((pattern.lower(), profile))
+        self._resolved = {}
+
+    @classmethod
+    def load(cls, path=None):
+        """从JSON文件加载站点配置（数组，或 {"profiles": [...]}），文件不存在时只有默认配置"""
+        path = path or os.environ.get('NETKEEP_PROFILES', PROFILES_PATH)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        except (OSError, ValueError) as e:
+            logger.warning("读取站点配置 %s 失败: %s，使用默认配置", path, e)
+            return cls()
+        if isinstance(data, dict):
+            data = data.get('profiles', [])
+        if not isinstance(data, list):
+            logger.warning("站点配置 %s 格式不正确，应为数组", path)
+            return cls()
+        profiles = cls(data)
+        if profiles.profiles:
+            logger.info("已加载 %s 个站点配置: %s", len(profiles.profiles), ', '.join(profiles.profiles))
+        return profiles
+
+    def match(self, account):
+        """返回账号使用的站点配置（已合并默认值）"""
+        host = (urlparse(account['site']).hostname or '').lower()
+        key = (account.get('profile'), host)
+        resolved = self._resolved.get(key)
+        if resolved is None:
+            profile = None
+            if account.get('profile'):
+                profile = self.profiles.get(account['profile'])
+                if profile is None:
+                    logger.warning("未找到站点配置 %s，按域名匹配", account['profile'])
+            if profile is None:
+                profile = next((p for pattern, p in self.by_domain if fnmatch.fnmatch(host, pattern)), {})
+            resolved = {**DEFAULT_SITE_PROFILE, **profile,
+                        'response': {**DEFAULT_SITE_PROFILE['response'], **profile.get('response', {})}}
+            self._resolved[key] = resolved
+        return resolved
+
+_site_profiles = None
+
+def load_site_profiles(path=None):
+    """加载站点配置并作为本进程共享的站点配置"""
+    global _site_profiles
+    _site_profiles = SiteProfiles.load(path)
+    return _site_profiles
+
+def get_site_profiles():
+    """返回本进程共享的站点配置（首次使用时加载）"""
+    if _site_profiles is None:
+        return load_site_profiles()
+    return _site_profiles
+
+def get_site_profile(account):
+    """返回账号匹配的站点配置"""
+    return get_site_profiles().match(account)
+
+def warmup_url(account, profile=None):
+    """登录后建立会话访问的页面（站点配置的warmupPath），配置为空时返回None"""
+    profile = profile or get_site_profile(account)
+    return f"{account['site']}{profile['warmupPath']}" if profile.get('warmupPath') else None
+
+class TokenBucket:
+    """令牌桶限速器（线程安全），rate为每秒补充的令牌数，burst为桶容量；rate<=0表示不限速"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """预留一个令牌，返回需要等待的秒数"""
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        """同步获取令牌（在线程中调用）"""
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        """异步获取令牌"""
+        delay = self._reserve()
+        if delay > 0:
+            await wait_pause('rate_limit', delay)
+
+class PrioritySemaphore:
+    """按优先级分配名额的信号量：名额释放时交给优先级键最小（最紧迫）的等待者，相同优先级按到达顺序"""
+
+    def __init__(self, value=1):
+        self._value = value
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority=0):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已经分配到名额后才被取消时，把名额交给下一个等待者；未分配的条目在release时跳过
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
 
-                # 尝试勾选"记住我"选项
-                page.evaluate('() => { const remember = document.querySelector(\'input[name="remember"]\'); if (remember) remember.checked = true; }')
-            except Exception as e:
-                print(f"使用简单方式填写表单失败: {str(e)}")
-                print("尝试使用备用方式填写表单...")
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=0):
+        """占用一个名额的上下文管理器"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+class SiteLimiter:
+    """单个站点的限制：同时处理的账号数与请求速率"""
+
+    def __init__(self, concurrency, rate):
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.semaphore = PrioritySemaphore(self.concurrency)
+        self.bucket = TokenBucket(rate, burst=self.concurrency)
+
+# 站点（域名）到限制器的映射，在每次运行开始时根据账号配置生成
+_site_limiters = {}
+
+def site_domain(site):
+    """返回站点地址中的域名（含端口）"""
+    return urlparse(site).netloc
+
+def configure_site_limits(accounts, default_concurrency=2, default_rate=1.0):
+    """按域名为账号生成站点限制器，账号配置中的siteConcurrency/siteRate优先，同一站点取最严格的值"""
+    limits = {}
+    for account in accounts:
+        domain = site_domain(account['site'])
+        concurrency, rate = limits.get(domain, (None, None))
+        if account.get('siteConcurrency') is not None:
+            value = int(account['siteConcurrency'])
+            concurrency = value if concurrency is None else min(concurrency, value)
+        if account.get('siteRate') is not None:
+            value = float(account['siteRate'])
+            rate = value if rate is None else min(rate, value)
+        limits[domain] = (concurrency, rate)
+
+    _site_limiters.clear()
+    for domain, (concurrency, rate) in limits.items():
+        _site_limiters[domain] = SiteLimiter(
+            concurrency if concurrency is not None else default_concurrency,
+            rate if rate is not None else default_rate
+        )
+    return _site_limiters
+
+def get_site_limiter(site):
+    """返回站点的限制器，未配置的站点返回一个默认限制器"""
+    domain = site_domain(site)
+    if domain not in _site_limiters:
+        _site_limiters[domain] = SiteLimiter(2, 1.0)
+    return _site_limiters[domain]
+
+async def throttle_site(url):
+    """按站点的请求速率等待令牌（浏览器导航前调用）"""
+    limiter = _site_limiters.get(site_domain(url))
+    if limiter is not None:
+        await limiter.bucket.acquire_async()
+
+def throttle_site_sync(url):
+    """按站点的请求速率等待令牌（在线程中发送HTTP请求前调用）"""
+    limiter = _site_limiters.get(site_domain(url))
+    if limiter is not None:
+        limiter.bucket.acquire()
+
+def interleave_by_domain(accounts):
+    """按域名分组后轮流取出账号的索引，使不同站点交替执行而不是同一站点的账号挤在一起"""
+    groups = {}
+    for i, account in enumerate(accounts):
+        groups.setdefault(site_domain(account['site']), []).append(i)
+    order = []
+    queues = list(groups.values())
+    while queues:
+        for queue in queues:
+            order.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return order
+
+async def navigate(page, url, wait_until='load', timeout=30000, challenge_timeout=30, reload_wait_until=None):
+    """导航到url，根据响应判断CloudFlare挑战并等待其完成，返回最终的响应
+
+    同一域名的挑战只由第一个遇到的账号处理，其余账号等待后复用缓存的cf_clearance。
+    """
+    domain = site_domain(url)
+    cache = get_clearance_cache()
+
+    # 同一站点的其他账号正在处理挑战时，先等待其完成
+    lock = cache.lock(domain)
+    if lock.locked():
+        async with lock:
+            pass
+    await cache.apply(page.context, domain)
 
-                # 备用方式：尝试不同的选择器
-                try:
-                    # 尝试不同的用户名输入框选择器
-                    username_selectors = ['input[name="email"]', 'input[id="username"]', 'input[id="email"]']
-                    for selector in username_selectors:
-                        try:
-                            if page.locator(selector).count() > 0:
-                                page.fill(selector, account['username'])
-                                break
-                        except Exception:
-                            continue
-
-                    # 尝试不同的密码输入框选择器
-                    password_selectors = ['input[id="password"]', 'input[type="password"]']
-                    for selector in password_selectors:
-                        try:
-                            if page.locator(selector).count() > 0:
-                                page.fill(selector, account['password'])
-                                break
-                        except Exception:
-                            continue
-                except Exception as e:
-                    print(f"备用方式填写表单也失败: {str(e)}")
+    attempt_started = time.time()
+    await throttle_site(url)
+    response = await page.goto(url, wait_until=wait_until, timeout=timeout)
+    if not is_challenge_page_response(response):
+        return response
 
-            # 提交登录表单
-            print(f"提交登录表单...")
+    def passed_challenge(r):
+        return r.frame == page.main_frame and r.request.is_navigation_request() and not is_challenge_page_response(r)
 
-            # 使用netkeep1.py的简单直接的登录方式
-            try:
-                # 直接点击提交按钮
-                print(f"点击登录按钮...")
-                page.click('button[type="submit"]')
+    # 在等待锁之前就开始监听，避免错过挑战完成后的跳转
+    solved = asyncio.ensure_future(wait_response(page, passed_challenge, 'challenge', timeout=challenge_timeout))
+    try:
+        async with lock:
+            # 等待期间如果其他账号已经通过了挑战，直接复用其cf_clearance
+            if cache.saved_at(domain) > attempt_started and await cache.apply(page.context, domain):
+                logger.info("复用同站点其他账号的cf_clearance...")
+                await throttle_site(url)
+                response = await page.goto(url, wait_until=wait_until, timeout=timeout)
+                if not is_challenge_page_response(response):
+                    return response
+
+            with span('cf_wait'):
+                logger.info("检测到CloudFlare挑战页面（状态码 %s），等待挑战完成...", response.status)
+                response = await solved
+                if response is None and reload_wait_until:
+                    # 如果仍然在CloudFlare页面，尝试刷新
+                    logger.info("CloudFlare挑战仍未完成，尝试刷新页面...")
+                    try:
+                        response = await page.reload(wait_until=reload_wait_until, timeout=timeout)
+                    except Exception as e:
+                        logger.warning("页面刷新时出错: %s，尝试继续执行...", e)
+                        response = None
+                    if is_challenge_page_response(response):
+                        response = None
+
+                if response is None:
+                    logger.warning("CloudFlare挑战未能在限定时间内完成")
+                    return None
+
+                await wait_load(page, 'challenge', state=wait_until if wait_until != 'commit' else 'domcontentloaded',
+                                timeout=timeout / 1000)
+                logger.info("CloudFlare挑战已完成，继续执行...")
+                await cache.capture(page.context, domain)
+                return response
+    finally:
+        if not solved.done():
+            solved.cancel()
+            await asyncio.gather(solved, return_exceptions=True)
+
+# 默认拦截的资源类型
+BLOCKED_RESOURCE_TYPES = {'image', 'font', 'media'}
+
+# 默认拦截的统计与广告域名（包括其子域名）
+TRACKER_HOSTS = (
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'googlesyndication.com',
+    'googleadservices.com', 'facebook.net', 'hotjar.com', 'clarity.ms', 'cloudflareinsights.com',
+    'hm.baidu.com', 'cnzz.com', 'umeng.com', 'mc.yandex.ru', 'segment.io', 'mixpanel.com'
+)
 
-                # 等待页面开始加载
-                try:
-                    print(f"等待页面加载...")
-                    page.wait_for_load_state('domcontentloaded', timeout=30000)
-                    print(f"页面已加载完毕 (domcontentloaded)")
-                except Exception as e:
-                    print(f"等待页面加载时出错: {str(e)}，继续执行...")
+# CloudFlare挑战所需的请求永远放行
+CHALLENGE_URL_MARKERS = ('challenges.cloudflare.com', '/cdn-cgi/challenge-platform')
 
-                # 添加固定等待时间
-                print(f"等待3秒，确保登录完成...")
-                time.sleep(3)
-            except Exception as e:
-                print(f"直接点击登录按钮失败: {str(e)}")
-                print("尝试使用备用方式提交表单...")
+def is_tracker_url(url):
+    """判断请求是否指向已知的统计或广告域名"""
+    host = urlparse(url).hostname or ''
+    return any(host == h or host.endswith('.' + h) for h in TRACKER_HOSTS)
 
-                # 备用方式：尝试不同的方法提交表单
-                try:
-                    # 尝试使用JavaScript提交表单
-                    page.evaluate('() => { const form = document.querySelector("form"); if (form) form.submit(); }')
-                    print("已通过JavaScript提交表单")
+async def apply_resource_policy(context, allow=None):
+    """为浏览器上下文设置请求拦截：默认中止图片、字体、媒体和统计请求
 
-                    # 等待页面开始加载
-                    try:
-                        print(f"等待页面加载...")
-                        page.wait_for_load_state('domcontentloaded', timeout=30000)
-                        print(f"页面已加载完毕 (domcontentloaded)")
-                    except Exception as e:
-                        print(f"等待页面加载时出错: {str(e)}，继续执行...")
-
-                    # 添加固定等待时间
-                    print(f"等待3秒，确保登录完成...")
-                    time.sleep(3)
-                except Exception as js_error:
-                    print(f"通过JavaScript提交表单失败: {str(js_error)}")
-
-                    # 尝试点击其他可能的登录按钮
-                    login_button_selectors = [
-                        'input[type="submit"]',
-                        'button:has-text("登录")', 'button:has-text("Login")',
-                        'a:has-text("登录")', 'a:has-text("Login")'
-                    ]
-
-                    for selector in login_button_selectors:
-                        try:
-                            if page.locator(selector).count() > 0:
-                                page.click(selector)
-                                print(f"已点击登录按钮: {selector}")
-
-                                # 等待页面开始加载
-                                try:
-                                    print(f"等待页面加载...")
-                                    page.wait_for_load_state('domcontentloaded', timeout=30000)
-                                    print(f"页面已加载完毕 (domcontentloaded)")
-                                except Exception as e:
-                                    print(f"等待页面加载时出错: {str(e)}，继续执行...")
-
-                                # 添加固定等待时间
-                                print(f"等待3秒，确保登录完成...")
-                                time.sleep(3)
-                                break
-                        except Exception:
-                            continue
-
-            # 开始轮询检测登录状态
-            print(f"开始检测登录状态...")
-            start_time = time.time()
-            max_wait_time = 30  # 最多等待30秒，比netkeep1.py的等待时间长，但比原来的60秒短
-            login_success_detected = False
-            poll_count = 0
-
-            # 使用更短的初始检查间隔
-            while time.time() - start_time < max_wait_time:
-                poll_count += 1
-                current_poll_time = time.time() - start_time
-
-                # 前10秒使用更短的检查间隔
-                current_interval = 0.5 if current_poll_time < 10 else 2
+    allow为站点白名单（列表或单个字符串），可以是资源类型（如"image"）或URL片段；为"*"时不拦截任何请求。
+    设置环境变量NETKEEP_BLOCK_RESOURCES=0可全局关闭拦截。
+    """
+    if allow == '*' or os.environ.get('NETKEEP_BLOCK_RESOURCES', '1') == '0':
+        return
+    # 只填写一项时可以直接写字符串，例如"image"
+    allow = [allow] if isinstance(allow, str) else list(allow or [])
+    allowed_types = {item for item in allow if item in BLOCKED_RESOURCE_TYPES}
+    allowed_patterns = [item for item in allow if item not in allowed_types]
+
+    async def handle(route):
+        request = route.request
+        url = request.url
+        if any(marker in url for marker in CHALLENGE_URL_MARKERS) or \
+                any(pattern in url for pattern in allowed_patterns):
+            await route.continue_()
+        elif (request.resource_type in BLOCKED_RESOURCE_TYPES and request.resource_type not in allowed_types) \
+                or is_tracker_url(url):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    await context.route('**/*', handle)
+
+# 浏览器上下文使用的User-Agent
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+async def new_account_context(browser, storage_state=None, site=None, allow_resources=None):
+    """为账号创建一个独立的浏览器上下文，可选地恢复已保存的storage_state，并带上站点缓存的cf_clearance
+
+    上下文会按资源策略拦截图片、字体、媒体和统计请求，allow_resources为站点白名单。
+    """
+    with span('context_create'):
+        # 使用更真实的浏览器配置
+        context = await browser.new_context(
+            storage_state=storage_state,
+            user_agent=USER_AGENT,
+            viewport={'width': 1280, 'height': 800},
+            extra_http_headers={
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+                'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+                'Upgrade-Insecure-Requests': '1',
+                'sec-ch-ua': '"Not_A Brand";v="8", "Chromium";v="120"',
+                'sec-ch-ua-mobile': '?0',
+                'sec-ch-ua-platform': '"Windows"'
+            }
+        )
+
+        # 启用JavaScript
+        await context.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => false})")
+
+        # 拦截不需要的资源，减少带宽并让networkidle更快达到
+        await apply_resource_policy(context, allow_resources)
+
+        if site:
+            await get_clearance_cache().apply(context, urlparse(site).netloc)
+    return context
+
+async def resume_session(account, context):
+    """使用缓存的会话打开一个受保护的页面，会话仍有效时返回登录结果，否则返回None"""
+    need_cookie = account.get('needCookie', 'renewApi' in account)
+    profile = get_site_profile(account)
+    login_url = f"{account['site']}{account['loginApi']}"
+    # 需要Cookie时直接访问站点配置的会话页面（原本就要访问），否则访问登录页，已登录的会话通常会被重定向离开登录页
+    check_url = (need_cookie and warmup_url(account, profile)) or login_url
 
-                try:
-                    # 检查当前URL（最快的检查方式）
-                    current_url = page.url
-                    url_changed = login_url != current_url and "/login" not in current_url
+    page = await context.new_page()
+    try:
+        with span('login_nav'):
+            response = await navigate(page, check_url, wait_until='domcontentloaded', timeout=15000)
+            if response is None:
+                return None
+        if "/login" in page.url:
+            return None
+        verdict = await classify_page(page, login_url, profile.get('successTexts'), profile.get('failureTexts'))
+        if verdict['state'] in ('login_form', 'login_failed', 'challenge'):
+            logger.debug("缓存会话检查: %s", verdict['evidence'])
+            return None
+    finally:
+        try:
+            await page.close()
+        except Exception:
+            pass
 
-                    if url_changed:
-                        # URL已改变，检查是否有登录表单
-                        login_form_exists = False
-                        try:
-                            login_form_exists = page.locator('form input[type="password"]').count() > 0
-                        except Exception:
-                            pass
-
-                        if not login_form_exists:
-                            # URL已改变且没有登录表单，很可能已经登录成功
-                            login_success_detected = True
-                            break
-                    else:
-                        # 如果URL未改变，每隔几次轮询进行一次完整检查
-                        if poll_count % 5 == 0:
-                            try:
-                                page_content = page.content().lower()
-                                login_form_exists = page.locator('form input[type="password"]').count() > 0
-
-                                # 检查页面内容是否包含客户区域特征
-                                client_area_indicators = [
-                                    "client area", "客户中心", "用户中心", "控制面板",
-                                    "hosting plans", "support tickets", "dashboard", "account"
-                                ]
-
-                                if any(indicator in page_content for indicator in client_area_indicators) and not login_form_exists:
-                                    login_success_detected = True
-                                    break
-                            except Exception:
-                                pass
-                except Exception:
-                    pass
+    if need_cookie:
+        with span('cookie_extract'):
+            cookie_value, cf_clearance_cookie = extract_session_cookie(await context.cookies(),
+                                                                       profile['sessionCookie'])
+        return context, cookie_value, cf_clearance_cookie
+    return context, None, None
+
+async def login_and_get_cookie(account, browser, max_retries=2, session_store=None):  # 减少重试次数
+    """在新的浏览器上下文中登录账号，失败时关闭上下文以免在共享浏览器中残留
+
+    如果提供了session_store，会先尝试复用上次保存的会话，只有会话失效时才走表单登录流程。
+    """
+    if session_store is not None:
+        storage_state = session_store.get(account['site'], account['username'])
+        if storage_state:
+            logger.info("尝试复用账号 %s 的缓存会话...", account['username'])
+            context = await new_account_context(browser, storage_state=storage_state, site=account['site'],
+                                                allow_resources=account.get('allowResources'))
+            result = None
+            try:
+                result = await resume_session(account, context)
+            except Exception as e:
+                logger.warning("验证缓存会话时出错: %s", e)
+            if result is not None:
+                logger.info("账号 %s 的缓存会话仍然有效，跳过表单登录", account['username'])
+                # 保存站点刷新后的Cookie，缓存的有效期从最近一次使用开始计算
+                try:
+                    session_store.put(account['site'], account['username'], await context.storage_state())
+                except Exception as e:
+                    logger.warning("保存账号 %s 的会话失败: %s", account['username'], e)
+                return result
+            logger.info("账号 %s 的缓存会话已失效，重新登录", account['username'])
+            session_store.delete(account['site'], account['username'])
+            try:
+                await context.close()
+            except Exception:
+                pass
 
-                time.sleep(current_interval)
+    context = await new_account_context(browser, site=account['site'], allow_resources=account.get('allowResources'))
+    try:
+        result = await login_in_context(account, context, max_retries)
+    except Exception:
+        try:
+            await context.close()
+        except Exception:
+            pass
+        raise
 
-            # 最终检查
-            try:
-                # 获取最终的页面状态
-                current_url = page.url
-                url_changed = login_url != current_url and "/login" not in current_url
+    if session_store is not None:
+        try:
+            session_store.put(account['site'], account['username'], await context.storage_state())
+        except Exception as e:
+            logger.warning("保存账号 %s 的会话失败: %s", account['username'], e)
+    return result
+
+# 登录表单的用户名、密码输入框和提交方式，按顺序尝试
+LOGIN_USERNAME_SELECTORS = ['input[name="username"]', 'input[name="email"]', 'input[id="username"]', 'input[id="email"]']
+LOGIN_PASSWORD_SELECTORS = ['input[name="password"]', 'input[id="password"]', 'input[type="password"]']
+LOGIN_SUBMIT_STRATEGIES = [
+    'button[type="submit"]', 'form.submit()', 'input[type="submit"]',
+    'button:has-text("登录")', 'button:has-text("Login")', 'a:has-text("登录")', 'a:has-text("Login")'
+]
+
+def profile_or_learned(configured, options, learned):
+    """站点配置指定了选择器时只使用它，否则把记住的选项放到通用顺序的最前面"""
+    return [configured] if configured else prefer_first(options, learned)
+
+# 提交登录表单前在页面上做标记：之后DOM发生变化时标记为已变化；导航到新页面后标记消失。
+# 页面状态分类器据此区分提交前就存在的文本和提交后出现的失败提示
+MARK_SUBMIT_JS = """() => {
+    const mark = window.__netkeepSubmit = {changed: false};
+    const observer = new MutationObserver(() => { mark.changed = true; observer.disconnect(); });
+    observer.observe(document.body || document.documentElement, {childList: true, subtree: true, characterData: true});
+}"""
+
+# 在页面内一次完成登录表单的查找、填写和提交：先按给定顺序尝试选择器（支持 tag:has-text("文本")），
+# 找不到时根据表单结构、输入框类型和autocomplete提示推断；提交延迟到evaluate返回后执行，避免导航销毁执行上下文
+LOGIN_FORM_JS = """({username, password, usernameSelectors, passwordSelectors, submitStrategies}) => {
+    const visible = el => !!(el.offsetWidth || el.offsetHeight || el.getClientRects().length);
+    const query = (selector, root) => {
+        const hasText = selector.match(/^([\\w-]+):has-text\\("(.*)"\\)$/);
+        let found;
+        try {
+            found = hasText
+                ? Array.from(root.querySelectorAll(hasText[1])).filter(el => (el.textContent || '').includes(hasText[2]))
+                : Array.from(root.querySelectorAll(selector));
+        } catch (e) {
+            return null;
+        }
+        return found.find(visible) || found[0] || null;
+    };
+    const describe = el => {
+        const tag = el.tagName.toLowerCase();
+        if (el.getAttribute('name')) return `${tag}[name="${el.getAttribute('name')}"]`;
+        if (el.id) return `${tag}[id="${el.id}"]`;
+        return null;
+    };
+    const pick = (selectors, discover) => {
+        for (const selector of selectors) {
+            const el = query(selector, document);
+            if (el) return [el, selector];
+        }
+        const el = discover();
+        return el ? [el, describe(el)] : [null, null];
+    };
+    const fill = (el, value) => {
+        // 使用原生setter并触发input/change事件，让前端框架感知到输入
+        const setter = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+        el.focus();
+        setter.call(el, value);
+        el.dispatchEvent(new Event('input', {bubbles: true}));
+        el.dispatchEvent(new Event('change', {bubbles: true}));
+    };
+
+    const passwords = Array.from(document.querySelectorAll('input[type="password"]'));
+    const [passwordEl, passwordSelector] = pick(passwordSelectors, () =>
+        document.querySelector('input[autocomplete="current-password"]') || passwords.find(visible) || passwords[0]);
+    const form = (passwordEl && passwordEl.form) || document.querySelector('form');
+    const scope = form || document;
+
+    const [usernameEl, usernameSelector] = pick(usernameSelectors, () => {
+        const hinted = scope.querySelector('input[autocomplete="username"], input[autocomplete="email"], input[type="email"]');
+        if (hinted) return hinted;
+        // 密码框之前最后一个可见的文本类输入框
+        const candidates = Array.from(scope.querySelectorAll('input')).filter(el =>
+            ['text', 'email', 'tel', ''].includes((el.getAttribute('type') || '').toLowerCase()) && visible(el) &&
+            (!passwordEl || (el.compareDocumentPosition(passwordEl) & Node.DOCUMENT_POSITION_FOLLOWING)));
+        return candidates[candidates.length - 1] || null;
+    });
+
+    if (usernameEl) fill(usernameEl, username);
+    if (passwordEl) fill(passwordEl, password);
+
+    const remember = scope.querySelector('input[name="remember"]') ||
+        Array.from(scope.querySelectorAll('input[type="checkbox"]')).find(el => /remember|记住/i.test(`${el.name} ${el.id}`));
+    if (remember && !remember.checked) remember.click();
+
+    let submitEl = null, submit = null;
+    for (const strategy of submitStrategies) {
+        if (strategy === 'form.submit()') {
+            if (form) { submit = strategy; break; }
+            continue;
+        }
+        submitEl = query(strategy, document);
+        if (submitEl) { submit = strategy; break; }
+    }
+    if (!submit) {
+        submitEl = scope.querySelector('button[type="submit"], button:not([type]), input[type="submit"], input[type="image"]') ||
+            Array.from(scope.querySelectorAll('button, a, input[type="button"]')).find(el =>
+                /登录|登陆|login|log in|sign in/i.test(el.textContent || el.value || ''));
+        if (submitEl) submit = describe(submitEl);
+        else if (form) submit = 'form.submit()';
+    }
+    // 表单内name为submit的输入框会遮蔽form.submit，因此调用原型上的方法
+    (MARK_SUBMIT_JS)();
+    if (submitEl) setTimeout(() => submitEl.click());
+    else if (form && submit) setTimeout(() => HTMLFormElement.prototype.submit.call(form));
+
+    return {username: usernameEl ? usernameSelector : null, password: passwordEl ? passwordSelector : null,
+            remember: !!remember, submit, submitted: !!(submitEl || (form && submit))};
+}""".replace('MARK_SUBMIT_JS', MARK_SUBMIT_JS)
+
+async def fill_login_form(page, account, username_selectors, password_selectors, submit_strategies):
+    """在一次evaluate中查找、填写并提交登录表单，返回 (用户名选择器, 密码选择器, 提交方式)
+
+    选择器按给定顺序优先，找不到时在页面内按表单结构推断；推断出的元素没有name或id时对应选择器为None。
+    页面内执行失败时（例如执行上下文被销毁）退回逐个选择器尝试的方式。
+    """
+    try:
+        filled = await page.evaluate(LOGIN_FORM_JS, {
+            'username': account['username'], 'password': account['password'],
+            'usernameSelectors': username_selectors, 'passwordSelectors': password_selectors,
+            'submitStrategies': submit_strategies,
+        })
+    except Exception as e:
+        logger.warning("在页面内填写登录表单失败: %s，逐个尝试选择器", e)
+        username_selector = await fill_first(page, username_selectors, account['username'])
+        password_selector = await fill_first(page, password_selectors, account['password'])
+        with contextlib.suppress(Exception):
+            await page.evaluate(MARK_SUBMIT_JS)
+        return username_selector, password_selector, await submit_login_form(page, submit_strategies)
+
+    if not filled['username'] and not filled['password']:
+        logger.warning("未找到用户名或密码输入框")
+    if filled['submitted']:
+        logger.info("已提交登录表单: %s", filled['submit'] or "推断的提交按钮")
+    else:
+        logger.warning("未找到可用的登录提交方式")
+    return filled['username'], filled['password'], filled['submit']
+
+async def fill_first(page, selectors, value):
+    """填写第一个存在的输入框，返回使用的选择器，都不存在时返回None"""
+    for selector in selectors:
+        try:
+            if await page.locator(selector).count() > 0:
+                await page.fill(selector, value)
+                return selector
+        except Exception as e:
+            logger.warning("填写 %s 失败: %s", selector, e)
+    return None
 
-                # 快速检查登录状态
-                login_form_exists = False
-                content_indicates_success = False
-                failure_detected = False
+async def submit_login_form(page, strategies):
+    """按顺序尝试提交登录表单，返回生效的方式（选择器或"form.submit()"），都不可用时返回None"""
+    for strategy in strategies:
+        try:
+            if strategy == 'form.submit()':
+                # 延迟到evaluate返回后再提交，避免导航销毁执行上下文
+                submitted = await page.evaluate(
+                    '() => { const form = document.querySelector("form"); if (form) setTimeout(() => form.submit()); return !!form; }'
+                )
+                if submitted:
+                    logger.info("已通过JavaScript提交表单")
+                    return strategy
+            elif await page.locator(strategy).count() > 0:
+                await page.click(strategy)
+                logger.info("已点击登录按钮: %s", strategy)
+                return strategy
+        except Exception as e:
+            logger.warning("使用 %s 提交表单失败: %s", strategy, e)
+    logger.warning("未找到可用的登录提交方式")
+    return None
 
-                try:
-                    # 检查是否仍有登录表单
-                    login_form_exists = page.locator('form input[type="password"]').count() > 0
+async def login_in_context(account, context, max_retries=2):
+    # 检查是否需要获取Cookie
+    # 如果没有renewApi字段，默认不需要获取Cookie
+    need_cookie = account.get('needCookie', 'renewApi' in account)
+    profile = get_site_profile(account)
+    success_texts = profile.get('successTexts')
+    failure_texts = profile.get('failureTexts')
 
-                    # 检查页面内容
-                    page_content = page.content().lower()
+    page = await context.new_page()
 
-                    # 检查成功指标
-                    client_area_indicators = ["client area", "客户中心", "用户中心", "控制面板",
-                                             "hosting plans", "support tickets", "dashboard", "account"]
-                    content_indicates_success = any(indicator in page_content for indicator in client_area_indicators)
+    # 随机移动鼠标，模拟人类行为
+    async def simulate_human_behavior(page):
+        # 随机移动鼠标
+        for _ in range(3):
+            await page.mouse.move(
+                random.randint(100, 1000),
+                random.randint(100, 600)
+            )
+            await wait_pause('human_pause', random.uniform(0.5, 1.5))
 
-                    # 检查失败指标
-                    failure_texts = ["密码错误", "用户名错误", "登录失败", "incorrect password", "invalid username"]
-                    failure_detected = any(text in page_content for text in failure_texts)
-                except Exception:
-                    pass
+    login_success_detected = False
+    for attempt in range(max_retries):
+        try:
+            login_url = f"{account['site']}{account['loginApi']}"
+            logger.info("尝试 %s/%s: 导航到 %s 登录 %s", attempt + 1, max_retries, login_url, account['username'])
 
-                # 如果轮询中未检测到成功，再次检查
-                if not login_success_detected:
-                    if (url_changed or content_indicates_success) and not login_form_exists:
-                        login_success_detected = True
-
-                # 最终判断
-                if login_success_detected:
-                    print(f"登录成功")
-                elif failure_detected:
-                    print(f"登录失败 (检测到失败提示)")
-                    raise Exception(f"登录失败，检测到失败提示")
-                elif login_form_exists:
-                    print(f"登录失败 (仍存在登录表单)")
-                    raise Exception("登录失败，仍存在登录表单")
-                elif url_changed:
-                    print(f"登录成功 (URL已改变)")
-                    login_success_detected = True
-                elif content_indicates_success:
-                    print(f"登录成功 (页面内容包含客户区域特征)")
-                    login_success_detected = True
-                else:
-                    print(f"登录失败 (无法确定登录状态)")
-                    raise Exception("登录超时，未能确认登录状态")
-            except Exception as e:
-                if not login_success_detected:
-                    raise
+            with span('login_nav'):
+                # 使用load而不是networkidle，更快地返回控制权；遇到CloudFlare挑战时等待挑战完成后立即继续
+                try:
+                    await navigate(page, login_url, wait_until='load', timeout=30000, challenge_timeout=30,
+                                   reload_wait_until='load')
+                except Exception as e:
+                    logger.warning("页面导航时出错: %s，尝试继续执行...", e)
+
+                # 等待登录表单出现后再填写
+                await wait_selector(page, 'input[type="password"]', 'login_form', timeout=10)
+
+            # 填写表单：站点配置指定了选择器时直接使用，否则优先使用该站点上次成功的选择器和提交方式
+            domain = site_domain(account['site'])
+            learned = get_strategy_cache().get(domain, 'login')
+            with span('form_fill'):
+                logger.info("填写并提交登录表单...")
+                username_selector, password_selector, submit_strategy = await fill_login_form(
+                    page, account,
+                    profile_or_learned(profile.get('usernameSelector'), LOGIN_USERNAME_SELECTORS,
+                                       learned.get('username_selector')),
+                    profile_or_learned(profile.get('passwordSelector'), LOGIN_PASSWORD_SELECTORS,
+                                       learned.get('password_selector')),
+                    profile_or_learned(profile.get('submitSelector'), LOGIN_SUBMIT_STRATEGIES, learned.get('submit')),
+                )
 
-            # 只有需要获取Cookie时才访问 /server/lxc 建立会话
-            if need_cookie:
-                print(f"导航到 {account['site']}/server/lxc 页面...")
-                page.goto(f"{account['site']}/server/lxc", wait_until='networkidle', timeout=12000)
-
-                # 检查是否遇到CloudFlare挑战页面
-                if "Just a moment" in page.content() or "Checking your browser" in page.content():
-                    print("服务器页面遇到CloudFlare挑战，等待挑战完成...")
-                    # 等待更长时间让CloudFlare挑战完成
-                    for _ in range(12):  # 最多等待30秒
-                        time.sleep(5)
-                        if "Just a moment" not in page.content() and "Checking your browser" not in page.content():
-                            print("CloudFlare挑战已完成，继续执行...")
-                            break
+            with span('submit_detect'):
+                # 等待登录结果：同时监听导航事件与页面内变化，任一条件满足立即返回
+                logger.info("开始检测登录状态...")
+                outcome, evidence = await wait_for_login_outcome(page, login_url, timeout=30,
+                                                                 success_texts=success_texts,
+                                                                 failure_texts=failure_texts)
+
+            if outcome == 'success':
+                logger.info("登录成功 (%s)", evidence)
+                login_success_detected = True
+                get_strategy_cache().update(domain, 'login', username_selector=username_selector,
+                                            password_selector=password_selector, submit=submit_strategy)
+            elif outcome == 'failure':
+                logger.warning("登录失败 (检测到失败提示)")
+                raise Exception("登录失败，检测到失败提示")
+            elif outcome == 'login_form':
+                logger.warning("登录失败 (仍存在登录表单)")
+                get_strategy_cache().forget(domain, 'login', 'username_selector', 'password_selector', 'submit')
+                raise Exception("登录失败，仍存在登录表单")
             else:
-                print(f"不需要获取Cookie，跳过导航到 {account['site']}/server/lxc 页面")
+                logger.warning("登录失败 (无法确定登录状态)")
+                # 记住的表单写法可能已失效，下次尝试完整的顺序
+                get_strategy_cache().forget(domain, 'login', 'username_selector', 'password_selector', 'submit')
+                raise Exception("登录超时，未能确认登录状态")
+
+            # 只有需要获取Cookie时才访问站点配置的会话页面（默认 /server/lxc）建立会话
+            session_url = warmup_url(account, profile)
+            if need_cookie and session_url:
+                logger.info("导航到 %s 页面...", session_url)
+                with span('lxc_nav'):
+                    await navigate(page, session_url, wait_until='networkidle', timeout=12000,
+                                   challenge_timeout=60)
+            elif session_url:
+                logger.info("不需要获取Cookie，跳过导航到 %s 页面", session_url)
 
             # 如果需要获取Cookie
             if need_cookie:
                 # 获取所有Cookie
-                cookies = context.cookies()
-
-                # 尝试获取sw110xy cookie
-                sw110xy_cookie = next((c for c in cookies if c['name'] == 'sw110xy'), None)
-
-                # 获取CloudFlare cookie
-                cf_clearance_cookie = next((c for c in cookies if c['name'] == 'cf_clearance'), None)
-
-                # 如果找不到sw110xy cookie，尝试获取其他可能的会话cookie
-                if not sw110xy_cookie:
-                    # 尝试获取其他常见的会话cookie
-                    session_cookies = [
-                        next((c for c in cookies if c['name'] == 'PHPSESSID'), None),
-                        next((c for c in cookies if c['name'] == 'laravel_session'), None),
-                        next((c for c in cookies if c['name'] == 'session'), None),
-                        next((c for c in cookies if 'session' in c['name'].lower()), None)
-                    ]
-
-                    # 使用第一个非None的会话cookie
-                    session_cookie = next((c for c in session_cookies if c is not None), None)
-
-                    if session_cookie:
-                        print(f"未找到sw110xy cookie，使用替代会话cookie: {session_cookie['name']}")
-                        cookie_value = f"{session_cookie['name']}={session_cookie['value']};1"
-                    else:
-                        # 如果没有找到任何会话cookie，尝试使用所有cookie
-                        print("未找到任何会话cookie，使用所有cookie")
-                        cookie_value = "; ".join([f"{c['name']}={c['value']}" for c in cookies])
-                else:
-                    cookie_value = f"{sw110xy_cookie['name']}={sw110xy_cookie['value']};1"
+                with span('cookie_extract'):
+                    cookie_value, cf_clearance_cookie = extract_session_cookie(await context.cookies(),
+                                                                               profile['sessionCookie'])
 
-                print(f"账号 {account['username']} 登录成功，Cookie: {cookie_value}")
+                logger.debug("账号 %s 登录成功，Cookie: %s", account['username'], cookie_value)
 
                 # 登录成功
 
                 return context, cookie_value, cf_clearance_cookie
             else:
                 # 不需要获取Cookie，只需登录
-                print(f"账号 {account['username']} 登录成功，不需要获取Cookie")
+                logger.info("账号 %s 登录成功，不需要获取Cookie", account['username'])
                 return context, None, None
         except PlaywrightTimeoutError as e:
             # 这个异常处理部分现在应该很少触发，因为我们使用了自定义轮询
-            print(f"Playwright超时异常: {str(e)}")
-
-            # 检查页面状态
-            try:
-                # 检查当前URL和页面内容
-                current_url = page.url
-                url_changed = login_url != current_url and "/login" not in current_url
+            logger.warning("Playwright超时异常: %s", e)
 
-                # 快速检查登录状态
-                try:
-                    login_form_exists = page.locator('form input[type="password"]').count() > 0
-                    page_content = page.content().lower()
-                    client_area_indicators = ["client area", "客户中心", "用户中心", "控制面板", "dashboard", "account"]
-                    content_indicates_success = any(indicator in page_content for indicator in client_area_indicators)
-
-                    # 如果URL已改变或页面内容表明登录成功，且没有登录表单，则认为登录成功
-                    if (url_changed or content_indicates_success) and not login_form_exists:
-                        print(f"虽然发生超时，但检测到登录成功")
-                        return context, None, None
-                except Exception:
-                    pass
-            except Exception:
-                pass
+            # 检查页面状态：URL已改变或页面内容表明登录成功，且没有登录表单，则认为登录成功
+            verdict = await classify_page(page, login_url, success_texts, failure_texts)
+            if verdict['state'] == 'logged_in':
+                logger.warning("虽然发生超时，但检测到登录成功 (%s)", verdict['evidence'])
+                return context, None, None
 
-            print(f"账号 {account['username']} 登录尝试 {attempt + 1} 失败")
+            logger.warning("账号 %s 登录尝试 %s 失败", account['username'], attempt + 1)
 
             if attempt < max_retries - 1:
-                print(f"等待10秒后重试...")
-                time.sleep(10)
+                logger.info("等待%s秒后重试...", RETRY_DELAY)
+                await wait_pause('retry_backoff', RETRY_DELAY)
 
                 # 检查页面是否已关闭，如果已关闭则创建新页面
                 try:
                     # 尝试访问页面的URL属性，如果页面已关闭会抛出异常
                     _ = page.url
                 except Exception:
-                    print("页面已关闭，创建新页面...")
+                    logger.info("页面已关闭，创建新页面...")
                     try:
-                        page = context.new_page()
+                        page = await context.new_page()
                     except Exception as new_page_error:
-                        print(f"创建新页面失败: {str(new_page_error)}")
+                        logger.warning("创建新页面失败: %s", new_page_error)
 
                 continue
             raise
         except Exception as e:
             # 一般异常处理
-            print(f"登录过程中发生异常: {str(e)}")
+            logger.warning("登录过程中发生异常: %s", e)
 
             # 检查页面是否已关闭
             if "Target page, context or browser has been closed" not in str(e):
                 # 检查页面状态
-                try:
-                    # 快速检查登录状态
-                    current_url = page.url
-                    url_changed = login_url != current_url and "/login" not in current_url
-
-                    try:
-                        login_form_exists = page.locator('form input[type="password"]').count() > 0
-                        page_content = page.content().lower()
-                        client_area_indicators = ["client area", "客户中心", "用户中心", "控制面板", "dashboard", "account"]
-                        content_indicates_success = any(indicator in page_content for indicator in client_area_indicators)
-
-                        # 如果URL已改变或页面内容表明登录成功，且没有登录表单，则认为登录成功
-                        if (url_changed or content_indicates_success) and not login_form_exists:
-                            print(f"虽然发生错误，但检测到登录成功")
-                            return context, None, None
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
+                verdict = await classify_page(page, login_url, success_texts, failure_texts)
+                if verdict['state'] == 'logged_in':
+                    logger.warning("虽然发生错误，但检测到登录成功 (%s)", verdict['evidence'])
+                    return context, None, None
 
-            print(f"账号 {account['username']} 登录失败: {str(e)}")
+            logger.error("账号 %s 登录失败: %s", account['username'], e)
 
             if attempt < max_retries - 1:
-                print(f"等待10秒后重试...")
-                time.sleep(10)
+                logger.info("等待%s秒后重试...", RETRY_DELAY)
+                await wait_pause('retry_backoff', RETRY_DELAY)
 
                 # 检查页面是否已关闭，如果已关闭则创建新页面
                 try:
                     # 尝试访问页面的URL属性，如果页面已关闭会抛出异常
                     _ = page.url
                 except Exception:
-                    print("页面已关闭，创建新页面...")
+                    logger.info("页面已关闭，创建新页面...")
                     try:
-                        page = context.new_page()
+                        page = await context.new_page()
                     except Exception as new_page_error:
-                        print(f"创建新页面失败: {str(new_page_error)}")
+                        logger.warning("创建新页面失败: %s", new_page_error)
 
                 continue
             raise
@@ -639,607 +2123,923 @@ def login_and_get_cookie(account, browser, max_retries=2):  # 减少重试次数
             # 只有在登录成功后才关闭页面，失败时保留页面以便重试
             if login_success_detected:
                 try:
-                    page.close()
+                    await page.close()
                 except Exception:
                     pass
 
-# 检查登录是否成功
-def check_login_success(page, login_url):
-    """检查是否登录成功"""
+# 在页面内判断页面状态，只把结论和依据传回Python：CloudFlare挑战页为'challenge'；存在登录表单时，
+# 提交后页面有变化且出现失败提示为'login_failed'，否则为'login_form'；没有登录表单且已离开登录页
+# 或出现客户区域特征为'logged_in'，否则为'unknown'。只匹配页面上显示的文本（innerText），不包括脚本和样式
+PAGE_STATE_JS = """({loginUrl, successTexts, failureTexts}) => {
+    const text = (document.body ? document.body.innerText : '').toLowerCase();
+    const title = (document.title || '').toLowerCase();
+    if (/just a moment|attention required|请稍候/.test(title) ||
+            document.querySelector('#challenge-form, #challenge-running, #cf-challenge-running, #challenge-stage')) {
+        return {state: 'challenge', evidence: `CloudFlare挑战页: ${document.title}`};
+    }
+    const password = Array.from(document.querySelectorAll('input[type="password"]'))
+        .find(el => el.form || el.offsetWidth || el.offsetHeight);
+    if (password) {
+        // 没有提交标记说明已是新页面（或并非刚提交表单），否则要求提交后DOM有变化，避免把提交前就有的文本当作结果
+        const mark = window.__netkeepSubmit;
+        const failure = (!mark || mark.changed) && failureTexts.find(t => text.includes(t));
+        if (failure) return {state: 'login_failed', evidence: `页面出现失败提示: ${failure}`};
+        return {state: 'login_form', evidence: '存在登录表单'};
+    }
+    const href = location.href;
+    if (loginUrl && href !== loginUrl && !href.includes('/login')) {
+        return {state: 'logged_in', evidence: `URL已改变: ${href}`};
+    }
+    const success = successTexts.find(t => text.includes(t));
+    if (success) return {state: 'logged_in', evidence: `页面内容包含客户区域特征: ${success}`};
+    return {state: 'unknown', evidence: '未能确认页面状态'};
+}"""
+
+# 页面内观察器：只在得到确定的登录结果时返回，供wait_for_function轮询
+LOGIN_OUTCOME_JS = f"""(args) => {{
+    const verdict = ({PAGE_STATE_JS})(args);
+    return ['logged_in', 'login_failed'].includes(verdict.state) ? verdict : false;
+}}"""
+
+def page_state_args(login_url, success_texts=None, failure_texts=None):
+    """生成页面状态分类器的参数，成功与失败特征默认使用通用特征"""
+    return {
+        'loginUrl': login_url,
+        'successTexts': [t.lower() for t in success_texts or CLIENT_AREA_INDICATORS],
+        'failureTexts': [t.lower() for t in failure_texts or LOGIN_FAILURE_TEXTS],
+    }
+
+async def classify_page(page, login_url, success_texts=None, failure_texts=None):
+    """在页面内判断页面状态，返回 {'state': 状态, 'evidence': 依据}，页面无法执行脚本时状态为'unknown'"""
     try:
-        current_url = page.url
-        # 检查URL是否已经改变且不再是登录页面
-        url_changed = login_url != current_url and "/login" not in current_url
-
-        # 检查页面内容是否包含客户区域特征
-        page_content = page.content().lower()
-        client_area_indicators = [
-            "client area", "客户中心", "用户中心", "控制面板",
-            "hosting plans", "support tickets", "active domains",
-            "free plan warning", "dashboard", "account"
+        return await page.evaluate(PAGE_STATE_JS, page_state_args(login_url, success_texts, failure_texts))
+    except Exception as e:
+        return {'state': 'unknown', 'evidence': f"无法检查页面: {e}"}
+
+async def wait_for_login_outcome(page, login_url, timeout=30, success_texts=None, failure_texts=None):
+    """提交登录表单后等待结果，返回 (结果, 依据)
+
+    同时等待导航离开登录页（commit即返回）和页面内观察器（在页面内每100毫秒检查一次，
+    不把页面内容传回Python），任一条件满足立即返回，不再固定等待或反复获取完整页面内容。
+    页面状态由页面内分类器（PAGE_STATE_JS）判断，与其他登录和续期检查共用。
+    结果为 'success'、'failure'、'login_form'（超时且仍有登录表单）或 'timeout'。
+    success_texts/failure_texts为站点配置的成功与失败特征，默认使用通用特征。
+    """
+    def left_login_page(url):
+        return url != login_url and "/login" not in url
+
+    def finish(outcome, evidence):
+        _record_wait('login_outcome', started, outcome in ('success', 'failure'))
+        return outcome, evidence
+
+    outcomes = {'logged_in': 'success', 'login_failed': 'failure'}
+    started = time.monotonic()
+    deadline = started + timeout
+    while True:
+        remaining_ms = (deadline - time.monotonic()) * 1000
+        if remaining_ms <= 0:
+            break
+
+        waiters = []
+        if left_login_page(page.url):
+            # 已离开登录页，等待新页面DOM就绪后确认没有登录表单或失败提示
+            try:
+                await page.wait_for_load_state('domcontentloaded', timeout=remaining_ms)
+            except Exception:
+                pass
+            verdict = await classify_page(page, login_url, success_texts, failure_texts)
+            if verdict['state'] in outcomes:
+                return finish(outcomes[verdict['state']], verdict['evidence'])
+        else:
+            waiters.append(asyncio.ensure_future(
+                page.wait_for_url(left_login_page, wait_until='commit', timeout=remaining_ms)
+            ))
+        waiters.append(asyncio.ensure_future(page.wait_for_function(
+            LOGIN_OUTCOME_JS, arg=page_state_args(login_url, success_texts, failure_texts),
+            polling=100, timeout=remaining_ms
+        )))
+
+        done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        observer = waiters[-1]
+        if observer in done and observer.exception() is None:
+            verdict = await observer.result().json_value()
+            return finish(outcomes[verdict['state']], verdict['evidence'])
+        if not any(waiter.exception() is None for waiter in done):
+            # 导航导致执行上下文销毁等情况，稍后重新开始等待
+            await asyncio.sleep(0.1)
+
+    # 超时后做一次最终检查
+    verdict = await classify_page(page, login_url, success_texts, failure_texts)
+    if verdict['state'] == 'login_form':
+        return finish('login_form', "仍存在登录表单")
+    return finish('timeout', f"未能确认登录状态（{verdict['evidence']}）")
+
+def extract_session_cookie(cookies, cookie_name='sw110xy'):
+    """从上下文Cookie中提取续期请求使用的会话Cookie，返回 (Cookie字符串, cf_clearance Cookie)
+
+    cookie_name为站点配置的会话Cookie名称，找不到时尝试常见的会话Cookie。
+    """
+    # 尝试获取站点的会话cookie
+    session_cookie = next((c for c in cookies if c['name'] == cookie_name), None)
+
+    # 获取CloudFlare cookie
+    cf_clearance_cookie = next((c for c in cookies if c['name'] == 'cf_clearance'), None)
+
+    # 如果找不到站点的会话cookie，尝试获取其他可能的会话cookie
+    if not session_cookie:
+        # 尝试获取其他常见的会话cookie
+        session_cookies = [
+            next((c for c in cookies if c['name'] == 'PHPSESSID'), None),
+            next((c for c in cookies if c['name'] == 'laravel_session'), None),
+            next((c for c in cookies if c['name'] == 'session'), None),
+            next((c for c in cookies if 'session' in c['name'].lower()), None)
         ]
-        content_indicates_success = any(indicator.lower() in page_content for indicator in client_area_indicators)
 
-        # 检查是否仍有登录表单
-        login_form_exists = page.locator('form input[type="password"]').count() > 0
+        # 使用第一个非None的会话cookie
+        session_cookie = next((c for c in session_cookies if c is not None), None)
 
-        # 如果URL已改变或页面内容表明登录成功，且没有登录表单，则认为登录成功
-        if (url_changed or content_indicates_success) and not login_form_exists:
-            if url_changed:
-                print(f"URL已改变: {current_url}")
-            if content_indicates_success:
-                print(f"页面内容包含客户区域特征")
-            return True
-    except Exception as e:
-        print(f"检查登录状态时出错: {str(e)}")
+        if session_cookie:
+            logger.info("未找到%s cookie，使用替代会话cookie: %s", cookie_name, session_cookie['name'])
+            cookie_value = f"{session_cookie['name']}={session_cookie['value']};1"
+        else:
+            # 如果没有找到任何会话cookie，尝试使用所有cookie
+            logger.info("未找到任何会话cookie，使用所有cookie")
+            cookie_value = "; ".join([f"{c['name']}={c['value']}" for c in cookies])
+    else:
+        cookie_value = f"{session_cookie['name']}={session_cookie['value']};1"
+
+    return cookie_value, cf_clearance_cookie
+
+# 登录成功与失败的页面特征（与浏览器登录流程中的判断保持一致）
+CLIENT_AREA_INDICATORS = [
+    "client area", "客户中心", "用户中心", "控制面板",
+    "hosting plans", "support tickets", "active domains",
+    "free plan warning", "dashboard", "account"
+]
+LOGIN_FAILURE_TEXTS = ["密码错误", "用户名错误", "登录失败", "incorrect password", "invalid username"]
+
+# HTTP登录时用户名输入框的常见name
+USERNAME_FIELD_NAMES = ['username', 'email', 'user', 'login', 'account', 'name']
+
+# 出现这些标记说明页面需要执行JS验证，HTTP登录无法完成
+JS_CHALLENGE_MARKERS = ['g-recaptcha', 'h-captcha', 'hcaptcha', 'cf-turnstile', 'geetest', 'captcha']
+
+class HandoffToBrowser(Exception):
+    """HTTP登录遇到无法处理的页面（CloudFlare挑战、未知表单等），需要交给浏览器处理
+
+    structural表示站点的登录方式本身不适合HTTP（没有可解析的表单、需要验证码等），challenge表示遇到CloudFlare挑战；
+    两者都不是时多半是本次运行的偶然情况（例如某个账号的密码错误），不影响同站点其他账号使用HTTP登录。
+    """
+
+    def __init__(self, message, structural=False, challenge=False):
+        super().__init__(message)
+        self.structural = structural
+        self.challenge = challenge
+
+class LoginFormParser(HTMLParser):
+    """从登录页HTML中提取表单、输入框和CSRF令牌"""
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.csrf_token = None
+        self._current_form = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'form':
+            self._current_form = {
+                'action': attrs.get('action') or '',
+                'method': (attrs.get('method') or 'get').lower(),
+                'inputs': []
+            }
+            self.forms.append(self._current_form)
+        elif tag == 'input' and self._current_form is not None:
+            self._current_form['inputs'].append({
+                'name': attrs.get('name'),
+                'type': (attrs.get('type') or 'text').lower(),
+                'value': attrs.get('value') or '',
+                'checked': 'checked' in attrs
+            })
+        elif tag == 'meta' and attrs.get('name') in ('csrf-token', '_csrf', 'csrf_token'):
+            self.csrf_token = attrs.get('content')
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self._current_form = None
+
+def is_cloudflare_challenge(response):
+    """根据requests的响应判断是否为CloudFlare挑战页面"""
+    return is_challenge_response(response.status_code, response.headers, response.url)
+
+def find_login_form(html):
+    """找到包含密码输入框的表单，返回 (表单, CSRF令牌)，找不到时返回 (None, None)"""
+    parser = LoginFormParser()
+    parser.feed(html)
+    for form in parser.forms:
+        if any(i['type'] == 'password' for i in form['inputs']):
+            return form, parser.csrf_token
+    return None, None
+
+def build_login_payload(form, account):
+    """根据表单结构生成登录请求数据，无法识别用户名或密码输入框时抛出HandoffToBrowser"""
+    inputs = form['inputs']
+    password_field = next((i['name'] for i in inputs if i['type'] == 'password' and i['name']), None)
+    username_field = next((i['name'] for i in inputs
+                           if i['name'] and i['name'].lower() in USERNAME_FIELD_NAMES
+                           and i['type'] in ('text', 'email')), None)
+    if not username_field:
+        # 退而求其次，使用第一个文本或邮箱输入框
+        username_field = next((i['name'] for i in inputs if i['name'] and i['type'] in ('text', 'email')), None)
+    if not (username_field and password_field):
+        raise HandoffToBrowser("无法识别用户名或密码输入框", structural=True)
+
+    data = {}
+    for i in inputs:
+        if not i['name']:
+            continue
+        if i['type'] == 'hidden':
+            # 隐藏字段（包括_token等CSRF令牌）原样提交
+            data[i['name']] = i['value']
+        elif i['type'] == 'checkbox' and (i['checked'] or 'remember' in i['name'].lower()):
+            # 勾选"记住我"选项
+            data[i['name']] = i['value'] or 'on'
+    data[username_field] = account['username']
+    data[password_field] = account['password']
+    return data
+
+def check_http_login_result(response, login_url, profile=DEFAULT_SITE_PROFILE):
+    """按浏览器登录流程的规则判断HTTP登录结果，成功返回True，明确失败抛出异常，无法判断时抛出HandoffToBrowser"""
+    if is_cloudflare_challenge(response):
+        raise HandoffToBrowser("提交登录表单后遇到CloudFlare挑战", challenge=True)
+
+    page_content = response.text.lower()
+    failure_texts = profile.get('failureTexts') or LOGIN_FAILURE_TEXTS
+    success_texts = profile.get('successTexts') or CLIENT_AREA_INDICATORS
+    if any(text.lower() in page_content for text in failure_texts):
+        raise Exception("登录失败，检测到失败提示")
+
+    login_form, _ = find_login_form(response.text)
+    if login_form is not None:
+        # 仍存在登录表单，可能需要JS生成的字段，交给浏览器再试一次
+        raise HandoffToBrowser("提交后仍存在登录表单")
+
+    url_changed = login_url != response.url and "/login" not in response.url
+    if url_changed or any(indicator.lower() in page_content for indicator in success_texts):
+        return True
+    raise HandoffToBrowser("无法确定登录状态")
+
+def http_login(account):
+    """不启动浏览器，直接使用共享连接池的HTTP会话提交登录表单
+
+    成功时返回 (session, Cookie字符串, cf_clearance Cookie)；遇到CloudFlare挑战或无法识别的表单时抛出
+    HandoffToBrowser，由调用方改用浏览器登录；检测到明确的失败提示时抛出普通异常。
+    """
+    need_cookie = account.get('needCookie', 'renewApi' in account)
+    profile = get_site_profile(account)
+    login_url = f"{account['site']}{account['loginApi']}"
+    session = new_http_session({
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8'
+    })
+
+    # 带上同站点缓存的cf_clearance，已通过挑战的站点也可以直接使用HTTP登录
+    cf_clearance_cookie = get_clearance_cache().get(urlparse(account['site']).netloc)
+    if cf_clearance_cookie:
+        session.cookies.set('cf_clearance', cf_clearance_cookie['value'],
+                            domain=cf_clearance_cookie.get('domain'), path=cf_clearance_cookie.get('path', '/'))
+
+    logger.info("尝试使用HTTP方式登录 %s: %s", account['username'], login_url)
+    with span('login_nav'):
+        throttle_site_sync(login_url)
+        response = session.get(login_url, timeout=HTTP_TIMEOUT)
+        if is_cloudflare_challenge(response):
+            raise HandoffToBrowser("登录页面遇到CloudFlare挑战", challenge=True)
+        if response.status_code != 200:
+            raise HandoffToBrowser(f"登录页面返回状态码 {response.status_code}")
+        if any(marker in response.text.lower() for marker in JS_CHALLENGE_MARKERS):
+            raise HandoffToBrowser("登录页面包含验证码", structural=True)
+
+    with span('form_fill'):
+        form, csrf_token = find_login_form(response.text)
+        if form is None:
+            raise HandoffToBrowser("未找到登录表单", structural=True)
+        if form['method'] != 'post':
+            raise HandoffToBrowser("登录表单不是POST提交", structural=True)
+
+        data = build_login_payload(form, account)
+        headers = {'Referer': response.url, 'Origin': account['site'].rstrip('/')}
+        if csrf_token:
+            headers['X-CSRF-TOKEN'] = csrf_token
+
+    with span('submit_detect'):
+        action_url = urljoin(response.url, form['action'])
+        throttle_site_sync(action_url)
+        response = session.post(action_url, data=data, headers=headers, timeout=HTTP_TIMEOUT)
+        check_http_login_result(response, login_url, profile)
+    logger.info("账号 %s 通过HTTP方式登录成功", account['username'])
+
+    if not need_cookie:
+        return session, None, None
+
+    # 访问站点配置的会话页面（默认 /server/lxc）建立会话，与浏览器流程保持一致
+    session_url = warmup_url(account, profile)
+    if session_url:
+        with span('lxc_nav'):
+            throttle_site_sync(session_url)
+            response = session.get(session_url, timeout=HTTP_TIMEOUT)
+            if is_cloudflare_challenge(response):
+                raise HandoffToBrowser("服务器页面遇到CloudFlare挑战", challenge=True)
+            if "/login" in response.url:
+                raise HandoffToBrowser("访问服务器页面时被重定向到登录页")
+
+    with span('cookie_extract'):
+        cookie_value, cf_clearance_cookie = extract_session_cookie(session_cookies(session), profile['sessionCookie'])
+    return session, cookie_value, cf_clearance_cookie
+
+def session_cookies(session):
+    """将requests.Session中的Cookie转换为Playwright格式的Cookie列表"""
+    return [{
+        'name': c.name,
+        'value': c.value,
+        'domain': c.domain,
+        'path': c.path or '/',
+        'expires': c.expires if c.expires is not None else -1,
+        'httpOnly': bool(c.has_nonstandard_attr('HttpOnly')),
+        'secure': bool(c.secure),
+        'sameSite': 'Lax'
+    } for c in session.cookies]
+
+# 站点记为只能使用浏览器登录后，隔多久（秒）再尝试一次HTTP登录
+HTTP_RECHECK = float(os.environ.get('NETKEEP_HTTP_RECHECK', 24 * 3600))
+# 连续多少次HTTP登录遇到CloudFlare挑战后，才把站点记为只能使用浏览器登录
+HTTP_CHALLENGE_LIMIT = 3
+
+def use_http_login(account, default_mode='auto'):
+    """判断账号是否先尝试HTTP登录（账号配置loginMode优先：http / browser / auto）"""
+    mode = account.get('loginMode', default_mode)
+    if mode == 'browser':
+        return False
+    # 已确认无法使用HTTP登录的站点（记录在站点策略缓存中）直接使用浏览器，超过HTTP_RECHECK后再尝试一次HTTP登录
+    learned = get_strategy_cache().get(site_domain(account['site']), 'login')
+    if mode == 'auto' and learned.get('method') == 'browser' and time.time() - learned['method_at'] < HTTP_RECHECK:
+        return False
+    return True
+
+async def resume_http_session(account, session_store):
+    """HTTP登录前先检查缓存的会话，仍然有效时返回 (requests会话, 会话Cookie, cf_clearance Cookie)，否则返回None"""
+    storage_state = session_store.get(account['site'], account['username'])
+    if not storage_state:
+        return None
+    session = new_http_session()
+    status, detail = await asyncio.to_thread(check_session, account, storage_state, session)
+    if status != 'alive':
+        logger.info("账号 %s 的缓存会话不可用（%s），重新登录", account['username'], detail)
+        if status == 'expired':
+            session_store.delete(account['site'], account['username'])
+        return None
+    logger.info("账号 %s 的缓存会话仍然有效，跳过HTTP登录", account['username'])
+    with span('cookie_extract'):
+        cookie_value, cf_clearance_cookie = extract_session_cookie(session_cookies(session),
+                                                                   get_site_profile(account)['sessionCookie'])
+    return session, cookie_value, cf_clearance_cookie
+
+async def try_http_login(account):
+    """尝试HTTP登录，需要交给浏览器时返回None"""
+    domain = site_domain(account['site'])
+    cache = get_strategy_cache()
+    try:
+        result = await asyncio.to_thread(http_login, account)
+        cache.update(domain, 'login', method='http', http_challenges=0)
+        return result
+    except HandoffToBrowser as e:
+        logger.warning("HTTP登录无法完成（%s），改用浏览器登录", e)
+        if account.get('loginMode', 'auto') != 'auto':
+            return None
+        # 只有站点本身不适合HTTP登录（或反复遇到挑战）时才让同站点的账号都直接使用浏览器，
+        # 密码错误、偶然的挑战等单次情况不影响其他账号
+        if e.structural:
+            cache.update(domain, 'login', refresh=True, method='browser')
+        elif e.challenge:
+            challenges = cache.get(domain, 'login').get('http_challenges', 0) + 1
+            if challenges >= HTTP_CHALLENGE_LIMIT:
+                cache.update(domain, 'login', refresh=True, method='browser', http_challenges=0)
+            else:
+                cache.update(domain, 'login', http_challenges=challenges)
+        return None
+    except requests.RequestException as e:
+        logger.warning("HTTP登录请求出错（%s），改用浏览器登录", e)
+        return None
+
+# 检查登录是否成功
+async def check_login_success(page, login_url):
+    """检查是否登录成功：URL已改变或页面内容包含客户区域特征，且没有登录表单和失败提示"""
+    verdict = await classify_page(page, login_url)
+    if verdict['state'] == 'logged_in':
+        logger.info("%s", verdict['evidence'])
+        return True
+    logger.debug("登录状态: %s", verdict['evidence'])
     return False
 
-# 处理弹窗中的续期按钮
-def handle_popup_renew(page, account):
-    """处理可能出现的弹窗中的续期按钮"""
-    print("检查是否有弹窗续期按钮")
-
-    # 查找可能的弹窗元素
-    popup_selectors = [
-        '.modal-dialog',
-        '.modal-content',
-        '.popup',
-        '.dialog',
-        'div[role="dialog"]',
-        '.modal.show',
-        '.layui-layer',
-        '.layui-layer-content'
+# 可能的弹窗元素
+POPUP_SELECTORS = [
+    '.modal-dialog',
+    '.modal-content',
+    '.popup',
+    '.dialog',
+    'div[role="dialog"]',
+    '.modal.show',
+    '.layui-layer',
+    '.layui-layer-content'
+]
+POPUP_SELECTOR = ', '.join(POPUP_SELECTORS)
+
+# 在页面内一次性检查所有候选按钮：按候选规则的先后打分，属性关键词作为兜底，
+# 匹配到的元素加上data-netkeep-probe标记，返回按分数排序的列表（分数相同时可见的优先）
+BUTTON_PROBE_JS = """(rules) => {
+    document.querySelectorAll('[data-netkeep-probe]').forEach(el => el.removeAttribute('data-netkeep-probe'));
+    const scopes = rules.scope ? Array.from(document.querySelectorAll(rules.scope)) : [document];
+    const textOf = el => (el.innerText || el.textContent || el.value || '').trim();
+    const isVisible = el => !!(el.offsetWidth || el.offsetHeight || el.getClientRects().length);
+    const found = new Map();
+    const consider = (el, score, reason, rule) => {
+        const previous = found.get(el);
+        if (!previous || previous.score < score) found.set(el, {score, reason, rule});
+    };
+    for (const scope of scopes) {
+        rules.candidates.forEach((candidate, i) => {
+            const score = (rules.candidates.length - i) * 10;
+            for (const el of scope.querySelectorAll(candidate.selector)) {
+                const text = textOf(el);
+                if (candidate.texts && !candidate.texts.some(t => text.includes(t))) continue;
+                consider(el, score, candidate.texts ? `${candidate.selector} "${candidate.texts.join('|')}"` : candidate.selector, i);
+            }
+        });
+        if (rules.attrKeywords) {
+            for (const el of scope.querySelectorAll(rules.attrSelector || 'button')) {
+                const attrs = [el.id, String(el.className), ...Object.entries(el.dataset).map(([k, v]) => `${k}=${v}`)]
+                    .join(' ').toLowerCase();
+                if (rules.attrKeywords.some(k => attrs.includes(k))) consider(el, 1, 'attributes', -1);
+            }
+        }
+    }
+    const matches = Array.from(found, ([el, m]) => ({el, ...m, visible: isVisible(el)}));
+    matches.sort((a, b) => (b.score - a.score) || (b.visible - a.visible));
+    return {
+        scopes: rules.scope ? scopes.length : null,
+        matches: matches.slice(0, rules.limit || 5).map((m, i) => {
+            m.el.setAttribute('data-netkeep-probe', String(i));
+            return {probe: i, score: m.score, reason: m.reason, rule: m.rule, visible: m.visible,
+                    tag: m.el.tagName.toLowerCase(), id: m.el.id, text: textOf(m.el).slice(0, 40)};
+        })
+    };
+}"""
+
+# 续期按钮的候选规则，越靠前优先级越高
+RENEW_BUTTON_RULES = {
+    'candidates': [
+        {'selector': 'button#submitRenew'},
+        {'selector': 'button#submitrenew'},
+        {'selector': 'button', 'texts': ['点击续费']},
+        {'selector': 'button[type="submit"]'},
+        {'selector': 'button.btn-primary'},
+        {'selector': 'button', 'texts': ['续期', '续费', '延期', '增加时长']},
+        {'selector': 'a', 'texts': ['续期', '续费', '延期', '增加时长']},
+        {'selector': '#submit-renew, #btnRenew, #btnSubmit'}
+    ],
+    'attrKeywords': ['renew', 'submit', '续费', '续期']
+}
+
+# 弹窗内续期/确认按钮的候选规则
+POPUP_BUTTON_RULES = {
+    'scope': POPUP_SELECTOR,
+    'candidates': [
+        {'selector': 'button#submitRenew'},
+        {'selector': 'button', 'texts': ['点击续费']},
+        {'selector': 'button', 'texts': ['续期']},
+        {'selector': 'a', 'texts': ['续期']},
+        {'selector': 'button', 'texts': ['续费']},
+        {'selector': 'a', 'texts': ['续费']},
+        {'selector': 'button', 'texts': ['确定']},
+        {'selector': 'button', 'texts': ['确认']},
+        {'selector': 'button.btn-primary'},
+        {'selector': 'button.btn-success'},
+        {'selector': 'button[type="submit"]'},
+        {'selector': 'input[type="submit"]'},
+        # layui弹窗的按钮是a标签
+        {'selector': '.layui-layer-btn0'}
+    ]
+}
+
+# 续期后确认对话框按钮的候选规则
+CONFIRM_BUTTON_RULES = {
+    'candidates': [
+        {'selector': 'button', 'texts': ['确定']},
+        {'selector': 'button', 'texts': ['确认']},
+        {'selector': 'button.btn-confirm'}
     ]
+}
+
+def profile_button_rules(selector, rules):
+    """站点配置指定了按钮选择器时只使用它（保留弹窗范围），否则使用通用候选规则"""
+    if not selector:
+        return rules
+    configured = {'candidates': [{'selector': selector}]}
+    if 'scope' in rules:
+        configured['scope'] = rules['scope']
+    return configured
+
+async def probe_buttons(page, rules, preferred=None):
+    """一次evaluate找出所有符合规则的按钮，返回 {'scopes': 弹窗数量或None, 'matches': [按优先级排序的匹配]}
+
+    preferred为该站点上次成功的候选规则，会被放到最前面；每个匹配的candidate字段是命中的候选规则。
+    """
+    rules = {**rules, 'candidates': prefer_first(rules['candidates'], preferred)}
+    probe = await page.evaluate(BUTTON_PROBE_JS, rules)
+    for match in probe['matches']:
+        match['candidate'] = rules['candidates'][match['rule']] if match['rule'] >= 0 else None
+    return probe
+
+async def click_probe_match(page, match):
+    """点击probe_buttons返回的匹配元素：先用JavaScript点击，失败时使用Playwright点击"""
+    selector = f'[data-netkeep-probe="{match["probe"]}"]'
+    try:
+        clicked = await page.evaluate('(s) => { const el = document.querySelector(s); if (el) el.click(); return !!el; }',
+                                      selector)
+    except Exception as e:
+        logger.warning("JavaScript点击失败: %s", e)
+        clicked = False
+    if not clicked:
+        await page.locator(selector).first.click()
 
-    popup_found = False
-    for selector in popup_selectors:
-        selector_count = page.locator(selector).count()
-
-        if selector_count > 0:
-            popup_found = True
-
-            # 在弹窗中查找续期按钮
-            popup_renew_selectors = [
-                'button#submitRenew',  # 特定ID
-                'button:has-text("点击续费")',  # 特定文本
-                'button:has-text("续期")',
-                'a:has-text("续期")',
-                'button:has-text("续费")',
-                'a:has-text("续费")',
-                'button:has-text("确定")',
-                'button:has-text("确认")',
-                'button.btn-primary',
-                'button.btn-success',
-                'button[type="submit"]',
-                'input[type="submit"]'
-            ]
+# 处理弹窗中的续期按钮
+async def handle_popup_renew(page, account, preferred=None, selector=None):
+    """处理可能出现的弹窗中的续期按钮，返回点击的匹配（未处理时返回None）
+
+    selector为站点配置的弹窗按钮，指定时只使用它，忽略记住的候选规则preferred。
+    """
+    logger.info("检查是否有弹窗续期按钮")
+
+    probe = await probe_buttons(page, profile_button_rules(selector, POPUP_BUTTON_RULES),
+                                None if selector else preferred)
+    if not probe['scopes']:
+        logger.info("未找到弹窗元素")
+        return None
+    if not probe['matches']:
+        logger.info("未找到弹窗中的可点击按钮")
+        return None
+
+    match = probe['matches'][0]
+    logger.info("点击弹窗中的续期按钮: %s", match['reason'])
+    await click_probe_match(page, match)
+    await wait_dom_quiet(page, 'popup_click')
+    logger.info("成功处理弹窗中的按钮")
+    return match
+
+def parse_renew_body(body):
+    """解析续期参数字符串（格式: "month=1&coupon_id=0&submit=1"），数字字符串转换为数字"""
+    data = {}
+    for param in body.split('&'):
+        if '=' in param:
+            key, value = param.split('=', 1)
+            data[key] = int(value) if value.isdigit() else value
+    return data
+
+def check_renew_response(result, shape):
+    """按站点配置的响应格式判断续期结果：成功返回True，明确失败返回False，无法判断返回None
+
+    shape中codeField为状态码字段，successCodes为表示成功的状态码（0通常表示成功，1可能表示部分成功或特殊情况）。
+    """
+    if not isinstance(result, dict):
+        return None
+    code_field = shape.get('codeField', 'code')
+    if code_field in result:
+        return result[code_field] in shape.get('successCodes', [0, 1])
+    if result.get('success'):
+        return True
+    return None
+
+def normalize_renew_result(result, shape):
+    """把站点自定义的状态码和消息字段统一为code和msg，便于生成通知"""
+    code_field = shape.get('codeField', 'code')
+    message_field = shape.get('messageField', 'msg')
+    if code_field in result and message_field in result:
+        return {**result, 'code': result[code_field], 'msg': result[message_field]}
+    return result
+
+def renew_via_api(account, cookie, cf_clearance_cookie=None, session=None):
+    """直接调用续期API（同步），成功时返回响应结果，失败时抛出异常
+
+    session为HTTP登录得到的会话时直接复用其Cookie Jar，否则新建会话并载入Cookie字符串。
+    """
+    with span('api_renew'):
+        profile = get_site_profile(account)
+        renew_url = f"{account['site']}{account['renewApi']}"
+
+        # 没有cf_clearance时使用同站点缓存的
+        if not cf_clearance_cookie:
+            cf_clearance_cookie = get_clearance_cache().get(urlparse(account['site']).netloc)
+
+        # 会话的User-Agent与浏览器一致（cf_clearance与User-Agent绑定）
+        if session is None:
+            session = new_http_session()
+            load_cookie_header(session, cookie, renew_url)
+
+        # 如果有CloudFlare cookie，放入Cookie Jar
+        if cf_clearance_cookie:
+            session.cookies.set('cf_clearance', cf_clearance_cookie['value'],
+                                domain=cf_clearance_cookie.get('domain') or urlparse(renew_url).hostname,
+                                path=cf_clearance_cookie.get('path', '/'))
+
+        # 构建API请求头
+        headers = {
+            'Referer': warmup_url(account, profile) or renew_url,
+            'Accept': 'application/json, text/javascript, */*; q=0.01',
+            'X-Requested-With': 'XMLHttpRequest',
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
 
-            # 尝试点击弹窗中的续期按钮
-            popup_button_found = False
+        # 构建请求参数
+        if 'renewBody' in account and account['renewBody']:
+            # 解析用户提供的body参数字符串 (格式: "month=1&coupon_id=0&submit=1")
+            data = parse_renew_body(account['renewBody'])
+        else:
+            logger.warning("未在配置中找到renewBody参数，使用站点配置 %s 的默认参数", profile['name'])
+            data = {}
+            # 尝试从renewApi中提取ID
+            id_match = re.search(r'/(\d+)/renew', account['renewApi'])
+            if id_match:
+                data['id'] = id_match.group(1)
+            data.update(parse_renew_body(profile['renewBody']))
+
+        # 发送API请求 (使用POST方法) - 不输出详细信息
+        throttle_site_sync(renew_url)
+        response = session.post(renew_url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
+
+        # 检查响应
+        if response.status_code == 200:
+            try:
+                # 尝试解析JSON响应
+                result = response.json()
+            except json.JSONDecodeError:
+                # 如果响应不是JSON格式，检查是否包含成功文本
+                response_text = response.text
 
-            # 首先通过选择器查找
-            for btn_selector in popup_renew_selectors:
-                full_selector = f"{selector} {btn_selector}"
-                btn_count = page.locator(full_selector).count()
+                if "续期成功" in response_text or "已续期" in response_text or "操作成功" in response_text:
+                    # 不输出详细的API响应信息
+                    return {"success": True, "text": response_text}
+                else:
+                    logger.info("API续期响应不包含成功文本: %s", response_text)
+                    raise Exception("API续期响应不包含成功文本")
+
+            # 按站点配置的响应格式检查是否包含成功指示
+            verdict = check_renew_response(result, profile['response'])
+            if verdict is True:
+                # 不输出详细的API响应信息
+                return normalize_renew_result(result, profile['response'])
+            elif verdict is False:
+                logger.info("API续期返回非成功状态码: %s", result)
+                raise Exception(f"API续期失败: {result}")
+            else:
+                logger.info("API续期响应不包含成功指示")
+                raise Exception("API续期响应不包含成功指示")
+        else:
+            logger.warning("API续期请求失败，状态码: %s", response.status_code)
+            raise Exception(f"API续期请求失败，状态码: {response.status_code}")
+
+async def click_renew_buttons(page, account, learned):
+    """点击续期按钮并处理弹窗和确认对话框，返回实际命中的 (续期按钮候选规则, 弹窗按钮候选规则)
+
+    站点配置指定了按钮选择器时直接使用，否则按通用候选规则探测，并优先尝试记住的规则。
+    """
+    profile = get_site_profile(account)
+    # 查找并点击续期按钮
+    renew_button_found = False
+    button_candidate = popup_candidate = None
+
+    # 一次evaluate检查所有候选选择器、按钮文本和属性；站点配置了按钮时不再把记住的通用规则排在前面
+    probe = await probe_buttons(page, profile_button_rules(profile.get('renewButton'), RENEW_BUTTON_RULES),
+                                None if profile.get('renewButton') else learned.get('button'))
+    if probe['matches']:
+        match = probe['matches'][0]
+        logger.info("找到续期按钮: %s（共 %s 个候选）", match['reason'], len(probe['matches']))
+        logger.debug("续期按钮候选: %s", probe['matches'])
+        await click_probe_match(page, match)
+        renew_button_found = True
+        button_candidate = match['candidate']
+
+        # 等待弹窗出现（最多3秒）
+        await wait_selector(page, POPUP_SELECTOR, 'renew_popup', timeout=3)
+        logger.info("点击续期按钮后，检查是否出现弹窗")
+
+        # 检查是否出现弹窗，并处理弹窗中的续期按钮
+        popup_match = await handle_popup_renew(page, account, learned.get('popup'), profile.get('popupButton'))
+        if popup_match:
+            popup_candidate = popup_match['candidate']
+            logger.info("已处理弹窗中的续期按钮")
+        else:
+            logger.warning("未检测到弹窗或弹窗处理失败")
+
+    if not renew_button_found:
+        logger.debug("未找到续期按钮")
+        raise Exception("未找到续期按钮")
+
+    # 记录所有可见的确认按钮（仅调试时收集，避免额外的浏览器往返）
+    if logger.isEnabledFor(logging.DEBUG):
+        all_confirm_buttons = await page.evaluate('''() =>
+            Array.from(document.querySelectorAll('button, input[type="submit"]'))
+                .map(el => ({tag: el.tagName.toLowerCase(), text: el.textContent || el.value}))''')
+        logger.debug("页面上的所有确认按钮元素: %s", all_confirm_buttons)
+
+    # 检查是否有确认对话框
+    confirm_button_found = False
+    probe = await probe_buttons(page, profile_button_rules(profile.get('confirmButton'), CONFIRM_BUTTON_RULES))
+    if probe['matches']:
+        await click_probe_match(page, probe['matches'][0])
+        confirm_button_found = True
+        await wait_dom_quiet(page, 'confirm_click')
+        logger.debug("点击确认按钮后: %s", probe['matches'][0]['reason'])
+
+    if confirm_button_found:
+        logger.info("已点击确认按钮")
+    else:
+        logger.info("未找到确认按钮")
+
+    return button_candidate, popup_candidate
+
+# 在页面内提取续期结果：layui弹窗消息、包含状态码和消息字段的JSON和成功文本，
+# 同时用页面状态分类器判断会话是否已失效，只把提取到的片段传回Python。
+# 只匹配页面上显示的文本（innerText），脚本和样式中的"success"之类的字样不算续期结果
+RENEW_RESULT_JS = f"""(args) => {{
+    const text = (document.body ? document.body.innerText : '').toLowerCase();
+    const escape = value => value.replace(/[.*+?^${{}}()|[\\]\\\\]/g, '\\\\$&');
+    const layer = document.querySelector('.layui-layer-content');
+    const json = text.match(new RegExp(
+        `(\\\\{{[\\\\s\\\\S]*?"${{escape(args.codeField)}}"[\\\\s\\\\S]*?"${{escape(args.messageField)}}"[\\\\s\\\\S]*?\\\\}})`));
+    return {{
+        layui: layer ? layer.innerText.trim().toLowerCase() : null,
+        json: json ? json[1] : null,
+        success: args.successTexts.find(t => text.includes(t)) || null,
+        page: ({PAGE_STATE_JS})(args),
+    }};
+}}"""
+
+# 续期后页面上表示成功的文本
+RENEW_SUCCESS_TEXTS = ["续期成功", "已续期", "操作成功", "success"]
+
+async def read_renew_result(page, renew_url, shape=DEFAULT_SITE_PROFILE['response'], dialogs=()):
+    """从点击后的页面中读取续期结果，未检测到成功信息时抛出异常
+
+    shape为站点配置的响应格式，dialogs为续期过程中页面弹出的alert消息。
+    """
+    code_field = shape.get('codeField', 'code').lower()
+    message_field = shape.get('messageField', 'msg').lower()
+    args = page_state_args(None)
+    found = await page.evaluate(RENEW_RESULT_JS, {
+        **args, 'codeField': code_field, 'messageField': message_field,
+        'successTexts': [t.lower() for t in RENEW_SUCCESS_TEXTS],
+    })
+    logger.debug("续期操作后页面: %s", found)
+
+    # 首先使用layui-layer-content中的消息（基于调试日志中发现的结构）
+    msg_text = found['layui']
+    if msg_text:
+        logger.debug("找到弹窗消息: %s", msg_text)
+
+        # 检查消息内容是否包含特定文本
+        if "请在到期前" in msg_text and "天后再续费" in msg_text:
+            logger.debug("续期结果: %s", msg_text)
+            return {"code": 1, "msg": msg_text, "success": True}
+        elif "续期成功" in msg_text or "续费成功" in msg_text or "操作成功" in msg_text:
+            logger.debug("续期成功: %s", msg_text)
+            return {"code": 0, "msg": msg_text, "success": True}
+        else:
+            logger.debug("续期结果: %s", msg_text)
+            return {"code": 1, "msg": msg_text, "success": True}
 
-                if btn_count > 0:
+    # 如果没有找到layui消息，尝试使用JSON格式的响应
+    response_text = found['json']
+    if response_text:
+        logger.debug("找到JSON响应: %s", response_text)
+        try:
+            response_json = json.loads(response_text)
+            code = response_json.get(code_field, None)
+            msg = response_json.get(message_field, '')
+
+            # 检查code是否为站点配置的成功状态码（默认0或1，通常0表示成功，1可能表示部分成功或特殊情况）
+            if code in shape.get('successCodes', [0, 1]):
+                logger.debug("API续期成功: code: %s, msg: %s", code, msg)
+                return {"code": code, "msg": msg, "success": True}
+            else:
+                logger.debug("API响应状态码不表示成功: code: %s, msg: %s", code, msg)
+                # 尝试导航到续期页面查看结果
+                try:
+                    await page.goto(renew_url, wait_until='networkidle', timeout=12000)
+                    logger.debug("续期后页面状态")
+                except:
+                    pass
 
-                    try:
-                        # 尝试使用JavaScript点击
-                        page.evaluate(f'document.querySelector("{full_selector}").click()')
-                        print("使用JavaScript点击弹窗中的续期按钮")
-                    except Exception as e:
-                        print(f"JavaScript点击弹窗按钮失败: {str(e)}")
-                        # 如果JavaScript点击失败，使用Playwright点击
-                        page.locator(full_selector).first.click()
-                        print("使用Playwright点击弹窗中的续期按钮")
-
-                    popup_button_found = True
-                    time.sleep(3)
-                    print("点击弹窗中的续期按钮后")
-                    break
-
-            # 如果通过选择器未找到按钮，尝试更全面的方法查找
-            if not popup_button_found:
-
-                # 在弹窗中查找所有按钮的文本内容
-                popup_buttons = page.locator(f"{selector} button").all()
-                for button in popup_buttons:
-                    try:
-                        text = button.text_content().strip()
+                return {"code": code, "msg": msg, "success": False}
+        except (json.JSONDecodeError, AttributeError):
+            logger.debug("无法解析JSON响应: %s", response_text)
 
-                        if '续费' in text or '续期' in text or '确定' in text or '确认' in text or '点击续费' in text:
+    # 尝试使用页面实际弹出的alert消息
+    if dialogs:
+        logger.debug("找到alert消息: %s", dialogs[-1])
+        return {"code": 1, "msg": dialogs[-1], "success": True}
 
-                            button.click()
-                            popup_button_found = True
-                            time.sleep(3)
-                            print("点击弹窗文本匹配按钮后")
-                            break
-                    except Exception as e:
-                        print(f"检查弹窗按钮文本时出错: {str(e)}")
+    # 如果无法提取消息，使用传统方法检查成功文本
+    if found['success']:
+        logger.debug("检测到成功信息: '%s'", found['success'])
+        logger.debug("续期成功")
+        return {"success": True, "text": "续期成功"}
 
-            if popup_button_found:
-                print("成功处理弹窗中的按钮")
-                return True
-            else:
-                print("未找到弹窗中的可点击按钮")
+    logger.debug("未检测到续期成功信息")
+    if found['page']['state'] in ('login_form', 'challenge'):
+        raise Exception(f"未检测到续期成功信息（{found['page']['evidence']}）")
+    raise Exception("未检测到续期成功信息")
 
-    if not popup_found:
-        print("未找到弹窗元素")
+async def renew_via_page(page, account, renew_url, learned=None):
+    """方法1: 直接访问续期页面并点击续期按钮，返回 (续期结果, 续期按钮候选规则, 弹窗按钮候选规则)
 
-    return False
+    learned为该站点记住的renew策略，其中的按钮候选规则会被优先尝试。
+    """
+    learned = learned or {}
+    # 记录续期过程中弹出的alert并关闭，面板常用alert显示续期结果
+    dialogs = []
+
+    def on_dialog(dialog):
+        dialogs.append(dialog.message)
+        asyncio.ensure_future(dialog.accept())
+
+    page.on('dialog', on_dialog)
+    try:
+        with span('browser_renew'):
+            logger.info("方法1: 直接访问续期页面 %s", renew_url)
+            await navigate(page, renew_url, wait_until='networkidle', timeout=12000, challenge_timeout=60)
+            button_candidate, popup_candidate = await click_renew_buttons(page, account, learned)
+            result = await read_renew_result(page, renew_url, get_site_profile(account)['response'], dialogs)
+    finally:
+        page.remove_listener('dialog', on_dialog)
+    return result, button_candidate, popup_candidate
 
-def renew_vps(account, context, cookie, cf_clearance_cookie=None, max_retries=2):
-    page = context.new_page()
+async def renew_vps(account, context, cookie, cf_clearance_cookie=None, max_retries=2, try_api=True):
+    profile = get_site_profile(account)
+    page = await context.new_page()
 
     try:
         for attempt in range(max_retries):
             try:
-                # 导航到服务器列表页面
-                print(f"尝试 {attempt + 1}/{max_retries}: 导航到 {account['site']}/server/lxc 页面...")
-                page.goto(f"{account['site']}/server/lxc", wait_until='networkidle', timeout=12000)  # 使用networkidle等待所有网络请求完成
-
-                # 等待页面完全加载，处理可能的CloudFlare挑战
-                print(f"等待5秒，确保页面完全加载并处理CloudFlare挑战...")
-                time.sleep(5)
-
-                # 检查是否遇到CloudFlare挑战页面
-                if "Just a moment" in page.content() or "Checking your browser" in page.content():
-                    print("检测到CloudFlare挑战页面，等待挑战完成...")
-                    # 等待更长时间让CloudFlare挑战完成
-                    for _ in range(12):  # 最多等待
-                        time.sleep(5)
-                        if "Just a moment" not in page.content() and "Checking your browser" not in page.content():
-                            print("CloudFlare挑战已完成，继续执行...")
-                            break
-
-                    # 如果仍然在CloudFlare页面，尝试刷新
-                    if "Just a moment" in page.content() or "Checking your browser" in page.content():
-                        print("CloudFlare挑战仍未完成，尝试刷新页面...")
-                        page.reload(wait_until='networkidle', timeout=12000)
-                        time.sleep(5)
+                # 导航到站点配置的服务器列表页面（默认 /server/lxc）
+                session_url = warmup_url(account, profile)
+                if session_url:
+                    logger.info("尝试 %s/%s: 导航到 %s 页面...", attempt + 1, max_retries, session_url)
+                    # 使用networkidle等待所有网络请求完成，遇到CloudFlare挑战时等待挑战完成后立即继续
+                    with span('lxc_nav'):
+                        await navigate(page, session_url, wait_until='networkidle', timeout=12000,
+                                       challenge_timeout=60, reload_wait_until='networkidle')
 
                 # 获取续期URL
                 renew_url = f"{account['site']}{account['renewApi']}"
-                print(f"账号 {account['username']} 的续期URL: {renew_url}")
-
-                # 方法2: 使用API请求续期（优先使用）
-                try:
-                    # 不输出详细的API请求信息
-
-                    # 构建API请求头
-                    headers = {
-                        'Cookie': cookie,
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                        'Referer': f"{account['site']}/server/lxc",
-                        'Accept': 'application/json, text/javascript, */*; q=0.01',
-                        'X-Requested-With': 'XMLHttpRequest',
-                        'Content-Type': 'application/x-www-form-urlencoded'
-                    }
-
-                    # 如果有CloudFlare cookie，添加到请求头
-                    if cf_clearance_cookie:
-                        headers['Cookie'] += f"; cf_clearance={cf_clearance_cookie['value']}"
-
-                    # 构建请求参数
-                    data = {}
-
-                    # 检查账号配置中是否有renewBody参数
-                    if 'renewBody' in account and account['renewBody']:
-                        # 解析用户提供的body参数字符串 (格式: "month=1&coupon_id=0&submit=1")
-                        try:
-                            body_params = account['renewBody'].split('&')
-                            for param in body_params:
-                                if '=' in param:
-                                    key, value = param.split('=', 1)
-                                    # 尝试将数字字符串转换为数字
-                                    if value.isdigit():
-                                        data[key] = int(value)
-                                    else:
-                                        data[key] = value
-                            # 不输出详细的参数信息
-                        except Exception as e:
-                            print(f"解析续期参数时出错: {str(e)}，使用默认参数")
-                            # 使用默认参数
-                            data['month'] = 1
-                            data['coupon_id'] = 0
-                            data['submit'] = 1
-                    else:
-                        print("警告: 未在配置中找到renewBody参数，使用默认参数")
-                        # 尝试从renewApi中提取ID
-                        try:
-                            import re
-                            id_match = re.search(r'/(\d+)/renew', account['renewApi'])
-                            account_id = id_match.group(1) if id_match else None
-                            if account_id:
-                                data['id'] = account_id
-                        except:
-                            pass
-
-                        # 使用默认参数
-                        data['month'] = 1
-                        data['coupon_id'] = 0
-                        data['submit'] = 1
-
-                    # 发送API请求 (使用POST方法) - 不输出详细信息
-                    response = requests.post(renew_url, headers=headers, data=data)
-
-                    # 检查响应
-                    if response.status_code == 200:
-                        try:
-                            # 尝试解析JSON响应
-                            result = response.json()
-
-                            # 检查响应中是否包含成功指示
-                            if 'code' in result:
-                                if result['code'] == 0 or result['code'] == 1:
-                                    # 不输出详细的API响应信息
-                                    return result
-                                else:
-                                    print(f"API续期返回非成功状态码: {result}")
-                                    raise Exception(f"API续期失败: {result}")
-                            elif 'success' in result and result['success']:
-                                # 不输出详细的API响应信息
-                                return result
-                            else:
-                                print(f"API续期响应不包含成功指示")
-                                raise Exception(f"API续期响应不包含成功指示")
-                        except json.JSONDecodeError:
-                            # 如果响应不是JSON格式，检查是否包含成功文本
-                            response_text = response.text
-
-                            if "续期成功" in response_text or "已续期" in response_text or "操作成功" in response_text:
-                                # 不输出详细的API响应信息
-                                return {"success": True, "text": response_text}
-                            else:
-                                print(f"API续期响应不包含成功文本: {response_text}")
-                                raise Exception(f"API续期响应不包含成功文本")
-                    else:
-                        print(f"API续期请求失败，状态码: {response.status_code}")
-                        raise Exception(f"API续期请求失败，状态码: {response.status_code}")
-                except Exception as e:
-                    print(f"方法2失败: {str(e)}，尝试方法1...")
+                logger.info("账号 %s 的续期URL: %s", account['username'], renew_url)
+
+                # 站点配置指定了续期方式时只使用该方式；否则按该站点记住的续期方式排序：
+                # 方法2（API请求）默认优先，记住页面方式时先走方法1
+                domain = site_domain(account['site'])
+                learned = get_strategy_cache().get(domain, 'renew')
+                if profile.get('renewMethod'):
+                    methods = [profile['renewMethod']]
+                elif not try_api:
+                    methods = ['page']
+                elif learned.get('method') == 'page':
+                    methods = ['page', 'api']
+                else:
+                    methods = ['api', 'page']
 
-                # 方法1: 直接访问续期页面并点击续期按钮
-                try:
-                    print(f"方法1: 直接访问续期页面 {renew_url}")
-
-                    page.goto(renew_url, wait_until='networkidle', timeout=12000)
-
-                    # 等待页面加载
-                    time.sleep(5)
-
-                    # 检查是否遇到CloudFlare挑战页面
-                    if "Just a moment" in page.content() or "Checking your browser" in page.content():
-                        print("续期页面遇到CloudFlare挑战，等待挑战完成...")
-                        # 等待更长时间让CloudFlare挑战完成
-                        for _ in range(12):  # 最多等待30秒
-                            time.sleep(5)
-                            if "Just a moment" not in page.content() and "Checking your browser" not in page.content():
-                                print("CloudFlare挑战已完成，继续执行...")
-                                break
-
-                    # 查找并点击续期按钮
-                    renew_button_found = False
-
-                    # 使用更简洁的选择器策略
-                    selectors = [
-                        # 首先尝试特定ID和文本
-                        'button#submitRenew',  # 特定ID（大写R）
-                        'button#submitrenew',  # 特定ID（小写r，以防万一）
-                        'button:has-text("点击续费")',  # 特定文本
-
-                        # 然后尝试通用的提交按钮
-                        'button[type="submit"]',  # 通用提交按钮
-                        'button.btn-primary',  # 主要按钮
-
-                        # 然后尝试包含特定文本的按钮
-                        'button:has-text("续期")',
-                        'button:has-text("续费")',
-                        'button:has-text("延期")',
-                        'button:has-text("增加时长")',
-
-                        # 最后尝试链接
-                        'a:has-text("续期")',
-                        'a:has-text("续费")',
-                        'a:has-text("延期")',
-                        'a:has-text("增加时长")'
-                    ]
-
-                    # 不再记录所有可见元素
-
-                    # 不再添加重复的选择器
-
-                    for selector in selectors:
-                        button_count = page.locator(selector).count()
-
-                        if button_count > 0:
-                            print(f"找到续期按钮: {selector}")
-
-                            try:
-                                # 尝试使用JavaScript点击
-                                page.evaluate(f'document.querySelector("{selector}").click()')
-                                print("使用JavaScript点击续期按钮")
-                            except Exception as e:
-                                print(f"JavaScript点击失败: {str(e)}")
-                                # 如果JavaScript点击失败，使用Playwright点击
-                                page.locator(selector).first.click()
-                                print("使用Playwright点击续期按钮")
-
-                            renew_button_found = True
-                            # 等待页面响应
-                            time.sleep(3)
-                            print("点击续期按钮后，检查是否出现弹窗")
-
-                            # 检查是否出现弹窗，并处理弹窗中的续期按钮
-                            popup_handled = handle_popup_renew(page, account)
-                            if popup_handled:
-                                print("已处理弹窗中的续期按钮")
-                            else:
-                                print("未检测到弹窗或弹窗处理失败")
-
-                            break
-
-                    # 如果通过选择器未找到按钮，尝试更全面的方法查找
-                    if not renew_button_found:
-
-                        # 1. 检查所有按钮的文本内容
-                        debug_info("1. 检查所有按钮的文本内容", account=account)
-                        buttons = page.locator('button').all()
-                        for button in buttons:
-                            try:
-                                text = button.text_content().strip()
-                                debug_info(f"检查按钮文本: '{text}'", account=account, step_name="check_button_text")
-                                if '续费' in text or '续期' in text or '点击续费' in text:
-                                    button.click()
-                                    renew_button_found = True
-                                    time.sleep(3)
-                                    debug_info("点击文本匹配的按钮后", account=account, step_name="after_text_click")
-                                    break
-                            except Exception as e:
-                                debug_info(f"检查按钮文本时出错: {str(e)}", account=account, step_name="text_check_error")
-
-                        # 2. 如果仍未找到，检查所有按钮的ID和类
-                        if not renew_button_found:
-                            debug_info("2. 检查所有按钮的ID和类", account=account)
-                            try:
-                                # 使用JavaScript获取所有按钮的ID和类
-                                button_attrs = page.evaluate('''() => {
-                                    const buttons = Array.from(document.querySelectorAll('button'));
-                                    return buttons.map(btn => ({
-                                        id: btn.id,
-                                        class: btn.className,
-                                        type: btn.type,
-                                        text: btn.textContent.trim(),
-                                        dataAttrs: Object.keys(btn.dataset).map(key => `data-${key}=${btn.dataset[key]}`)
-                                    }));
-                                }''')
-
-                                debug_info(f"页面上的按钮属性: {button_attrs}", account=account)
-
-                                # 查找包含"renew"、"submit"等关键词的按钮
-                                for i, attrs in enumerate(button_attrs):
-                                    btn_id = attrs.get('id', '').lower()
-                                    btn_class = attrs.get('class', '').lower()
-                                    btn_text = attrs.get('text', '').lower()
-                                    btn_data = ' '.join(attrs.get('dataAttrs', [])).lower()
-
-                                    if ('renew' in btn_id or 'submit' in btn_id or
-                                        'renew' in btn_class or 'submit' in btn_class or
-                                        '续费' in btn_text or '续期' in btn_text or '点击续费' in btn_text or
-                                        'renew' in btn_data or '续费' in btn_data):
-
-                                        debug_info(f"通过属性找到可能的续期按钮: {attrs}", account=account)
-                                        # 使用JavaScript点击这个按钮
-                                        page.evaluate(f'document.querySelectorAll("button")[{i}].click()')
-                                        renew_button_found = True
-                                        time.sleep(3)
-                                        debug_info("点击属性匹配的按钮后", account=account)
-                                        break
-                            except Exception as e:
-                                debug_info(f"检查按钮属性时出错: {str(e)}", account=account)
-
-                        # 3. 如果仍未找到，尝试直接点击submitRenew按钮
-                        if not renew_button_found:
-                            debug_info("3. 尝试直接点击submitRenew按钮", account=account)
-                            try:
-                                # 尝试直接使用JavaScript查找并点击submitRenew按钮
-                                clicked = page.evaluate('''() => {
-                                    // 尝试多种可能的ID
-                                    const ids = ['submitRenew', 'submitrenew', 'submit-renew', 'btnRenew', 'btnSubmit'];
-                                    for (const id of ids) {
-                                        const btn = document.getElementById(id);
-                                        if (btn) {
-                                            btn.click();
-                                            return true;
-                                        }
-                                    }
-
-                                    // 尝试查找包含特定文本的按钮
-                                    const buttons = Array.from(document.querySelectorAll('button'));
-                                    for (const btn of buttons) {
-                                        if (btn.textContent.includes('续费') ||
-                                            btn.textContent.includes('续期') ||
-                                            btn.textContent.includes('点击续费')) {
-                                            btn.click();
-                                            return true;
-                                        }
-                                    }
-
-                                    return false;
-                                }''')
-
-                                if clicked:
-                                    debug_info("通过JavaScript直接点击了续期按钮", account=account)
-                                    renew_button_found = True
-                                    time.sleep(3)
-                                else:
-                                    debug_info("无法通过JavaScript直接点击续期按钮", account=account)
-                            except Exception as e:
-                                debug_info(f"直接点击submitRenew按钮时出错: {str(e)}", account=account)
-
-                        # 检查是否出现弹窗
-                        if renew_button_found:
-                            popup_handled = handle_popup_renew(page, account)
-                            if popup_handled:
-                                debug_info("已处理弹窗中的续期按钮", account=account, step_name="popup_handled_after_search")
-
-                    if not renew_button_found:
-                        debug_info("未找到续期按钮，尝试方法2...", account=account, step_name="no_button_found")
-                        raise Exception("未找到续期按钮")
-
-                    # 检查是否有确认对话框
-                    confirm_selectors = [
-                        'button:has-text("确定")',
-                        'button:has-text("确认")',
-                        'button.btn-primary:has-text("确定")',
-                        'button.btn-confirm',
-                        'button[type="submit"]:has-text("确定")'
-                    ]
-
-                    # 记录所有可见的确认按钮
-                    all_confirm_buttons = []
-                    for selector in ['button', 'input[type="submit"]']:
-                        elements = page.locator(selector).all()
-                        for element in elements:
-                            try:
-                                text = element.text_content()
-                                all_confirm_buttons.append({"selector": selector, "text": text})
-                            except:
-                                pass
-
-                    debug_info("页面上的所有确认按钮元素", data=all_confirm_buttons, account=account)
-
-                    confirm_button_found = False
-                    for selector in confirm_selectors:
-                        if page.locator(selector).count() > 0:
-
-                            try:
-                                # 尝试使用JavaScript点击
-                                page.evaluate(f'document.querySelector("{selector}").click()')
-                                debug_info("使用JavaScript点击确认按钮", account=account)
-                            except:
-                                # 如果JavaScript点击失败，使用Playwright点击
-                                page.locator(selector).first.click()
-                                debug_info("使用Playwright点击确认按钮", account=account)
-
-                            confirm_button_found = True
-                            time.sleep(3)
-                            debug_info("点击确认按钮后", account=account)
-                            break
-
-                    if confirm_button_found:
-                        print("已点击确认按钮")
-                    else:
-                        print("未找到确认按钮")
-
-                    # 检查续期结果
-                    success_texts = ["续期成功", "已续期", "操作成功", "success"]
-                    page_content = page.content().lower()
-
-                    # 保存最终页面内容
-                    debug_info("续期操作后页面内容", data=page_content, account=account)
-
-                    # 尝试从页面内容中提取JSON响应或消息
+                for method in methods:
                     try:
-                        # 导入re模块
-                        import re
-                        # 首先尝试查找layui-layer-content中的消息（基于调试日志中发现的结构）
-                        layui_msg_pattern = r'<div[^>]*class="layui-layer-content[^"]*"[^>]*>(.*?)</div>'
-                        layui_msg_match = re.search(layui_msg_pattern, page_content, re.DOTALL)
-
-                        if layui_msg_match:
-                            # 提取消息内容，去除HTML标签
-                            msg_html = layui_msg_match.group(1)
-                            msg_text = re.sub(r'<[^>]*>', '', msg_html).strip()
-                            debug_info(f"找到弹窗消息: {msg_text}", account=account)
-
-                            # 检查消息内容是否包含特定文本
-                            if "请在到期前" in msg_text and "天后再续费" in msg_text:
-                                debug_info(f"续期结果: {msg_text}", account=account)
-                                return {"code": 1, "msg": msg_text, "success": True}
-                            elif "续期成功" in msg_text or "续费成功" in msg_text or "操作成功" in msg_text:
-                                debug_info(f"续期成功: {msg_text}", account=account)
-                                return {"code": 0, "msg": msg_text, "success": True}
-                            else:
-                                debug_info(f"续期结果: {msg_text}", account=account)
-                                return {"code": 1, "msg": msg_text, "success": True}
-
-                        # 如果没有找到layui消息，尝试查找JSON格式的响应
-                        json_pattern = r'({[\s\S]*?"code"[\s\S]*?"msg"[\s\S]*?})'
-                        json_match = re.search(json_pattern, page_content)
-
-                        if json_match:
-                            response_text = json_match.group(1)
-                            debug_info(f"找到JSON响应: {response_text}", account=account)
-
-                            try:
-                                response_json = json.loads(response_text)
-                                code = response_json.get('code', None)
-                                msg = response_json.get('msg', '')
-
-                                # 检查code是否为0或1（通常0表示成功，1可能表示部分成功或特殊情况）
-                                if code == 0 or code == 1:
-                                    debug_info(f"API续期成功: code: {code}, msg: {msg}", account=account)
-                                    return {"code": code, "msg": msg, "success": True}
-                                else:
-                                    debug_info(f"API响应状态码非0或1: code: {code}, msg: {msg}", account=account)
-                                    # 尝试导航到续期页面查看结果
-                                    try:
-                                        page.goto(renew_url, wait_until='networkidle', timeout=12000)
-                                        debug_info("续期后页面状态", account=account)
-                                    except:
-                                        pass
-
-                                    return {"code": code, "msg": msg, "success": False}
-                            except json.JSONDecodeError:
-                                debug_info(f"无法解析JSON响应: {response_text}", account=account)
-
-                        # 尝试查找alert消息
-                        alert_pattern = r'alert\([\'"]([^\'"]*?)[\'"]\)'
-                        alert_match = re.search(alert_pattern, page_content)
-
-                        if alert_match:
-                            alert_text = alert_match.group(1)
-                            debug_info(f"找到alert消息: {alert_text}", account=account)
-                            return {"code": 1, "msg": alert_text, "success": True}
-
+                        if method == 'api':
+                            result = await asyncio.to_thread(renew_via_api, account, cookie, cf_clearance_cookie)
+                            get_strategy_cache().update(domain, 'renew', method='api')
+                        else:
+                            result, button, popup = await renew_via_page(page, account, renew_url, learned)
+                            get_strategy_cache().update(domain, 'renew', method='page', button=button, popup=popup)
+                        return result
                     except Exception as e:
-                        debug_info(f"提取响应消息时出错: {str(e)}", account=account)
-
-                    # 如果无法提取JSON，使用传统方法检查成功文本
-                    success = False
-                    for text in success_texts:
-                        if text.lower() in page_content:
-                            success = True
-                            debug_info(f"检测到成功信息: '{text}'", account=account)
-                            break
-
-                    if success:
-                        debug_info("续期成功", account=account)
-                        return {"success": True, "text": "续期成功"}
-                    else:
-                        # 如果页面上没有成功信息，尝试方法2
-                        debug_info("未检测到续期成功信息，尝试方法2...", account=account)
-                        raise Exception("未检测到续期成功信息")
-
-                except Exception as e:
-                    print(f"方法1失败: {str(e)}")
-
-                    # 如果方法1失败，尝试重试
-                    if attempt < max_retries - 1:
-                        print(f"等待5秒后重试...")
-                        time.sleep(5)
-                        continue
-                    raise
-
+                        logger.warning("%s失败: %s", '方法2' if method == 'api' else '方法1', e)
+                        if method == methods[-1]:
+                            raise
 
             except Exception as e:
-                print(f"续期尝试 {attempt + 1} 失败: {str(e)}")
+                logger.warning("续期尝试 %s 失败: %s", attempt + 1, e)
 
                 if attempt < max_retries - 1:
-                    print(f"等待5秒后重试...")
-                    time.sleep(5)
+                    logger.info("等待%s秒后重试...", RETRY_DELAY)
+                    await wait_pause('retry_backoff', RETRY_DELAY)
                     continue
                 raise
         # 如果所有尝试都失败，抛出异常
@@ -1254,251 +3054,837 @@ def renew_vps(account, context, cookie, cf_clearance_cookie=None, max_retries=2)
 
         # 截图完成后再关闭页面（如果尚未关闭）
         try:
-            page.close()
+            await page.close()
         except Exception:
             # 页面可能已经关闭，忽略错误
             pass
 
-def main():
-    # 记录启动信息
-    print(f"NetKeep启动 - 时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-    # 从环境变量加载账号信息
-    netkeep_accounts_env = os.environ.get('NETKEEP_ACCOUNTS', '[]')
-
-    # 不再记录环境变量值
+# 浏览器启动参数，使用更多的参数以更好地处理CloudFlare挑战
+BROWSER_ARGS = [
+    '--no-sandbox',
+    '--disable-setuid-sandbox',
+    '--disable-blink-features=AutomationControlled',
+    '--disable-web-security',
+    '--disable-features=IsolateOrigins,site-per-process',
+    '--ignore-certificate-errors',
+    '--disable-extensions',
+    '--disable-dev-shm-usage',
+    '--disable-accelerated-2d-canvas',
+    '--no-first-run',
+    '--no-zygote',
+    '--disable-gpu'
+]
+
+async def launch_browser(p):
+    """启动一个新的Chromium实例"""
+    with span('browser_launch'):
+        return await p.chromium.launch(headless=True, args=BROWSER_ARGS)
+
+class SharedBrowser:
+    """整个运行期间共享的Chromium实例，每个账号只创建独立的上下文，浏览器崩溃后自动重启"""
+
+    def __init__(self, p):
+        self._playwright = p
+        self._browser = None
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        """返回可用的浏览器实例，必要时（首次使用或已断开）重新启动"""
+        async with self._lock:
+            if self._browser is None or not self._browser.is_connected():
+                if self._browser is not None:
+                    logger.info("共享浏览器已断开，正在重新启动...")
+                else:
+                    logger.info("启动共享浏览器实例...")
+                self._browser = await launch_browser(self._playwright)
+            return self._browser
+
+    async def close(self):
+        """关闭共享浏览器实例"""
+        async with self._lock:
+            if self._browser is not None:
+                logger.info("关闭共享浏览器实例...")
+                try:
+                    await self._browser.close()
+                except Exception:
+                    pass
+                self._browser = None
 
+def get_site_name(account):
+    """获取网站类型信息（从域名的结尾前一段获取）"""
     try:
-        # 尝试直接解析JSON
-        accounts = json.loads(netkeep_accounts_env)
-    except json.JSONDecodeError as e:
-        print(f"JSON解析错误: {str(e)}")
-        print("尝试修复JSON格式...")
-
-        # 检查是否是不完整的JSON数组
-        if not netkeep_accounts_env.strip().startswith('['):
-            # 如果不是以[开头，尝试添加[]
-            try:
-                # 尝试将内容包装在[]中
-                fixed_json = '[' + netkeep_accounts_env.strip() + ']'
-                accounts = json.loads(fixed_json)
-                print("成功修复JSON格式")
-            except json.JSONDecodeError:
-                # 如果仍然失败，尝试使用正则表达式提取JSON对象
-                import re
-                try:
-                    # 尝试提取所有JSON对象
-                    pattern = r'({[^{}]*"site"[^{}]*"loginApi"[^{}]*})'
-                    matches = re.findall(pattern, netkeep_accounts_env, re.DOTALL)
-
-                    if matches:
-                        # 将提取的对象组合成一个数组
-                        accounts_json = '[' + ','.join(matches) + ']'
-                        accounts = json.loads(accounts_json)
-                        print(f"成功从环境变量中提取了 {len(accounts)} 个账号")
-                    else:
-                        print("无法从环境变量中提取账号信息")
-                        accounts = []
-                except Exception as e:
-                    print(f"提取JSON对象失败: {str(e)}")
-                    accounts = []
+        # 提取域名部分
+        domain = account['site'].split('//')[1]
+        # 分割域名并获取倒数第二段
+        domain_parts = domain.split('.')
+        if len(domain_parts) >= 2:
+            return domain_parts[-2]  # 获取倒数第二段
+        return domain
+    except Exception:
+        return account['site']
+
+def parse_accounts(netkeep_accounts_env):
+    """解析NETKEEP_ACCOUNTS环境变量中的账号信息，并按字段要求过滤无效账号"""
+    accounts = parse_accounts_text(netkeep_accounts_env)
+    if not isinstance(accounts, list):
+        logger.warning("NETKEEP_ACCOUNTS格式不正确，应为账号数组")
+        return []
+    if not accounts and netkeep_accounts_env.strip() not in ('', '[]'):
+        logger.warning("无法从环境变量中提取账号信息")
+    return validate_accounts(accounts)
+
+def format_renew_status(account, site_name, result):
+    """将续期结果转换为通知中的状态行"""
+    if isinstance(result, dict):
+        # 如果结果是字典格式
+        if 'code' in result and 'msg' in result:
+            # API响应格式
+            code = result.get('code')
+            msg = result.get('msg', '')
+            success = result.get('success', False)
+
+            if success:
+                return f"账号 {account['username']} ({site_name}) 续期成功: code: {code}, msg: \"{msg}\""
+            return f"账号 {account['username']} ({site_name}) 续期结果: code: {code}, msg: \"{msg}\""
+        elif 'text' in result:
+            # 文本响应格式
+            text = result.get('text', '')
+            success = result.get('success', False)
+
+            if success:
+                return f"账号 {account['username']} ({site_name}) 续期成功: {text}"
+            return f"账号 {account['username']} ({site_name}) 续期结果: {text}"
+        # 其他字典格式
+        result_readable = json.dumps(result, ensure_ascii=False)
+        return f"账号 {account['username']} ({site_name}) 续期结果: {result_readable}"
+
+    # 如果结果是字符串或其他格式
+    try:
+        # 尝试解析为JSON
+        result_json = json.loads(result)
+        if 'msg' in result_json:
+            result_readable = json.dumps(result_json, ensure_ascii=False)
+        else:
+            result_readable = str(result)
+    except Exception:
+        result_readable = str(result)
+
+    return f"账号 {account['username']} ({site_name}) 续期结果: {result_readable}"
+
+async def process_account(p, account, index, total, semaphore, shared_browser=None, session_store=None,
+                          login_mode='auto', ledger=None, priority=0, attempt=0):
+    """处理单个账号的登录与续期，返回 (登录状态, 续期状态, 是否成功)
+
+    先占用站点的并发名额，再占用全局名额，避免等待同一站点的账号占住全局名额而阻塞其他站点；
+    两者都是PrioritySemaphore，priority越小越先分到名额。提供了ledger时把本次结果写入续期记录。
+    """
+    async with get_site_limiter(account['site']).semaphore.slot(priority), semaphore.slot(priority):
+        _log_context.set({'account': account['username'], 'site': site_domain(account['site'])})
+        logger.info('=' * 50)
+        logger.info("处理账号 %s/%s: %s", index+1, total, account['username'])
+        # 检查是否有续期API
+        need_renew = 'renewApi' in account and account['renewApi']
+        if need_renew:
+            logger.info("续期API: %s", account['renewApi'])
         else:
-            # 如果已经是以[开头，可能是其他JSON格式问题
-            print("环境变量格式不正确，无法解析")
-            accounts = []
+            logger.info("仅登录")
+        logger.info('=' * 50)
+
+        site_name = get_site_name(account)
+        profile = get_site_profile(account)
+        if profile['name'] != DEFAULT_SITE_PROFILE['name']:
+            logger.info("使用站点配置: %s", profile['name'])
+
+        # 记录该账号所有等待的实际耗时和各阶段耗时
+        waits = WaitRecorder()
+        _current_waits.set(waits)
+        spans = SpanRecorder(site_domain(account['site']), account['username'])
+        _current_spans.set(spans)
+        started = time.monotonic()
+
+        # 非共享模式下为每个账号创建一个新的浏览器实例
+        own_browser = None
+        context = None
+        logged_in = False
+        result = None
+        error = None
+
+        async def get_browser():
+            nonlocal own_browser
+            if shared_browser is not None:
+                # 共享浏览器模式：只为账号创建新的上下文
+                return await shared_browser.get()
+            if own_browser is None:
+                logger.info("为账号 %s 启动新的浏览器实例...", account['username'])
+                own_browser = await launch_browser(p)
+            return own_browser
 
-    # 打印读取到的账号信息
-    print("\n读取到的账号信息:")
-    for i, account in enumerate(accounts):
-        # 获取网站类型信息（从域名的结尾前一段获取）
         try:
-            # 提取域名部分
-            domain = account['site'].split('//')[1]
-            # 分割域名并获取倒数第二段
-            domain_parts = domain.split('.')
-            if len(domain_parts) >= 2:
-                site_name = domain_parts[-2]  # 获取倒数第二段
+            # 登录：简单的面板先检查缓存的会话，失效时使用HTTP方式登录，无法处理时交给浏览器
+            http_result = None
+            if use_http_login(account, login_mode):
+                if session_store is not None:
+                    http_result = await resume_http_session(account, session_store)
+                if http_result is None:
+                    http_result = await try_http_login(account)
+
+            if http_result is not None:
+                http_session, cookie, cf_clearance_cookie = http_result
+                # 复用的会话也重新保存，记录站点刷新后的Cookie
+                if session_store is not None:
+                    session_store.put(account['site'], account['username'],
+                                      {'cookies': session_cookies(http_session), 'origins': []})
             else:
-                site_name = domain
-        except:
-            site_name = account['site']
+                context, cookie, cf_clearance_cookie = await login_and_get_cookie(
+                    account, await get_browser(), session_store=session_store
+                )
+            logged_in = True
+            login_status = f"账号 {account['username']} ({site_name}) 登录成功"
 
-        need_renew = 'renewApi' in account and account['renewApi']
-        # 不再需要need_cookie变量
+            # 检查是否需要续期
+            if need_renew:
+                # 确保有Cookie
+                if not cookie:
+                    raise Exception("需要续期但未获取到Cookie")
+
+                logger.info("账号 %s 配置了续期API，执行续期操作...", account['username'])
+                result = None
+                if context is None:
+                    # HTTP方式登录的账号先直接调用续期API，失败时再使用浏览器续期；
+                    # 该站点记住的续期方式是页面方式时，直接交给浏览器（renew_vps会先走页面再回退到API）；
+                    # 站点配置指定了API方式时不再回退到浏览器
+                    configured_method = get_site_profile(account).get('renewMethod')
+                    renew_learned = get_strategy_cache().get(site_domain(account['site']), 'renew')
+                    api_first = (configured_method or renew_learned.get('method')) != 'page'
+                    if api_first:
+                        try:
+                            result = await asyncio.to_thread(renew_via_api, account, cookie, cf_clearance_cookie,
+                                                             http_session)
+                            get_strategy_cache().update(site_domain(account['site']), 'renew', method='api')
+                        except Exception as e:
+                            if configured_method == 'api':
+                                raise
+                            logger.warning("API续期失败: %s，改用浏览器续期...", e)
+                    if result is None:
+                        context = await new_account_context(await get_browser(), site=account['site'],
+                                                            allow_resources=account.get('allowResources'))
+                        await context.add_cookies(session_cookies(http_session))
+                        result = await renew_vps(account, context, cookie, cf_clearance_cookie,
+                                                 try_api=not api_first)
+                else:
+                    result = await renew_vps(account, context, cookie, cf_clearance_cookie)
+                renew_status = format_renew_status(account, site_name, result)
+                logger.info("账号 %s 续期完成", account['username'])
+            else:
+                logger.info("账号 %s 未配置续期API，仅执行登录操作", account['username'])
+                renew_status = f"账号 {account['username']} ({site_name}) 仅执行登录，未进行续期"
+        except Exception as e:
+            logger.error("账号 %s 处理出错: %s", account['username'], e)
+            error = str(e)
 
-        if need_renew:
-            print(f"账号 {i+1}: {account['username']} ({site_name}), 需要续期, 续期API: {account['renewApi']}")
-        else:
-            print(f"账号 {i+1}: {account['username']} ({site_name}), 仅登录")
+            if not logged_in:
+                login_status = f"账号 {account['username']} ({site_name}) 登录失败: {str(e)}"
+            else:
+                login_status = f"账号 {account['username']} ({site_name}) 登录成功"
 
+            # 检查是否是续期阶段出错
+            if need_renew:
+                renew_status = f"账号 {account['username']} ({site_name}) 续期失败: {str(e)}"
+            else:
+                renew_status = f"账号 {account['username']} ({site_name}) 仅执行登录，未进行续期"
+        finally:
+            # 确保关闭浏览器上下文和浏览器实例
+            if context:
+                logger.info("关闭账号 %s 的浏览器上下文...", account['username'])
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+            if own_browser:
+                logger.info("关闭账号 %s 的浏览器实例...", account['username'])
+                try:
+                    await own_browser.close()
+                except Exception:
+                    pass
 
+            if waits.records:
+                logger.info("账号 %s 等待耗时共 %.2f秒: %s", account['username'], waits.total(), waits.summary())
+            if spans.spans:
+                logger.info("账号 %s 各阶段耗时: %s", account['username'], spans.summary())
+            run_metrics.add_account(spans, time.monotonic() - started, logged_in, renew_status, attempt)
+            if ledger is not None:
+                ledger.record(account, logged_in, result, error)
+
+        ok = logged_in and error is None and not (isinstance(result, dict) and result.get('success') is False)
+        return login_status, renew_status, ok
+
+# 会话检查结果的显示名称
+CHECK_LABELS = {'alive': '有效', 'expired': '已失效', 'challenged': '遇到挑战', 'error': '检查出错'}
+
+def classify_session_response(response, login_url):
+    """根据不跟随重定向的响应判断会话状态，返回 (状态, 说明)，状态为CHECK_LABELS中的键"""
+    if is_cloudflare_challenge(response):
+        return 'challenged', f"CloudFlare挑战（状态码 {response.status_code}）"
+    if response.is_redirect:
+        location = response.headers.get('Location', '')
+        target = urljoin(response.url, location)
+        if "/login" in target or target.split('?')[0] == login_url:
+            return 'expired', f"重定向到登录页 {location}"
+        return 'alive', f"重定向到 {location}"
+    if response.status_code in (401, 403):
+        return 'expired', f"状态码 {response.status_code}"
+    if response.status_code != 200:
+        return 'error', f"状态码 {response.status_code}"
+    login_form, _ = find_login_form(response.text)
+    if login_form is not None:
+        return 'expired', "页面包含登录表单"
+    return 'alive', "状态码 200"
+
+def check_session(account, storage_state, session=None):
+    """使用缓存的会话Cookie请求一次站点配置的会话页面（没有时请求登录页），不跟随重定向，返回 (状态, 说明)
+
+    传入session时Cookie写入该会话，会话有效时调用方可以直接用它续期。
+    """
+    if not storage_state or not storage_state.get('cookies'):
+        return 'expired', "没有缓存的会话"
+    session = session if session is not None else new_http_session()
+    for c in storage_state['cookies']:
+        session.cookies.set(c['name'], c['value'], domain=c.get('domain'), path=c.get('path', '/'))
+    cf_clearance_cookie = get_clearance_cache().get(urlparse(account['site']).netloc)
+    if cf_clearance_cookie:
+        session.cookies.set('cf_clearance', cf_clearance_cookie['value'],
+                            domain=cf_clearance_cookie.get('domain'), path=cf_clearance_cookie.get('path', '/'))
+
+    login_url = f"{account['site']}{account['loginApi']}"
+    url = warmup_url(account) or login_url
+    throttle_site_sync(url)
+    started = time.monotonic()
+    status = 'error'
+    try:
+        response = session.get(url, allow_redirects=False, timeout=HTTP_TIMEOUT)
+        status, detail = classify_session_response(response, login_url)
+    except requests.RequestException as e:
+        detail = str(e)
+    finally:
+        run_metrics.observe('session_check', site_domain(account['site']), time.monotonic() - started,
+                            status != 'error')
+    return status, detail
+
+async def run_checks(accounts, concurrency=HTTP_POOL_SIZE, site_concurrency=2, site_rate=1.0):
+    """并发检查所有账号缓存的会话是否仍然有效（不启动浏览器），返回 [(状态, 说明)]，顺序与accounts一致"""
+    configure_site_limits(accounts, site_concurrency, site_rate)
+    session_store = SessionStore()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def check(account):
+        async with semaphore:
+            _log_context.set({'account': account['username'], 'site': site_domain(account['site'])})
+            # 在事件循环中读取会话缓存，工作线程只发送请求
+            storage_state = session_store.get(account['site'], account['username'])
+            status, detail = await asyncio.to_thread(check_session, account, storage_state)
+            logger.info("会话%s: %s", CHECK_LABELS[status], detail)
+            return status, detail
+
+    return await asyncio.gather(*(check(account) for account in accounts))
+
+def format_check_report(accounts, results):
+    """把会话检查结果整理为通知消息"""
+    counts = {}
+    lines = []
+    for account, (status, detail) in zip(accounts, results):
+        counts[status] = counts.get(status, 0) + 1
+        lines.append(f"账号 {account['username']} ({get_site_name(account)}) 会话{CHECK_LABELS[status]}: {detail}")
+    summary = "，".join(f"{CHECK_LABELS[status]} {count}" for status, count in counts.items())
+    return f"NetKeep 会话检查（{summary}）:\n\n" + "\n".join(lines)
+
+async def run_account(p, account, index, total, semaphore, shared_browser=None, session_store=None,
+                      login_mode='auto', ledger=None, priority=0, retries=0):
+    """处理单个账号，失败时最多再重试retries次（保持原来的优先级），返回最后一次的 (登录状态, 续期状态)"""
+    for attempt in range(retries + 1):
+        if attempt:
+            logger.info("账号 %s 处理失败，%s秒后重试（%s/%s）", account['username'], RETRY_DELAY, attempt, retries)
+            await wait_pause('retry_backoff', RETRY_DELAY)
+        login_status, renew_status, ok = await process_account(
+            p, account, index, total, semaphore, shared_browser, session_store, login_mode, ledger, priority, attempt
+        )
+        if ok:
+            break
+    return login_status, renew_status
+
+async def process_accounts(p, accounts, concurrency=1, shared_browser=None, session_store=None, login_mode='auto',
+                           ledger=None, retries=0):
+    """在已启动的Playwright中处理一批账号，结果按传入顺序返回 (登录状态列表, 续期状态列表)
+
+    有续期记录时按紧迫程度分配名额：离到期最近、最久未登录、连续失败最多的账号先处理；
+    失败的账号最多再重试retries次，重试时保持原来的优先级，因此也先于不紧迫的账号。
+    没有记录时按站点交替的顺序处理。
+    """
+    semaphore = PrioritySemaphore(max(1, concurrency))
+    order = interleave_by_domain(accounts)
+    now = time.time()
+    priorities = {i: (ledger.urgency(accounts[i], now) if ledger is not None else 0, rank)
+                  for rank, i in enumerate(order)}
+    if ledger is not None:
+        order.sort(key=priorities.get)
+        logger.info("处理顺序: %s", ", ".join(accounts[i]['username'] for i in order))
+
+    ordered_results = await asyncio.gather(*(
+        run_account(p, accounts[i], i, len(accounts), semaphore, shared_browser, session_store, login_mode, ledger,
+                    priorities[i], retries)
+        for i in order
+    ))
+    results = [None] * len(accounts)
+    for i, result in zip(order, ordered_results):
+        results[i] = result
+
+    login_statuses = [login_status for login_status, _ in results]
+    renew_statuses = [renew_status for _, renew_status in results]
+    return login_statuses, renew_statuses
+
+async def run_accounts(accounts, concurrency=1, browser_mode='shared', use_session_cache=True, login_mode='auto',
+                       site_concurrency=2, site_rate=1.0, ledger=None, retries=0):
+    """按站点分组调度，不同站点并行、同一站点受并发数和请求速率限制，结果按配置顺序返回"""
+    configure_site_limits(accounts, site_concurrency, site_rate)
+    session_store = SessionStore() if use_session_cache else None
+    async with async_playwright() as p:
+        shared_browser = SharedBrowser(p) if browser_mode == 'shared' else None
+        try:
+            return await process_accounts(p, accounts, concurrency, shared_browser, session_store, login_mode, ledger,
+                                          retries)
+        finally:
+            if shared_browser is not None:
+                await shared_browser.close()
+
+# 常驻模式下检查配置变化的间隔（秒）
+DAEMON_TICK = 60
+
+def daemon_next_run(ledger, account, jitter, retry, now=None):
+    """计算常驻模式下账号的下次运行时间
+
+    上次失败的账号按失败次数指数退避（最长1天）；尚未到期的账号在到期时间之后、续期窗口之内随机抖动，
+    避免所有账号在同一时刻访问站点。
+    """
+    now = now if now is not None else time.time()
+    entry = ledger.get(account)
+    if entry.get('failures'):
+        return entry.get('updated_at', now) + min(retry * 2 ** (entry['failures'] - 1), 24 * 3600)
+    due_at = ledger.next_due(account, now)
+    if due_at <= now:
+        return now
+    window = entry.get('window_days', DEFAULT_RENEW_WINDOW_DAYS) * 86400 if account.get('renewApi') else jitter
+    return due_at + random.uniform(0, min(jitter, window))
+
+async def run_daemon(args, notifier):
+    """常驻模式：Playwright和共享浏览器保持运行，按续期记录为每个账号安排运行时间，账号配置变化时自动重新加载
+
+    每个到期的账号作为单独的任务启动，共用同一个全局并发名额，调度循环不等待正在处理的账号，
+    因此处理较慢的账号不会推迟其他账号的运行时间。处理结果攒到没有正在处理的账号（或超过一个检查间隔）时合并通知。
+    """
+    ledger = RenewLedger()
+    session_store = None if args.no_session_cache else SessionStore()
+    retry = float(os.environ.get('NETKEEP_DAEMON_RETRY', 3600))
+    semaphore = PrioritySemaphore(max(1, args.concurrency))
+    stop = asyncio.Event()
+    # 收到退出信号、账号处理完成时唤醒调度循环
+    wake = asyncio.Event()
+
+    def request_stop():
+        stop.set()
+        wake.set()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # Windows不支持add_signal_handler，此时依赖KeyboardInterrupt退出
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, request_stop)
+
+    accounts = {}
+    accounts_json = None
+    schedule = {}
+    running = {}
+    results = []
+    results_since = None
+
+    def report():
+        nonlocal results_since
+        login_statuses = [login_status for login_status, _ in results]
+        renew_statuses = [renew_status for _, renew_status in results]
+        notifier.send("NetKeep 登录与续期状态:\n\n" + "\n".join(login_statuses) + "\n\n" + "\n".join(renew_statuses))
+        export_metrics(args)
+        results.clear()
+        results_since = None
+
+    async def run(key, account, index, total):
+        nonlocal results_since
+        try:
+            results.append(await run_account(
+                p, account, index, total, semaphore, shared_browser, session_store, args.login_mode, ledger,
+                ledger.urgency(account), args.account_retries
+            ))
+            if results_since is None:
+                results_since = time.time()
+        except Exception as e:
+            logger.error("账号 %s 处理出错: %s", account['username'], e)
+        finally:
+            running.pop(key, None)
+            wake.set()
 
-    if not accounts:
-        print("NETKEEP_ACCOUNTS 环境变量中未配置任何账号")
-        send_telegram_message("NetKeep 续期失败: 没有配置任何账号")
+    first = True
+    async with async_playwright() as p:
+        shared_browser = SharedBrowser(p)
+        try:
+            try:
+                await shared_browser.get()
+            except Exception as e:
+                logger.warning("预先启动浏览器失败: %s，将在需要时重试", e)
+
+            while not stop.is_set():
+                wake.clear()
+                # load_config每次都会重新载入.env，因此比较载入后的账号配置，config.json和.env的修改都会生效
+                load_config()
+                if os.environ.get('NETKEEP_ACCOUNTS', '[]') != accounts_json:
+                    accounts_json = os.environ.get('NETKEEP_ACCOUNTS', '[]')
+                    accounts = {account_key(a): a for a in filter_shard(parse_accounts(accounts_json), args.shard)}
+                    if not first:
+                        logger.info("配置已变化，重新加载 %s 个账号", len(accounts))
+                        load_site_profiles(args.profiles)
+                    configure_site_limits(list(accounts.values()), args.site_concurrency, args.site_rate)
+                    schedule = {key: at for key, at in schedule.items() if key in accounts}
+
+                now = time.time()
+                for key, account in accounts.items():
+                    if key not in schedule and key not in running:
+                        schedule[key] = now if first and args.force else \
+                            daemon_next_run(ledger, account, args.daemon_jitter, retry, now)
+                        logger.info("账号 %s 下次运行时间: %s", account['username'], format_timestamp(schedule[key]))
+                first = False
+
+                keys = list(accounts)
+                for key in [key for key, at in schedule.items() if at <= now]:
+                    del schedule[key]
+                    logger.info("账号 %s 已到期，开始处理", accounts[key]['username'])
+                    running[key] = asyncio.create_task(run(key, accounts[key], keys.index(key), len(keys)))
+
+                if results and (not running or time.time() - results_since >= args.daemon_tick):
+                    report()
+
+                next_at = min(schedule.values(), default=now + args.daemon_tick)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(wake.wait(), timeout=max(1, min(next_at - time.time(), args.daemon_tick)))
+
+            if running:
+                logger.info("等待 %s 个正在处理的账号完成...", len(running))
+                await asyncio.gather(*running.values(), return_exceptions=True)
+            if results:
+                report()
+        finally:
+            await shared_browser.close()
+    logger.info("常驻模式已退出")
+
+def parse_shard(value):
+    """解析"i/N"形式的分片参数（i从1开始），返回 (i, N)"""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value or '')
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError("分片格式应为 i/N，且 1 <= i <= N，例如 1/4")
+    return int(match.group(1)), int(match.group(2))
+
+def shard_of(account, count):
+    """按 (site, username) 的稳定哈希返回账号所在的分片（0 ~ count-1），与账号顺序和运行环境无关"""
+    digest = hashlib.sha256(account_key(account).encode('utf-8')).hexdigest()
+    return int(digest[:16], 16) % count
+
+def filter_shard(accounts, shard):
+    """只保留属于分片 (i, N) 的账号，shard为None时原样返回"""
+    if not shard:
+        return accounts
+    index, count = shard
+    return [account for account in accounts if shard_of(account, count) == index - 1]
+
+def strip_option(argv, option):
+    """从命令行参数中去掉一个带值的选项（"--opt value"或"--opt=value"）"""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            result.append(arg)
+    return result
+
+def write_worker_results(path, accounts, login_statuses, renew_statuses, skipped):
+    """工作进程把各账号的状态行和指标写入结果文件，由父进程汇总"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'keys': [account_key(account) for account in accounts],
+                   'login': login_statuses, 'renew': renew_statuses, 'skipped': skipped,
+                   'metrics': run_metrics.dump()}, f, ensure_ascii=False)
+
+def run_workers(argv, accounts, count):
+    """启动count个工作进程，各自用独立的浏览器处理一个分片，返回合并后的 (登录状态, 续期状态, 跳过的账号)
+
+    工作进程使用与父进程相同的命令行参数，另外加上 --shard k/N 和结果文件；它们不发送通知，
+    由父进程把所有分片的状态按配置顺序合并为一条通知，并合并各进程的阶段耗时指标。
+    """
+    base_argv = strip_option(argv, '--workers')
+    result_dir = tempfile.mkdtemp(prefix='netkeep-workers-')
+    workers = []
+    for index in range(1, count + 1):
+        path = os.path.join(result_dir, f"shard-{index}.json")
+        command = [sys.executable, os.path.abspath(__file__), *base_argv,
+                   '--shard', f"{index}/{count}", '--results-file', path]
+        workers.append((index, path, subprocess.Popen(command)))
+    logger.info("已启动 %s 个工作进程", count)
+
+    positions = {account_key(account): i for i, account in enumerate(accounts)}
+    merged, failed, skipped = [], [], []
+    for index, path, process in workers:
+        returncode = process.wait()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            logger.error("分片 %s/%s 的工作进程没有返回结果（退出码 %s）", index, count, returncode)
+            failed.append(f"分片 {index}/{count} 的工作进程异常退出（退出码 {returncode}）")
+            continue
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        merged.extend(zip(results['keys'], results['login'], results['renew']))
+        skipped.extend(results['skipped'])
+        run_metrics.merge(results['metrics'])
+    with contextlib.suppress(OSError):
+        os.rmdir(result_dir)
+
+    merged.sort(key=lambda item: positions.get(item[0], len(positions)))
+    login_statuses = [login_status for _, login_status, _ in merged]
+    renew_statuses = [renew_status for _, _, renew_status in merged] + failed
+    return login_statuses, renew_statuses, skipped
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="NetKeep - 自动登录与续期")
+    parser.add_argument(
+        '--concurrency', type=int,
+        default=int(os.environ.get('NETKEEP_CONCURRENCY', '1')),
+        help="同时处理的账号数量（默认读取NETKEEP_CONCURRENCY，未设置时为1）"
+    )
+    parser.add_argument(
+        '--browser-mode', choices=['shared', 'per-account'],
+        default=os.environ.get('NETKEEP_BROWSER_MODE', 'shared'),
+        help="shared: 整个运行共享一个浏览器，每个账号使用独立上下文；per-account: 每个账号启动独立的浏览器"
+    )
+    parser.add_argument(
+        '--no-session-cache', action='store_true',
+        default=os.environ.get('NETKEEP_SESSION_CACHE', '1') == '0',
+        help="不复用缓存的登录会话，每次都执行表单登录"
+    )
+    parser.add_argument(
+        '--login-mode', choices=['auto', 'http', 'browser'],
+        default=os.environ.get('NETKEEP_LOGIN_MODE', 'auto'),
+        help="默认登录方式（账号配置中的loginMode优先）：auto先尝试HTTP登录，遇到CloudFlare或无法识别的表单时改用浏览器"
+    )
+    parser.add_argument(
+        '--site-concurrency', type=int,
+        default=int(os.environ.get('NETKEEP_SITE_CONCURRENCY', '2')),
+        help="同一站点同时处理的账号数量（账号配置中的siteConcurrency优先）"
+    )
+    parser.add_argument(
+        '--site-rate', type=float,
+        default=float(os.environ.get('NETKEEP_SITE_RATE', '1.0')),
+        help="同一站点每秒最多发起的请求数，0表示不限速（账号配置中的siteRate优先）"
+    )
+    parser.add_argument(
+        '--no-block-resources', action='store_true',
+        default=os.environ.get('NETKEEP_BLOCK_RESOURCES', '1') == '0',
+        help="不拦截图片、字体、媒体和统计请求"
+    )
+    parser.add_argument(
+        '--account-retries', type=int,
+        default=int(os.environ.get('NETKEEP_ACCOUNT_RETRIES', '0')),
+        help="处理失败的账号重新排队重试的次数（默认0），重试按账号的紧迫程度优先分配名额"
+    )
+    parser.add_argument(
+        '--force', action='store_true',
+        default=os.environ.get('NETKEEP_FORCE', '0') == '1',
+        help="忽略续期记录，处理所有账号（默认跳过尚未到续期时间且近期登录过的账号）"
+    )
+    parser.add_argument(
+        '--check', action='store_true',
+        help="只检查各账号缓存的会话是否有效（有效/已失效/遇到挑战），不启动浏览器、不登录、不续期"
+    )
+    parser.add_argument(
+        '--shard', type=parse_shard,
+        default=parse_shard(os.environ['NETKEEP_SHARD']) if os.environ.get('NETKEEP_SHARD') else None,
+        help="只处理第i个分片的账号（格式 i/N，按站点和用户名的哈希稳定划分），可用于把账号分给多个CI任务"
+    )
+    parser.add_argument(
+        '--workers', type=int,
+        default=int(os.environ.get('NETKEEP_WORKERS', '1')),
+        help="把账号按分片交给N个工作进程（各自启动浏览器）并行处理，最后合并为一条通知（默认1）"
+    )
+    parser.add_argument('--results-file', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--daemon', action='store_true',
+        default=os.environ.get('NETKEEP_DAEMON', '0') == '1',
+        help="常驻运行：保持浏览器启动，按续期记录定时处理各账号，配置文件变化时自动重新加载"
+    )
+    parser.add_argument(
+        '--daemon-jitter', type=float,
+        default=float(os.environ.get('NETKEEP_DAEMON_JITTER', 1800)),
+        help="常驻模式下每个账号运行时间的最大随机延迟（秒，默认1800，不超过账号的续期窗口）"
+    )
+    parser.add_argument(
+        '--daemon-tick', type=float,
+        default=float(os.environ.get('NETKEEP_DAEMON_TICK', DAEMON_TICK)),
+        help="常驻模式下检查配置变化的间隔（秒，默认60）"
+    )
+    parser.add_argument(
+        '--profiles', default=os.environ.get('NETKEEP_PROFILES', PROFILES_PATH),
+        help="站点配置文件（默认profiles.json，不存在时使用内置的默认配置）"
+    )
+    parser.add_argument(
+        '--metrics-json', default=os.environ.get('NETKEEP_METRICS_JSON'),
+        help="运行结束后把各阶段耗时摘要写入该JSON文件"
+    )
+    parser.add_argument(
+        '--metrics-textfile', default=os.environ.get('NETKEEP_METRICS_TEXTFILE'),
+        help="运行结束后把Prometheus格式的指标写入该文件（供node_exporter的textfile collector读取）"
+    )
+    parser.add_argument(
+        '--metrics-port', type=int,
+        default=int(os.environ.get('NETKEEP_METRICS_PORT', '0')),
+        help="在该端口提供 /metrics 和 /metrics.json（默认0，不启动）"
+    )
+    parser.add_argument(
+        '--log-level', type=str.upper, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        default=os.environ.get('NETKEEP_LOG_LEVEL', 'INFO').upper(),
+        help="日志级别（默认INFO，DEBUG会额外收集页面按钮等调试信息）"
+    )
+    parser.add_argument(
+        '--log-file', default=os.environ.get('NETKEEP_LOG_FILE'),
+        help="同时把日志以JSON行格式写入该文件（带账号和站点字段）"
+    )
+    return parser.parse_args(argv)
+
+def export_metrics(args):
+    """按命令行参数导出本次运行的阶段耗时"""
+    try:
+        if args.metrics_json:
+            write_metrics_json(args.metrics_json)
+            logger.info("阶段耗时摘要已写入 %s", args.metrics_json)
+        if args.metrics_textfile:
+            write_metrics_textfile(args.metrics_textfile)
+            logger.info("Prometheus指标已写入 %s", args.metrics_textfile)
+    except OSError as e:
+        logger.warning("导出指标失败: %s", e)
+
+def main(argv=None):
+    # 先按环境变量配置日志以便输出配置加载信息，解析命令行参数后再按参数重新配置
+    setup_logging(os.environ.get('NETKEEP_LOG_LEVEL', 'INFO').upper())
+    load_config()
+    argv = list(argv if argv is not None else sys.argv[1:])
+    args = parse_args(argv)
+    setup_logging(args.log_level, args.log_file)
+    if args.no_block_resources:
+        os.environ['NETKEEP_BLOCK_RESOURCES'] = '0'
+    load_site_profiles(args.profiles)
+
+    notifier = TelegramNotifier()
+    # 工作进程的指标由父进程合并后导出
+    if args.metrics_port and not args.results_file:
+        start_metrics_server(args.metrics_port)
+
+    # 记录启动信息
+    logger.info("NetKeep启动 - 时间: %s", datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+    def report(accounts, login_statuses, renew_statuses, skipped=()):
+        """发送结果通知并导出指标；作为工作进程运行时只把结果写入文件，由父进程汇总"""
+        if args.results_file:
+            write_worker_results(args.results_file, accounts, login_statuses, renew_statuses, list(skipped))
+            return
+        # 所有账号都被跳过时也发送通知，让跳过的原因出现在Telegram中
+        sections = ["\n".join(lines) for lines in (login_statuses, renew_statuses, skipped) if lines]
+        if sections:
+            notifier.send("NetKeep 登录与续期状态:\n\n" + "\n\n".join(sections))
+        notifier.close()
+        export_metrics(args)
+
+    if args.daemon:
+        if args.workers > 1:
+            logger.warning("常驻模式不支持--workers，请为每个分片分别以--daemon --shard i/N运行")
+        logger.info("以常驻模式运行，并发处理账号数: %s", max(1, args.concurrency))
+        try:
+            asyncio.run(run_daemon(args, notifier))
+        except KeyboardInterrupt:
+            pass
+        notifier.close()
+        export_metrics(args)
         return
 
-    login_statuses = []
-    renew_statuses = []
+    # 从环境变量加载账号信息
+    accounts = parse_accounts(os.environ.get('NETKEEP_ACCOUNTS', '[]'))
 
-    with sync_playwright() as p:
-        for i, account in enumerate(accounts):
-            print(f"\n{'='*50}")
-            print(f"处理账号 {i+1}/{len(accounts)}: {account['username']}")
-            # 检查是否有续期API
-            need_renew = 'renewApi' in account and account['renewApi']
-            if need_renew:
-                print(f"续期API: {account['renewApi']}")
-            else:
-                print(f"仅登录")
-            print(f"{'='*50}\n")
+    # 打印读取到的账号信息
+    logger.info("读取到的账号信息:")
+    for i, account in enumerate(accounts):
+        site_name = get_site_name(account)
+        need_renew = 'renewApi' in account and account['renewApi']
 
-            # 为每个账号创建一个新的浏览器实例
-            browser = None
-            context = None
+        if need_renew:
+            logger.info("账号 %s: %s (%s), 需要续期, 续期API: %s", i+1, account['username'], site_name,
+                        account['renewApi'])
+        else:
+            logger.info("账号 %s: %s (%s), 仅登录", i+1, account['username'], site_name)
 
-            try:
-                # 获取网站类型信息
-                # 提取域名部分
-                domain = account['site'].split('//')[1]
-                # 分割域名并获取倒数第二段
-                domain_parts = domain.split('.')
-                if len(domain_parts) >= 2:
-                    site_name = domain_parts[-2]  # 获取倒数第二段
-                else:
-                    site_name = domain
-                need_renew = 'renewApi' in account and account['renewApi']
-                # 不再需要need_cookie变量
-
-                print(f"为账号 {account['username']} 启动新的浏览器实例...")
-                # 使用更多的浏览器参数，以更好地处理CloudFlare挑战
-                browser = p.chromium.launch(
-                    headless=True,
-                    args=[
-                        '--no-sandbox',
-                        '--disable-setuid-sandbox',
-                        '--disable-blink-features=AutomationControlled',
-                        '--disable-web-security',
-                        '--disable-features=IsolateOrigins,site-per-process',
-                        '--ignore-certificate-errors',
-                        '--disable-extensions',
-                        '--disable-dev-shm-usage',
-                        '--disable-accelerated-2d-canvas',
-                        '--no-first-run',
-                        '--no-zygote',
-                        '--disable-gpu'
-                    ]
-                )
+    if not accounts:
+        logger.info("NETKEEP_ACCOUNTS 环境变量中未配置任何账号")
+        if args.results_file:
+            report([], [], [])
+            return
+        notifier.send("NetKeep 续期失败: 没有配置任何账号")
+        notifier.close()
+        return
 
-                # 登录
-                context, cookie, cf_clearance_cookie = login_and_get_cookie(account, browser)
-                login_statuses.append(f"账号 {account['username']} ({site_name}) 登录成功")
-
-                # 检查是否需要续期
-                if need_renew:
-                    # 确保有Cookie
-                    if not cookie:
-                        raise Exception("需要续期但未获取到Cookie")
-
-                    print(f"账号 {account['username']} 配置了续期API，执行续期操作...")
-                    result = renew_vps(account, context, cookie, cf_clearance_cookie)
-
-                    # 处理续期结果
-                    if isinstance(result, dict):
-                        # 如果结果是字典格式
-                        if 'code' in result and 'msg' in result:
-                            # API响应格式
-                            code = result.get('code')
-                            msg = result.get('msg', '')
-                            success = result.get('success', False)
-
-                            if success:
-                                renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期成功: code: {code}, msg: \"{msg}\"")
-                            else:
-                                renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期结果: code: {code}, msg: \"{msg}\"")
-                        elif 'text' in result:
-                            # 文本响应格式
-                            text = result.get('text', '')
-                            success = result.get('success', False)
-
-                            if success:
-                                renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期成功: {text}")
-                            else:
-                                renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期结果: {text}")
-                        else:
-                            # 其他字典格式
-                            result_readable = json.dumps(result, ensure_ascii=False)
-                            renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期结果: {result_readable}")
-                    else:
-                        # 如果结果是字符串或其他格式
-                        try:
-                            # 尝试解析为JSON
-                            result_json = json.loads(result)
-                            if 'msg' in result_json:
-                                # 确保Unicode已经被正确解码为中文
-                                result_json['msg'] = result_json['msg']
-                                result_readable = json.dumps(result_json, ensure_ascii=False)
-                            else:
-                                result_readable = str(result)
-                        except:
-                            result_readable = str(result)
-
-                        renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期结果: {result_readable}")
-
-                    print(f"账号 {account['username']} 续期完成")
-                else:
-                    print(f"账号 {account['username']} 未配置续期API，仅执行登录操作")
-                    renew_statuses.append(f"账号 {account['username']} ({site_name}) 仅执行登录，未进行续期")
-            except Exception as e:
-                print(f"账号 {account['username']} 处理出错: {str(e)}")
+    if args.shard:
+        accounts = filter_shard(accounts, args.shard)
+        logger.info("分片 %s/%s: 处理其中 %s 个账号", *args.shard, len(accounts))
+    elif args.workers > 1 and not args.check:
+        login_statuses, renew_statuses, skipped = run_workers(argv, accounts, args.workers)
+        report(accounts, login_statuses, renew_statuses, skipped)
+        logger.info("执行完成")
+        return
 
-                # 获取网站类型信息用于状态消息
-                try:
-                    # 提取域名部分
-                    domain = account['site'].split('//')[1]
-                    # 分割域名并获取倒数第二段
-                    domain_parts = domain.split('.')
-                    if len(domain_parts) >= 2:
-                        site_name = domain_parts[-2]  # 获取倒数第二段
-                    else:
-                        site_name = domain
-                except:
-                    site_name = account['site']
+    if args.check:
+        start = time.monotonic()
+        results = asyncio.run(run_checks(accounts, max(HTTP_POOL_SIZE, args.concurrency),
+                                         args.site_concurrency, args.site_rate))
+        logger.info("会话检查完成，共 %s 个账号，耗时 %.2f秒", len(accounts), time.monotonic() - start)
+        notifier.send(format_check_report(accounts, results))
+        notifier.close()
+        export_metrics(args)
+        return
 
-                if 'context' not in locals() or context is None:
-                    login_statuses.append(f"账号 {account['username']} ({site_name}) 登录失败: {str(e)}")
-                else:
-                    login_statuses.append(f"账号 {account['username']} ({site_name}) 登录成功")
+    # 在启动浏览器之前按续期记录跳过尚未到期的账号
+    ledger = RenewLedger()
+    accounts, skipped = select_due_accounts(accounts, ledger, force=args.force)
+    if not accounts:
+        logger.info("所有账号均未到处理时间，本次跳过（可使用--force强制执行）")
+        report([], [], [], skipped)
+        return
 
-                # 检查是否是续期阶段出错
-                need_renew = 'renewApi' in account and account['renewApi']
-                if need_renew:
-                    renew_statuses.append(f"账号 {account['username']} ({site_name}) 续期失败: {str(e)}")
-                else:
-                    renew_statuses.append(f"账号 {account['username']} ({site_name}) 仅执行登录，未进行续期")
-            finally:
-                # 确保关闭浏览器上下文和浏览器实例
-                if context:
-                    print(f"关闭账号 {account['username']} 的浏览器上下文...")
-                    context.close()
-                if browser:
-                    print(f"关闭账号 {account['username']} 的浏览器实例...")
-                    browser.close()
-
-                # 添加延迟，确保资源完全释放
-                print("等待5秒，确保资源完全释放...")
-                time.sleep(5)
-
-    message = "NetKeep 登录与续期状态:\n\n" + "\n".join(login_statuses) + "\n\n" + "\n".join(renew_statuses)
-    send_telegram_message(message)
-    print("执行完成")
+    logger.info("并发处理账号数: %s，浏览器模式: %s", max(1, args.concurrency), args.browser_mode)
+    login_statuses, renew_statuses = asyncio.run(run_accounts(
+        accounts, args.concurrency, args.browser_mode, use_session_cache=not args.no_session_cache,
+        login_mode=args.login_mode, site_concurrency=args.site_concurrency, site_rate=args.site_rate,
+        ledger=ledger, retries=args.account_retries
+    ))
+    report(accounts, login_statuses, renew_statuses, skipped)
+    logger.info("执行完成")
 
 if __name__ == "__main__":
     try:
-        print("开始执行脚本...")
         main()
-        print("脚本执行完成")
-    except Exception as e:
-        import traceback
-        print(f"脚本执行出错: {str(e)}")
-        traceback.print_exc()
\ No newline at end of file
+    except Exception:
+        logger.exception("脚本执行出错")